@@ -3,6 +3,8 @@
 import pandas as pd
 import numpy as np
 
+from features import parsing
+
 def has_appointment_same_day(df: pd.DataFrame) -> pd.Series:
     ''' 
     Returns a boolean series indicating if that patient has more than one appointmet scheduled on that day
@@ -29,9 +31,9 @@ def difference_scheduling_and_arrival(df: pd.DataFrame, treshold:int = 60) -> pd
     Absoulte values larger than the treshold are being replaced to missing
     '''
 
-    arrival = pd.to_datetime(df['AANKOMST'], format='%H:%M', errors='coerce')
-    scheduled = pd.to_datetime(df['STARTTIMEPLAN'], format='%H:%M', errors='coerce')
-    diff_minutes = (arrival - scheduled).dt.total_seconds() / 60
+    arrival = parsing.time_to_minutes(df['AANKOMST'])
+    scheduled = parsing.time_to_minutes(df['STARTTIMEPLAN'])
+    diff_minutes = (arrival - scheduled).astype('float64')
     diff_minutes.loc[abs(diff_minutes) > treshold] = np.nan
 
     return diff_minutes
@@ -41,7 +43,7 @@ def fetch_weekday(series: pd.Series) -> pd.Series:
     ''' 
     Gets the weekday of the given dates 
     '''
-    return series.dt.strftime('%A')
+    return parsing.map_unique(series, lambda dates: dates.dt.strftime('%A'))
 
 def fetch_month(series: pd.Series) -> pd.Series:
     '''
@@ -55,5 +57,4 @@ def fetch_appointment_hour(series: pd.Series) -> pd.Series:
     Fetches the hour of the appointment
     Format should be a string in format 'hh:mm'
     '''
-    times = pd.to_datetime(series, format= '%H:%M')
-    return times.dt.hour
+    return parsing.map_unique(series, lambda times: pd.to_datetime(times, format= '%H:%M').dt.hour)
@@ -1,11 +1,14 @@
 import pandas as pd
 
+from features import schema
+
 def get_specialism(df: pd.DataFrame) -> pd.Series:
     ''' 
     Cobmines two columns to get the specialism
     If SPECCODE is NULL it will use TARAFD
     '''
-    specs = df['SPECCODE'].combine_first(df['TARAFD'])
+    speccode, tarafd = schema.union_categories(df['SPECCODE'], df['TARAFD'])
+    specs = speccode.combine_first(tarafd)
     return specs
 
 def process_target_variable(df: pd.DataFrame) -> pd.DataFrame:
@@ -21,17 +24,21 @@ def process_target_variable(df: pd.DataFrame) -> pd.DataFrame:
 
     return df
 
-def get_feature_df(df: pd.DataFrame, training:bool) -> pd.DataFrame:
+def get_feature_df(df: pd.DataFrame, training:bool, extended_features: bool = False) -> pd.DataFrame:
     '''
     Returns a dataframe with only the features.
     It also sorts the dataframe in the right format/sorted
     if training is set to true, the target variable will be added
+    if extended_features is set to true, the extended history features will be added
     '''
     feature_cols = ['GESLACHT', 'LEEFTIJD', 'POSTCODE', 'WOONPLAATS', # patient features
                 'AGENDA', 'DESCRIPTION', 'CONSTYPE', 'CODE', 'SPECIALISME','LOCATIE', 'DUUR', # appointment features
                 'AfspraakZelfdeDag', 'AFSTAND', 'VerschilInplannenEnAfspraak', 'num_no_shows', 'perc_no_shows', 'stiptheid', 'MaandAfspraak', 'DagAfspraak', 'TijdAfspraak',  # engineerd features
                 'num_appointments', 'last_noshow', 'days_since_last_appointment', # engineerd features
                 ]
+    if extended_features:
+        feature_cols += ['num_no_shows_spec', 'perc_no_shows_spec', 'num_appointments_spec', 'appointment_last_week', 'weighted_no_show_percentage']
+
     # if you want to train with the data, add target variable and date
     if training:
         feature_cols.append('no_show')
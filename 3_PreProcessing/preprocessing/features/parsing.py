@@ -0,0 +1,32 @@
+'''Functions to parse columns with few distinct values, every distinct value is only parsed once'''
+
+import pandas as pd
+import numpy as np
+
+
+def map_unique(series: pd.Series, func) -> pd.Series:
+    '''
+    Applies func to the distinct values of a series and maps the results back onto every row
+    func gets a series with the distinct values and should return a series of the same length
+    Missing values are not passed to func and stay missing
+    '''
+    codes, uniques = pd.factorize(series)
+    if isinstance(uniques.dtype, pd.CategoricalDtype):
+        uniques = np.asarray(uniques)   # func gets the values themselves, not categories
+    results = func(pd.Series(uniques)).reset_index(drop=True)
+    mapped = results.reindex(codes)
+    mapped.index = series.index
+    mapped.name = series.name
+
+    return mapped
+
+
+def time_to_minutes(series: pd.Series, errors: str = 'coerce') -> pd.Series:
+    '''
+    Parses strings in the format 'hh:mm' to the number of minutes since midnight
+    '''
+    def parse(uniques: pd.Series) -> pd.Series:
+        times = pd.to_datetime(uniques, format='%H:%M', errors=errors)
+        return times.dt.hour * 60 + times.dt.minute
+
+    return map_unique(series, parse)
@@ -0,0 +1,125 @@
+'''Converts the csv export of no_show_query.sql to a parquet dataset partitioned by year and month of the appointment'''
+
+import os
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from features import schema
+
+
+# fixed schema of the export, so every chunk is parsed the same way regardless of the values in it
+EXPORT_DTYPES = {'PATIENTNR': 'int64', 'MERGED': 'Int64', 'IsTestPatient': 'Int64', 'GESLACHT': str, 'POSTCODE': str, 'WOONPLAATS': str,
+                 'LEEFTIJD': 'float64', 'TIMEDIFF': str, 'STARTTIMEPLAN': str, 'AANKOMST': str, 'AGENDA': str, 'SUBAGENDA': str,
+                 'SPECCODE': str, 'TARAFD': str, 'LOCATIONID': str, 'DESCRIPTION': str, 'IsVoldaan': str, 'AfspraakstatusKey': 'Int64',
+                 'REDEN': str, 'CONSTYPE': str, 'CODE': str, 'MEMO': str, 'OMSCHR': str, 'DUUR': 'Int64'}
+DATE_COLUMNS = ['INVOERDAT', 'STARTDATEPLAN']
+
+# columns with few distinct values, these are dictionary encoded in the parquet files
+CATEGORICAL_COLUMNS = ['GESLACHT', 'POSTCODE', 'WOONPLAATS', 'TIMEDIFF', 'STARTTIMEPLAN', 'AANKOMST', 'AGENDA', 'SUBAGENDA', 'SPECCODE',
+                       'TARAFD', 'LOCATIONID', 'DESCRIPTION', 'IsVoldaan', 'REDEN', 'CONSTYPE', 'CODE']
+
+# columns used by preprocessing.preprocess_noshow_data
+PREPROCESSING_COLUMNS = ['PATIENTNR', 'GESLACHT', 'POSTCODE', 'WOONPLAATS', 'LEEFTIJD', 'INVOERDAT', 'STARTDATEPLAN', 'STARTTIMEPLAN',
+                         'AANKOMST', 'AGENDA', 'SPECCODE', 'TARAFD', 'DESCRIPTION', 'AfspraakstatusKey', 'REDEN', 'CONSTYPE', 'CODE', 'DUUR']
+
+PARTITION_COLUMNS = ['year', 'month']
+
+ARROW_TYPES = {'int64': pa.int64(), 'Int64': pa.int64(), 'float64': pa.float64(), str: pa.string()}
+
+
+def get_arrow_schema(columns: list) -> pa.Schema:
+    '''
+    Returns the arrow schema of the export columns, unknown columns are stored as strings
+    An explicit schema keeps the files of all chunks compatible, also when a column is completely empty in a chunk
+    '''
+    fields = []
+    for col in columns:
+        if col in DATE_COLUMNS:
+            fields.append(pa.field(col, pa.timestamp('ns')))
+        elif col in PARTITION_COLUMNS:
+            fields.append(pa.field(col, pa.int16()))
+        else:
+            fields.append(pa.field(col, ARROW_TYPES[EXPORT_DTYPES.get(col, str)]))
+
+    return pa.schema(fields)
+
+
+def ingest_export(file: str, dataset_path: str, chunksize: int = 1_000_000) -> int:
+    '''
+    Reads the csv export in chunks and appends every chunk to the parquet dataset at dataset_path
+    The dataset is partitioned by year and month of STARTDATEPLAN, so later stages only read the months they need
+
+    Returns the number of ingested appointments
+    '''
+    if os.path.exists(dataset_path) and os.listdir(dataset_path):
+        raise FileExistsError(f'{dataset_path} is not empty, remove it first to ingest a new export')
+
+    n_rows = 0
+    reader = pd.read_csv(file, sep=';', parse_dates=DATE_COLUMNS, dtype=EXPORT_DTYPES, encoding='utf-8-sig', chunksize=chunksize)
+    for i, chunk in enumerate(reader):
+        chunk['year'] = chunk['STARTDATEPLAN'].dt.year.astype('int16')
+        chunk['month'] = chunk['STARTDATEPLAN'].dt.month.astype('int16')
+
+        table = pa.Table.from_pandas(chunk, schema=get_arrow_schema(chunk.columns), preserve_index=False)
+        # the chunk number in the file name keeps the order of the export within a partition
+        pq.write_to_dataset(table, dataset_path, partition_cols=PARTITION_COLUMNS, basename_template=f'part-{i:05d}-{{i}}.parquet',
+                            use_dictionary=[col for col in CATEGORICAL_COLUMNS if col in chunk.columns])
+
+        n_rows += len(chunk)
+        print(f'{n_rows} appointments ingested')
+
+    return n_rows
+
+
+def read_dataset(dataset_path: str, columns: list = None, start=None, end=None) -> pd.DataFrame:
+    '''
+    Reads the appointments with start <= STARTDATEPLAN < end from the parquet dataset
+    Only the requested columns are read and only the partitions which overlap the date range are opened
+
+    Parameters
+    ----------
+    dataset_path : str
+        Path of the dataset written by ingest_export
+    columns : list
+        Columns to read, all export columns if None
+    start, end : str or pd.Timestamp
+        Date range to read (format: yyyy-mm-dd), open ended if None
+
+    Returns
+    -------
+    pd.DataFrame
+        Appointments sorted on STARTDATEPLAN (appointments on the same date keep the order of the export), with the dtypes of features/schema.py
+    '''
+    # the dictionary encoded columns are read as categories straight away
+    file_format = ds.ParquetFileFormat(read_options={'dictionary_columns': CATEGORICAL_COLUMNS})
+    dataset = ds.dataset(dataset_path, format=file_format, partitioning='hive')
+
+    # the partition filter prunes the months outside of the range, the date filter the days within the first and last month
+    months = ds.field('year') * 12 + ds.field('month')
+    condition = ds.scalar(True)
+    if start is not None:
+        start = pd.Timestamp(start)
+        condition &= (months >= start.year * 12 + start.month) & (ds.field('STARTDATEPLAN') >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        condition &= (months <= end.year * 12 + end.month) & (ds.field('STARTDATEPLAN') < end)
+
+    if columns is None:
+        columns = [col for col in dataset.schema.names if col not in PARTITION_COLUMNS]
+
+    df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if 'STARTDATEPLAN' in df.columns:
+        df = df.sort_values(by='STARTDATEPLAN', kind='mergesort').reset_index(drop=True)
+
+    return schema.apply_schema(df)
+
+
+if __name__ == '__main__':
+    # converts an export of no_show_query.sql, which only has to be done once per export
+    file = sys.argv[1]
+    dataset_path = sys.argv[2]
+
+    ingest_export(file, dataset_path)
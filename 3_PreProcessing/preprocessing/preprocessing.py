@@ -1,12 +1,18 @@
+import os
+import numpy as np
 import pandas as pd
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from features import datetime, geographic, cumulative, misc
+import ingest
+
+from features import datetime, geographic, cumulative, misc, schema
 from cleaning import cleaning
 
 
 
-def preprocess_noshow_data(df_data: pd.DataFrame, start_year, hist_years: int, training: bool = False) -> pd.DataFrame:
+def preprocess_noshow_data(df_data: pd.DataFrame, start_year, hist_years: int, training: bool = False, extended_features: bool = False,
+                           memory_report: list = None) -> pd.DataFrame:
     '''
     Preprocesses all of the data so that it can be used for training or inference
 
@@ -26,6 +32,11 @@ def preprocess_noshow_data(df_data: pd.DataFrame, start_year, hist_years: int, t
         Boolean to indicate if the preprocessing is for training
         If training=True the target variable is attached to the dataframe
         If training=False the target variable is not attached to the dataframe
+    extended_features : bool
+        Boolean to indicate if the extended history features are added (see cumulative.calculate_cum_features)
+        These are the specialism level and decay weighted no show features
+    memory_report : list
+        If given, the size of the dataframe and the peak memory after every stage are appended (see features/schema.py)
     
     Returns
     -------
@@ -33,12 +44,18 @@ def preprocess_noshow_data(df_data: pd.DataFrame, start_year, hist_years: int, t
         Dataframe containing the preprocessed data
         Only the features for modelling are returned
     '''
+    # the declared dtypes are applied at the start and after every stage
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'ingest', df_data)
+
     # removing data not suitable for prediction
     df_data = cleaning.clean_data(df_data)
     df_data = df_data[df_data['CONSTYPE'].isin(['H', 'E', 'V', '*'])]
 
     # get target variable
     df_data = misc.process_target_variable(df_data)  
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'cleaning', df_data)
 
     # get date features
     df_data['AfspraakZelfdeDag'] = datetime.has_appointment_same_day(df_data)
@@ -49,22 +66,82 @@ def preprocess_noshow_data(df_data: pd.DataFrame, start_year, hist_years: int, t
     df_data['TijdAfspraak'] = datetime.fetch_appointment_hour(df_data['STARTTIMEPLAN'])
     df_data['SPECIALISME'] = misc.get_specialism(df_data)
     df_data['VerschilAankomstEnStart'] = datetime.difference_scheduling_and_arrival(df_data, treshold=60)
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'date features', df_data)
 
     # get geo features
     df_data['POSTCODE'] = geographic.extract_zipcode(df_data['POSTCODE'])
-    df_data['LOCATIE'] = df_data['DESCRIPTION'].apply(geographic.get_location)
-    zip_codes = geographic.get_all_nl_zip_codes('/export/home/jmaathuis/Documents/NO-SHOWS/3_PreProcessing/NL(1).txt')
-    df_data = df_data.merge(zip_codes, how='left', left_on='POSTCODE', right_index=True)
-    df_data['AFSTAND'] = geographic.haversine_distance(df_data['LOCATIE'], df_data['latitude'], df_data['longitude'])
+    df_data['LOCATIE'] = geographic.get_locations(df_data['DESCRIPTION'])
+    zip_code_index = geographic.load_zip_code_index('/export/home/jmaathuis/Documents/NO-SHOWS/3_PreProcessing/NL(1).txt')   # precomputed coordinates and distances per postal code
+    zip_code_features = geographic.lookup_zip_codes(zip_code_index, df_data['POSTCODE'], df_data['LOCATIE'])
+    for col in ['latitude', 'longitude', 'AFSTAND']:
+        df_data[col] = zip_code_features[col]
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'geo features', df_data)
 
     # get cumulative features
-    df_data = cumulative.calculate_cum_features(df_data, history_years=hist_years, exclude_days=3)
+    df_data = cumulative.calculate_cum_features(df_data, history_years=hist_years, exclude_days=3, extended=extended_features)
     # df_data = df_data[df_data['STARTDATEPLAN'] >= start_year]
 
     df_data = df_data[df_data['CONSTYPE'].isin(['H', 'E', 'V', '*'])]
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'cumulative features', df_data)
+
     return df_data
     # return misc.get_feature_df(df_data, training=training)
-    
+
+
+def hash_partitions(patients: pd.Series, n_partitions: int) -> np.ndarray:
+    '''
+    Returns the partition of every row based on a hash of the patient number
+    All appointments of a patient end up in the same partition, and a patient is in the same partition in every run
+    '''
+    hashes = pd.util.hash_pandas_object(patients.astype(str), index=False).to_numpy()
+    return (hashes % n_partitions).astype(np.int64)
+
+
+def preprocess_partition(df_data: pd.DataFrame, start_year, hist_years: int, training: bool, extended_features: bool,
+                         report_memory: bool) -> tuple:
+    '''
+    Preprocesses one partition of patients in a worker process, returns the preprocessed data and the memory report of the worker
+    '''
+    memory_report = [] if report_memory else None
+    df_data = preprocess_noshow_data(df_data, start_year=start_year, hist_years=hist_years, training=training,
+                                     extended_features=extended_features, memory_report=memory_report)
+
+    return df_data, memory_report
+
+
+def preprocess_noshow_data_partitioned(df_data: pd.DataFrame, start_year, hist_years: int, n_workers: int, n_partitions: int = None,
+                                       training: bool = False, extended_features: bool = False, memory_report: list = None) -> pd.DataFrame:
+    '''
+    Preprocesses the data like preprocess_noshow_data, with the patients split over a pool of n_workers processes
+    Every stage only combines appointments of the same patient, so the patients are partitioned by a hash of their patient number
+    and every partition is preprocessed on its own. The partitions are combined in the order of preprocess_noshow_data
+    (STARTDATEPLAN, PATIENTNR), so the result is identical to a single run.
+
+    There are more partitions than workers (default 4 per worker), so a worker which finishes early picks up the next partition
+    '''
+    if n_partitions is None:
+        n_partitions = 4 * n_workers
+
+    partitions = hash_partitions(df_data['PATIENTNR'], n_partitions)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(preprocess_partition, df_data[partitions == i], start_year, hist_years, training, extended_features,
+                               memory_report is not None)
+                   for i in range(n_partitions) if (partitions == i).any()]
+        results = [future.result() for future in futures]
+
+    if memory_report is not None:
+        for _, report in results:
+            memory_report.extend(report)
+
+    # a patient is in one partition only, so (STARTDATEPLAN, PATIENTNR) is unique and the sort gives the order of a single run
+    df_data = schema.concat([df for df, _ in results])
+    df_data = df_data.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'], kind='mergesort').reset_index(drop=True)
+
+    return schema.apply_schema(df_data)
+
 
 if __name__ == '__main__':
     # case for creating a training setepr
@@ -72,18 +149,37 @@ if __name__ == '__main__':
     start_year = str(sys.argv[2])
     history_years = int(sys.argv[3])
     # appointments = int(sys.argv[4])
-
-    outfile = f'{file.split(".csv")[0]}_start_date={start_year}_hist={history_years}_improved2.csv'
+    extended_features = '--extended' in sys.argv[4:]
+    memory_report = [] if '--memory-report' in sys.argv[4:] else None
+    # --workers=n preprocesses the patients in n processes (see preprocess_noshow_data_partitioned)
+    n_workers = next((int(arg.split('=')[1]) for arg in sys.argv[4:] if arg.startswith('--workers=')), 1)
+
+    if os.path.isdir(file):
+        # parquet dataset written by ingest.py, only the history needed for the appointments from start_year is read
+        outfile = f'{file.rstrip("/")}_start_date={start_year}_hist={history_years}_improved2.parquet'
+        history_start = pd.Timestamp(start_year) - pd.DateOffset(years=history_years)
+        df = ingest.read_dataset(file, columns=ingest.PREPROCESSING_COLUMNS, start=history_start)
+    else:
+        outfile = f'{file.split(".csv")[0]}_start_date={start_year}_hist={history_years}_improved2.csv'
+        # the text columns are parsed to categories directly, so the strings are never all in memory at once
+        categories = {col: 'category' for col, dtype in schema.SCHEMA.items() if dtype == 'category'}
+        df = pd.read_csv(file, sep=';', parse_dates=['STARTDATEPLAN', 'INVOERDAT'], 
+                    dtype={**categories, 'PATIENTNR': 'int64', 'MERGED': 'int64', 'AfspraakstatusKey': 'Int64', 'DUUR': pd.Int64Dtype()},
+                    encoding='utf-8-sig')
     print(outfile)
 
-    df = pd.read_csv(file, sep=';', parse_dates=['STARTDATEPLAN', 'INVOERDAT'], 
-                dtype={'PATIENTNR': 'int64', 'MERGED': 'int64', 'GESLACHT': str, 'POSTOCDE': str, 'WOONPLAATS': str, #'LEEFTIJD': 'int64', 
-                        'STARTTIMEPLAN': str, 'AANKOMST': str, 'AGENDA': str, 'SUBAGENDA': str, 'SPECCODE': str, 'TARAFD': str,
-                        'LOCATIONID': str, 'DESCRIPTION': str, 'IsVoldaan': str, 'AfspraakstatusKey': 'Int64', 'CONSTYPE': str, 'CODE': str,
-                        'DUUR': pd.Int64Dtype()}, encoding='utf-8-sig')
-
-    df_pp = preprocess_noshow_data(df, start_year=start_year, hist_years=history_years, training=True)
-
-    df_pp.to_csv(outfile, index=0)
+    if n_workers > 1:
+        df_pp = preprocess_noshow_data_partitioned(df, start_year=start_year, hist_years=history_years, n_workers=n_workers, training=True,
+                                                   extended_features=extended_features, memory_report=memory_report)
+    else:
+        df_pp = preprocess_noshow_data(df, start_year=start_year, hist_years=history_years, training=True, extended_features=extended_features,
+                                       memory_report=memory_report)
+    if memory_report is not None:
+        schema.print_memory_report(memory_report)
+
+    if outfile.endswith('.parquet'):
+        df_pp.to_parquet(outfile, index=False)
+    else:
+        df_pp.to_csv(outfile, index=0)
 
 
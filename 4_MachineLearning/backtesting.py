@@ -0,0 +1,234 @@
+'''Rolling origin backtesting of the model on the preprocessed training set: train up to a month, test on the next month'''
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from concurrent.futures import ProcessPoolExecutor
+from xgboost import XGBClassifier
+from sklearn.metrics import average_precision_score, roc_auc_score
+from sklearn.utils import class_weight
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '3_PreProcessing', 'preprocessing'))
+from features import misc, vocabulary
+
+
+# parameters of the model in machine_learning.ipynb, on the cpu since the folds run in parallel
+CLASSIFIER_PARAMS = {
+    'tree_method': 'hist',
+    'enable_categorical': True,
+    'learning_rate': 0.15,
+    'max_cat_to_onehot': 25,
+    'max_cat_threshold': 5,
+    'reg_alpha': 10,
+    'scale_pos_weight': 0.5,
+    'n_estimators': 350,
+}
+
+# specialisms left out of the training set in machine_learning.ipynb (noisy for different reasons)
+NOISY_SPECIALISMS = ['RAD', 'APO', 'ONC', 'GEV', 'ORT', 'GGZ', 'PSY', 'ANE']
+
+# the appointments of a workday are predicted 3 workdays before it, the model of a fold only knows the outcomes up to then
+HORIZON_WORKDAYS = 3
+
+# feature arrays shared with the fold processes, see init_fold_worker
+features = None
+
+
+def filter_training_set(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Applies the filters of machine_learning.ipynb: no weekends, only consultation types H, E, V and * and no noisy specialisms
+    '''
+    df = df[~df['DagAfspraak'].isin(['Saturday', 'Sunday'])]
+    df = df[df['CONSTYPE'].isin(['H', 'E', 'V', '*'])]
+
+    return df[~df['SPECIALISME'].isin(NOISY_SPECIALISMS)]
+
+
+def iter_training_set(path: str, extended_features: bool = False, batch_rows: int = 1_000_000, start=None):
+    '''
+    Yields the preprocessed training set (a parquet file or a directory of parquet files) in filtered batches of at most batch_rows rows
+    Only the features, the target and the date are read (from start on if given), so the training set never has to fit in memory
+    '''
+    dataset = ds.dataset(path, format='parquet')
+    columns = misc.get_feature_df(dataset.schema.empty_table().to_pandas(), training=True, extended_features=extended_features).columns.tolist()
+    condition = None if start is None else ds.field('STARTDATEPLAN') >= pd.Timestamp(start)
+    for batch in dataset.to_batches(columns=columns + ['STARTDATEPLAN'], filter=condition, batch_size=batch_rows):
+        df = filter_training_set(batch.to_pandas())
+        if len(df) > 0:
+            yield df
+
+
+def build_feature_cache(path: str, cache_dir: str, extended_features: bool = False, batch_rows: int = 1_000_000, vocabularies: dict = None,
+                        start=None):
+    '''
+    Encodes the features of the preprocessed training set (from start on if given) once and saves them as arrays in cache_dir
+    The training set is read twice in batches: once for the vocabularies and the number of rows, once to encode every batch straight
+    into the arrays on disk. The categorical features are saved as their code in the vocabulary (NaN if missing), the other features as float32
+    Pass the vocabularies of a model to encode the features for that model, values it has not seen get the unknown code
+    '''
+    values, n_rows = {col: set() for col in vocabulary.CATEGORICAL_FEATURES}, 0
+    for df in iter_training_set(path, extended_features=extended_features, batch_rows=batch_rows, start=start):
+        if vocabularies is None:
+            for col, batch_values in vocabulary.build_vocabularies(df).items():
+                values[col].update(batch_values)
+        n_rows += len(df)
+    if n_rows == 0:
+        raise ValueError(f'{path} has no appointments left after the filters')
+    if vocabularies is None:
+        # the sorted values of all batches, the same vocabularies as build_vocabularies gives on the whole training set
+        vocabularies = {col: pd.Index(list(col_values)).sort_values().tolist() for col, col_values in values.items()}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays, offset = {}, 0
+    for df in iter_training_set(path, extended_features=extended_features, batch_rows=batch_rows, start=start):
+        X = vocabulary.encode(misc.get_feature_df(df, training=False, extended_features=extended_features).copy(), vocabularies)
+        if not arrays:
+            arrays = {name: np.lib.format.open_memmap(os.path.join(cache_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+                      for name, dtype, shape in [('X', np.float32, (n_rows, len(X.columns))), ('y', np.int8, (n_rows,)),
+                                                 ('dates', 'datetime64[D]', (n_rows,)), ('specialism', np.int64, (n_rows,))]}
+        rows = slice(offset, offset + len(X))
+        for i, col in enumerate(X.columns):
+            if col in vocabularies:
+                codes = X[col].cat.codes.to_numpy()
+                arrays['X'][rows, i] = np.where(codes >= 0, codes, np.nan)
+            else:
+                arrays['X'][rows, i] = X[col].to_numpy(dtype=np.float32, na_value=np.nan)
+        arrays['y'][rows] = df['no_show'].to_numpy(dtype=np.int8)
+        arrays['dates'][rows] = df['STARTDATEPLAN'].to_numpy(dtype='datetime64[D]')
+        arrays['specialism'][rows] = X['SPECIALISME'].cat.codes.to_numpy()
+        offset += len(X)
+    for array in arrays.values():
+        array.flush()
+
+    vocabulary.save_vocabularies(vocabularies, os.path.join(cache_dir, 'vocabularies.json'))
+    with open(os.path.join(cache_dir, 'features.json'), 'w') as f:
+        json.dump({'features': X.columns.tolist(), 'feature_types': ['c' if col in vocabularies else 'q' for col in X.columns],
+                   'specialisms': vocabularies['SPECIALISME'] + [vocabulary.UNKNOWN]}, f, indent=1)
+
+
+def load_feature_cache(cache_dir: str, mmap_mode: str = 'r') -> dict:
+    '''
+    Loads the arrays and the vocabularies saved by build_feature_cache, memory mapped so processes share the pages instead of copying them
+    '''
+    with open(os.path.join(cache_dir, 'features.json')) as f:
+        cache = json.load(f)
+    cache['vocabularies'] = vocabulary.load_vocabularies(os.path.join(cache_dir, 'vocabularies.json'))
+    for name in ['X', 'y', 'dates', 'specialism']:
+        cache[name] = np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    return cache
+
+
+def get_folds(dates: np.ndarray, first_test_month: str, last_test_month: str, train_months: int = None) -> list:
+    '''
+    Returns the (train start, train end, test start, test end) dates of every fold, one fold per test month
+    The training set ends HORIZON_WORKDAYS workdays before the test month, the outcomes after that are not known when the first
+    workday of the test month is predicted. It starts at the first date (expanding window) or train_months months before the test month
+    '''
+    folds = []
+    for test_start in pd.date_range(first_test_month, last_test_month, freq='MS'):
+        test_end = test_start + pd.DateOffset(months=1)
+        train_end = test_start - pd.offsets.BDay(HORIZON_WORKDAYS)
+        train_start = dates.min() if train_months is None else test_start - pd.DateOffset(months=train_months)
+        folds.append((pd.Timestamp(train_start), train_end, test_start, test_end))
+
+    return folds
+
+
+def get_cache_dir(file: str, extended_features: bool = False) -> str:
+    '''
+    Returns the default directory of the feature cache of a training set, next to it
+    '''
+    return f'{file.rsplit(".", 1)[0]}_features{"_extended" if extended_features else ""}'
+
+
+def init_fold_worker(cache_dir: str):
+    '''
+    Opens the memory mapped feature arrays in a process of the fold pool
+    '''
+    global features
+    features = load_feature_cache(cache_dir)
+
+
+def evaluate_fold(fold: tuple, params: dict, min_rows: int = 500) -> list:
+    '''
+    Trains a model on the training dates of the fold and evaluates it on the test month
+    Returns the number of appointments, no shows, PR-AUC and ROC-AUC over all specialisms and per specialism with at least min_rows
+    appointments and both outcomes in the test month
+    '''
+    train_start, train_end, test_start, test_end = [np.datetime64(date.date(), 'D') for date in fold]
+    dates = features['dates']
+    train = np.flatnonzero((dates >= train_start) & (dates < train_end))
+    test = np.flatnonzero((dates >= test_start) & (dates < test_end))
+    if len(train) == 0 or len(test) == 0:
+        return []
+
+    # the rows of the fold are read from the memory mapped arrays, only the training and test rows are copied
+    y_train = features['y'][train]
+    start = time.perf_counter()
+    model = XGBClassifier(**params, feature_types=features['feature_types'])
+    model.fit(features['X'][train], y_train, sample_weight=class_weight.compute_sample_weight('balanced', y=y_train))
+    y_test, specialism = features['y'][test], features['specialism'][test]
+    y_score = model.predict_proba(features['X'][test])[:, 1]
+    seconds = time.perf_counter() - start
+
+    results = []
+    groups = [('TOTAAL', np.ones(len(test), dtype=bool))] + [(spec, specialism == code) for code, spec in enumerate(features['specialisms'])]
+    for spec, rows in groups:
+        if rows.sum() < min_rows or len(np.unique(y_test[rows])) < 2:
+            continue
+        results.append({'test_month': str(test_start)[:7], 'specialism': spec, 'n_train': len(train), 'n_appointments': int(rows.sum()),
+                        'n_no_shows': int(y_test[rows].sum()), 'pr_auc': average_precision_score(y_test[rows], y_score[rows]),
+                        'roc_auc': roc_auc_score(y_test[rows], y_score[rows]), 'seconds': seconds})
+
+    return results
+
+
+def backtest(cache_dir: str, first_test_month: str, last_test_month: str, train_months: int = None, n_workers: int = 4,
+             params: dict = CLASSIFIER_PARAMS, min_rows: int = 500) -> pd.DataFrame:
+    '''
+    Runs the folds of the rolling origin backtest concurrently in n_workers processes, every fold trains with the remaining cores
+    Returns the metrics per fold and specialism (see evaluate_fold)
+    '''
+    folds = get_folds(load_feature_cache(cache_dir)['dates'], first_test_month, last_test_month, train_months=train_months)
+    params = dict(params, n_jobs=max(1, (os.cpu_count() or 1) // n_workers))
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_fold_worker, initargs=(cache_dir,)) as pool:
+        results = pool.map(evaluate_fold, folds, [params] * len(folds), [min_rows] * len(folds))
+
+    return pd.DataFrame([row for fold in results for row in fold])
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Returns the mean and standard deviation over the folds of the PR-AUC and ROC-AUC per specialism, sorted on PR-AUC
+    '''
+    summary = results.groupby('specialism').agg(folds=('test_month', 'count'), n_appointments=('n_appointments', 'sum'),
+                                                pr_auc=('pr_auc', 'mean'), pr_auc_std=('pr_auc', 'std'),
+                                                roc_auc=('roc_auc', 'mean'), roc_auc_std=('roc_auc', 'std'))
+
+    return summary.sort_values(by='pr_auc', ascending=False)
+
+
+if __name__ == '__main__':
+    # python backtesting.py <preprocessed.parquet> <results.csv> <first test month yyyy-mm> <last test month yyyy-mm>
+    #                       [--workers=4] [--train-months=n] [--cache=<dir>] [--extended]
+    file, outfile, first_test_month, last_test_month = sys.argv[1:5]
+    options = dict(arg[2:].split('=', 1) if '=' in arg else (arg[2:], True) for arg in sys.argv[5:] if arg.startswith('--'))
+    cache_dir = options.get('cache', get_cache_dir(file, extended_features='extended' in options))
+
+    # the features are encoded once, later backtests on the same file start from the cache
+    if not os.path.exists(os.path.join(cache_dir, 'features.json')):
+        build_feature_cache(file, cache_dir, extended_features='extended' in options)
+
+    start = time.perf_counter()
+    results = backtest(cache_dir, first_test_month, last_test_month, n_workers=int(options.get('workers', 4)),
+                       train_months=int(options['train-months']) if 'train-months' in options else None)
+    results.to_csv(outfile, index=False)
+
+    print(summarize(results).to_string(float_format='%.3f'))
+    print(f'{results["test_month"].nunique()} folds in {time.perf_counter() - start:.0f}s, results saved to {outfile}')
@@ -0,0 +1,145 @@
+'''Refreshes the production model on the newest months of appointments by continuing its boosting instead of a full retrain'''
+
+import os
+import sys
+import json
+import time
+import joblib
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import xgboost
+from sklearn.metrics import average_precision_score, roc_auc_score
+
+import backtesting
+import train
+from features import vocabulary
+
+
+def get_refresh_months(dates: np.ndarray, months: int, holdout_months: int) -> tuple:
+    '''
+    Returns the start of the refresh window and the start and end of the holdout: the last holdout_months months are the holdout,
+    the months before it the refresh window. The refresh window ends HORIZON_WORKDAYS workdays before the holdout (see split_train_valid)
+    '''
+    last_month = pd.Timestamp(dates.max()).to_period('M')
+    holdout_start = (last_month - holdout_months + 1).to_timestamp()
+
+    return (last_month - holdout_months - months + 1).to_timestamp(), holdout_start, (last_month + 1).to_timestamp()
+
+
+def continue_boosting(booster: xgboost.Booster, params: dict, dtrain: xgboost.DMatrix, rounds: int, drop_trees: int = 0) -> xgboost.Booster:
+    '''
+    Drops the last drop_trees trees of booster and adds rounds trees fitted on dtrain, the booster itself is left as it is
+    The first trees keep what the model learned from years of history, the new trees correct it for the newest appointments
+    '''
+    n_trees = booster.num_boosted_rounds()
+    if drop_trees >= n_trees:
+        raise ValueError(f'The model has {n_trees} trees, it can not drop {drop_trees}')
+    kept = booster[:n_trees - drop_trees] if drop_trees > 0 else booster.copy()
+
+    return xgboost.train(params, dtrain, num_boost_round=rounds, xgb_model=kept)
+
+
+def evaluate(booster: xgboost.Booster, cache: dict, rows: np.ndarray) -> dict:
+    '''
+    Returns the PR-AUC and ROC-AUC of booster on the rows of the feature cache
+    '''
+    y = cache['y'][rows]
+    dmatrix = xgboost.DMatrix(cache['X'][rows], feature_names=cache['features'], feature_types=cache['feature_types'], enable_categorical=True)
+    y_score = booster.predict(dmatrix)
+
+    return {'pr_auc': average_precision_score(y, y_score), 'roc_auc': roc_auc_score(y, y_score)}
+
+
+def refresh(model, vocabularies: dict, file: str, cache_dir: str, months: int = 1, holdout_months: int = 1, rounds: int = 50,
+            drop_trees: int = 0, tolerance: float = 0.0) -> tuple:
+    '''
+    Continues the boosting of model on the newest months of the preprocessed training set and compares it with model on a holdout
+    The candidate is accepted if its PR-AUC on the holdout is at most tolerance below that of the production model.
+    An accepted candidate is refreshed once more on the refresh window and the holdout together, with the same settings
+
+    Only the months needed are read and encoded, with the vocabularies of the model. Returns the refreshed model (None if it is
+    rejected) and a report with the metrics of both models
+    '''
+    booster = model.get_booster()
+    # the model was trained with the extended features if it knows them
+    extended_features = 'num_no_shows_spec' in booster.feature_names
+    dates = ds.dataset(file, format='parquet').to_table(columns=['STARTDATEPLAN'])['STARTDATEPLAN'].to_numpy()
+    start, holdout_start, holdout_end = get_refresh_months(dates, months, holdout_months)
+
+    backtesting.build_feature_cache(file, cache_dir, extended_features=extended_features, vocabularies=vocabularies, start=start)
+    cache = backtesting.load_feature_cache(cache_dir)
+    if cache['features'] != booster.feature_names:
+        raise ValueError(f'The features of the model and of {file} differ')
+
+    cache_dates = cache['dates']
+    train_end = holdout_start - pd.offsets.BDay(backtesting.HORIZON_WORKDAYS)
+    train_rows = np.flatnonzero(cache_dates < np.datetime64(train_end.date(), 'D'))
+    holdout = np.flatnonzero((cache_dates >= np.datetime64(holdout_start.date(), 'D')) & (cache_dates < np.datetime64(holdout_end.date(), 'D')))
+
+    if len(np.unique(cache['y'][holdout])) < 2:
+        raise ValueError(f'The holdout from {holdout_start.date()} needs appointments with and without a no show')
+
+    # the parameters the model was trained with, on the cpu
+    params = {key: value for key, value in model.get_xgb_params().items() if value is not None}
+    params.update({'device': 'cpu', 'tree_method': 'hist'})
+    max_bin = params.get('max_bin', 256)
+
+    start_time = time.perf_counter()
+    candidate = continue_boosting(booster, params, train.get_dmatrix(cache, train_rows, max_bin), rounds, drop_trees=drop_trees)
+    seconds = time.perf_counter() - start_time
+
+    production_metrics, candidate_metrics = evaluate(booster, cache, holdout), evaluate(candidate, cache, holdout)
+    accepted = candidate_metrics['pr_auc'] >= production_metrics['pr_auc'] - tolerance
+    report = {'last_date': str(pd.Timestamp(dates.max()).date()), 'refresh_start': str(start.date()), 'holdout_start': str(holdout_start.date()),
+              'holdout_end': str(holdout_end.date()), 'n_refresh': len(train_rows), 'n_holdout': len(holdout), 'rounds': rounds, 'drop_trees': drop_trees, 'seconds': seconds,
+              'production': production_metrics, 'candidate': candidate_metrics, 'accepted': bool(accepted)}
+    if not accepted:
+        return None, report
+
+    booster = continue_boosting(booster, params, train.get_dmatrix(cache, np.arange(len(cache_dates)), max_bin), rounds, drop_trees=drop_trees)
+    model.set_params(n_estimators=booster.num_boosted_rounds())
+    model.load_model(booster.save_raw('ubj'))
+
+    return model, report
+
+
+def get_version_path(model_path: str, version: str) -> str:
+    '''
+    Returns the path of a version of a model next to it, no_show_model_v2.joblib becomes no_show_model_v2_<version>.joblib
+    '''
+    base, ext = os.path.splitext(model_path)
+    return f'{base}_{version}{ext}'
+
+
+if __name__ == '__main__':
+    # python refresh.py <model.joblib> <training_set.parquet> [--months=1] [--holdout-months=1] [--rounds=50] [--drop-trees=0]
+    #                   [--tolerance=0.0] [--cache=<dir>] [--output=<model.joblib>]
+    # the refreshed model is saved as a new version next to the model (<model>_<yyyymmdd>.joblib) with its vocabularies and report,
+    # the model itself is never overwritten. The exit code is 1 if the refreshed model is rejected
+    model_path, file = sys.argv[1:3]
+    options = dict(arg[2:].split('=', 1) if '=' in arg else (arg[2:], True) for arg in sys.argv[3:] if arg.startswith('--'))
+    # the features are encoded with the vocabularies of the model, so the cache is specific to the model
+    cache_dir = options.get('cache', f'{backtesting.get_cache_dir(file)}_{os.path.splitext(os.path.basename(model_path))[0]}')
+
+    vocabularies = vocabulary.load_vocabularies(vocabulary.get_vocabularies_path(model_path))
+    if vocabularies is None:
+        raise ValueError('The refresh needs the vocabularies of the model')
+    model = joblib.load(model_path)
+
+    model, report = refresh(model, vocabularies, file, cache_dir, months=int(options.get('months', 1)),
+                            holdout_months=int(options.get('holdout-months', 1)), rounds=int(options.get('rounds', 50)),
+                            drop_trees=int(options.get('drop-trees', 0)), tolerance=float(options.get('tolerance', 0.0)))
+    print(f'Holdout {report["holdout_start"]} - {report["holdout_end"]}: PR-AUC {report["production"]["pr_auc"]:.4f} (production) '
+          f'{report["candidate"]["pr_auc"]:.4f} (refreshed on {report["n_refresh"]} appointments in {report["seconds"]:.0f}s)')
+
+    output_path = options.get('output', get_version_path(model_path, pd.Timestamp(report['last_date']).strftime('%Y%m%d')))
+    with open(f'{os.path.splitext(output_path)[0]}_refresh.json', 'w') as f:
+        json.dump(report, f, indent=1)
+    if model is None:
+        print('Refreshed model rejected, the production model stays')
+        sys.exit(1)
+
+    joblib.dump(model, output_path)
+    vocabulary.save_vocabularies(vocabularies, vocabulary.get_vocabularies_path(output_path))
+    print(f'Refreshed model saved to {output_path}')
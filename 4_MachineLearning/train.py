@@ -0,0 +1,236 @@
+'''Trains the model on the cpu with a successive halving search over the parameters of machine_learning.ipynb'''
+
+import os
+import sys
+import time
+import joblib
+import numpy as np
+import pandas as pd
+import xgboost
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.utils import class_weight
+
+import backtesting
+from features import vocabulary
+
+
+# search space of the bayesian search in machine_learning.ipynb, the number of trees is decided by the search itself
+PARAM_SPACE = {
+    'max_cat_to_onehot': ('int', 1, 50),
+    'max_cat_threshold': ('int', 1, 10),
+    'scale_pos_weight': ('uniform', 0, 1),
+    'reg_alpha': ('uniform', 0, 20),
+    'reg_lambda': ('uniform', 0, 20),
+    'learning_rate': ('log-uniform', 0.01, 1.0),
+    'grow_policy': ('choice', ['depthwise', 'lossguide']),
+    'min_child_weight': ('uniform', 1, 10),
+    'subsample': ('uniform', 0.5, 1.0),
+    'colsample_bytree': ('uniform', 0.5, 1.0),
+    'colsample_bylevel': ('uniform', 0.5, 1.0),
+    'colsample_bynode': ('uniform', 0.5, 1.0),
+    'gamma': ('log-uniform', 0.01, 10.0),
+}
+
+MAX_ROUNDS = 1000
+
+# rows per chunk handed to xgboost, only one chunk of the feature arrays is copied into memory at a time
+CHUNK_ROWS = 1_000_000
+
+# binned training and validation data of a search process, built once and shared by all trials in the process (see init_search_worker)
+data = None
+
+
+def sample_params(rng: np.random.Generator, n_trials: int) -> list:
+    '''
+    Draws n_trials parameter sets from PARAM_SPACE, the first one is the set of machine_learning.ipynb
+    '''
+    trials = [{key: value for key, value in backtesting.CLASSIFIER_PARAMS.items() if key in PARAM_SPACE}]
+    while len(trials) < n_trials:
+        params = {}
+        for key, (kind, *space) in PARAM_SPACE.items():
+            if kind == 'int':
+                params[key] = int(rng.integers(space[0], space[1] + 1))
+            elif kind == 'uniform':
+                params[key] = float(rng.uniform(space[0], space[1]))
+            elif kind == 'log-uniform':
+                params[key] = float(np.exp(rng.uniform(np.log(space[0]), np.log(space[1]))))
+            else:
+                params[key] = space[0][rng.integers(len(space[0]))]
+        trials.append(params)
+
+    return trials
+
+
+def split_train_valid(dates: np.ndarray, valid_months: int) -> tuple:
+    '''
+    Returns the rows to train on and the rows to validate on: the last valid_months months are the validation set,
+    the training set ends HORIZON_WORKDAYS workdays before it, just like a fold of the backtest
+    '''
+    valid_start = (pd.Timestamp(dates.max()).to_period('M') - valid_months + 1).to_timestamp()
+    train_end = valid_start - pd.offsets.BDay(backtesting.HORIZON_WORKDAYS)
+
+    return np.flatnonzero(dates < np.datetime64(train_end.date(), 'D')), np.flatnonzero(dates >= np.datetime64(valid_start.date(), 'D'))
+
+
+class FeatureCacheIter(xgboost.DataIter):
+    '''
+    Hands the rows of the feature cache to xgboost in chunks of CHUNK_ROWS rows
+    xgboost bins the chunks one by one (QuantileDMatrix) or writes them to pages on disk (external memory), so the feature arrays are never
+    copied into memory as a whole. With balanced the classes get sample weights instead of being oversampled
+    '''
+    def __init__(self, cache: dict, rows: np.ndarray, balanced: bool = True, cache_prefix: str = None):
+        self.cache, self.rows, self.chunk = cache, rows, 0
+        y = cache['y'][rows]
+        classes = np.unique(y)
+        self.class_weights = np.ones(classes.max() + 1, dtype=np.float32)
+        if balanced:
+            self.class_weights[classes] = class_weight.compute_class_weight('balanced', classes=classes, y=y)
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> int:
+        if self.chunk * CHUNK_ROWS >= len(self.rows):
+            return 0
+        rows = self.rows[self.chunk * CHUNK_ROWS:(self.chunk + 1) * CHUNK_ROWS]
+        y = self.cache['y'][rows]
+        input_data(data=self.cache['X'][rows], label=y, weight=self.class_weights[y],
+                   feature_names=self.cache['features'], feature_types=self.cache['feature_types'])
+        self.chunk += 1
+        return 1
+
+    def reset(self):
+        self.chunk = 0
+
+
+def get_dmatrix(cache: dict, rows: np.ndarray, max_bin: int, balanced: bool = True, ref: xgboost.DMatrix = None,
+                external_memory_dir: str = None) -> xgboost.DMatrix:
+    '''
+    Returns the matrix of the rows of the feature cache: binned in memory, or in pages in external_memory_dir if it is given
+    The training matrix is balanced, an evaluation matrix is not (balanced=False) so its PR-AUC is that of the actual no show rate
+    '''
+    if external_memory_dir is not None:
+        os.makedirs(external_memory_dir, exist_ok=True)
+        cache_prefix = os.path.join(external_memory_dir, f'{os.getpid()}-{len(rows)}')
+        return xgboost.DMatrix(FeatureCacheIter(cache, rows, balanced=balanced, cache_prefix=cache_prefix), enable_categorical=True)
+
+    return xgboost.QuantileDMatrix(FeatureCacheIter(cache, rows, balanced=balanced), ref=ref, max_bin=max_bin, enable_categorical=True)
+
+
+def init_search_worker(cache_dir: str, valid_months: int, max_bin: int, external_memory_dir: str = None):
+    '''
+    Builds the binned (quantile) matrices of the training and validation set once in a process of the search pool
+    Every trial in the process trains on these, so the data is only read and binned once per process
+    '''
+    global data
+    cache = backtesting.load_feature_cache(cache_dir)
+    train, valid = split_train_valid(cache['dates'], valid_months)
+
+    dtrain = get_dmatrix(cache, train, max_bin, external_memory_dir=external_memory_dir)
+    dvalid = get_dmatrix(cache, valid, max_bin, balanced=False, ref=dtrain, external_memory_dir=external_memory_dir)
+    data = {'train': dtrain, 'valid': dvalid}
+
+
+def train_trial(params: dict, model: bytearray, rounds: int, n_threads: int, max_bin: int, early_stopping_rounds: int = None) -> tuple:
+    '''
+    Continues training a trial up to rounds boosting rounds in total, model is the booster of the previous rung (None to start)
+    Returns the booster, its PR-AUC on the validation set and the number of rounds of the best iteration
+    '''
+    booster = None if model is None else xgboost.Booster(model_file=model)
+    done = 0 if booster is None else booster.num_boosted_rounds()
+    evals_result = {}
+    booster = xgboost.train({**params, 'tree_method': 'hist', 'max_bin': max_bin, 'objective': 'binary:logistic', 'eval_metric': 'aucpr',
+                             'nthread': n_threads}, data['train'], num_boost_round=rounds - done, evals=[(data['valid'], 'valid')],
+                            evals_result=evals_result, xgb_model=booster, early_stopping_rounds=early_stopping_rounds, verbose_eval=False)
+
+    scores = evals_result['valid']['aucpr']
+    best = int(np.argmax(scores))
+    return booster.save_raw('ubj'), float(scores[best]), done + best + 1
+
+
+def search(cache_dir: str, n_trials: int = 27, min_rounds: int = 25, eta: int = 3, valid_months: int = 3, n_workers: int = 4,
+           max_bin: int = 256, seed: int = 0, external_memory_dir: str = None) -> pd.DataFrame:
+    '''
+    Successive halving: all trials train min_rounds rounds, the best 1/eta of them continue to eta times as many rounds, and so on
+    The last trials train up to MAX_ROUNDS rounds with early stopping. Weak parameter sets are stopped after a few rounds,
+    so most of the time goes to the promising ones. The trials of a rung run in parallel in n_workers processes
+    Returns the PR-AUC on the validation set of every trial at every rung, the best trial of the last rung first
+    '''
+    trials = sample_params(np.random.default_rng(seed), n_trials)
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+    results = []
+    models = {trial: None for trial in range(len(trials))}
+    rounds = min_rounds
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_search_worker,
+                             initargs=(cache_dir, valid_months, max_bin, external_memory_dir)) as pool:
+        while True:
+            last = len(models) <= eta or rounds * eta > MAX_ROUNDS
+            rung_rounds = MAX_ROUNDS if last else rounds
+            start = time.perf_counter()
+            futures = {trial: pool.submit(train_trial, trials[trial], model, rung_rounds, n_threads, max_bin,
+                                          early_stopping_rounds=50 if last else None) for trial, model in models.items()}
+            scores = {}
+            for trial, future in futures.items():
+                models[trial], scores[trial], best_rounds = future.result()
+                results.append({'trial': trial, 'rounds': rung_rounds, 'best_rounds': best_rounds, 'pr_auc': scores[trial], **trials[trial]})
+            print(f'{len(models)} trials of {rung_rounds} rounds in {time.perf_counter() - start:.0f}s, best PR-AUC {max(scores.values()):.4f}')
+
+            if last:
+                break
+            keep = sorted(scores, key=scores.get, reverse=True)[:max(1, len(models) // eta)]
+            models = {trial: models[trial] for trial in keep}
+            rounds *= eta
+
+    results = pd.DataFrame(results)
+    final = results[results['rounds'] == results['rounds'].max()].sort_values(by='pr_auc', ascending=False)
+
+    return pd.concat([final, results.drop(final.index)])
+
+
+def get_params(trial: pd.Series) -> dict:
+    '''
+    Returns the parameters of a trial in the results of search, the parameters machine_learning.ipynb did not set are left to xgboost
+    '''
+    return {key: int(trial[key]) if kind == 'int' else trial[key] for key, (kind, *space) in PARAM_SPACE.items() if pd.notna(trial[key])}
+
+
+def train_final_model(cache_dir: str, params: dict, n_estimators: int, max_bin: int = 256, external_memory_dir: str = None):
+    '''
+    Trains the model with the best parameters on the whole training set (training and validation) with all cores
+    The booster is trained on the chunks of the feature cache and loaded into an XGBClassifier, the model machine_learning.ipynb saves,
+    so the back end predicts with it on the encoded feature frame as before
+    '''
+    cache = backtesting.load_feature_cache(cache_dir)
+    dtrain = get_dmatrix(cache, np.arange(len(cache['y'])), max_bin, external_memory_dir=external_memory_dir)
+    booster = xgboost.train({**params, 'tree_method': 'hist', 'max_bin': max_bin, 'objective': 'binary:logistic'}, dtrain,
+                            num_boost_round=n_estimators)
+
+    model = xgboost.XGBClassifier(**params, tree_method='hist', max_bin=max_bin, enable_categorical=True, n_estimators=n_estimators)
+    model.load_model(booster.save_raw('ubj'))
+    return model
+
+
+if __name__ == '__main__':
+    # python train.py <training_set.parquet> <model.joblib> [--trials=27] [--workers=4] [--valid-months=3] [--seed=0] [--cache=<dir>] [--extended]
+    #                 [--external-memory=<dir>]
+    # the model is saved in the format of no_show_model_v2.joblib, with its vocabularies next to it
+    file, model_path = sys.argv[1:3]
+    options = dict(arg[2:].split('=', 1) if '=' in arg else (arg[2:], True) for arg in sys.argv[3:] if arg.startswith('--'))
+    cache_dir = options.get('cache', backtesting.get_cache_dir(file, extended_features='extended' in options))
+
+    if not os.path.exists(os.path.join(cache_dir, 'features.json')):
+        backtesting.build_feature_cache(file, cache_dir, extended_features='extended' in options)
+
+    start = time.perf_counter()
+    results = search(cache_dir, n_trials=int(options.get('trials', 27)), valid_months=int(options.get('valid-months', 3)),
+                     n_workers=int(options.get('workers', 4)), seed=int(options.get('seed', 0)),
+                     external_memory_dir=options.get('external-memory'))
+    results.to_csv(f'{os.path.splitext(model_path)[0]}_search.csv', index=False)
+
+    best = results.iloc[0]
+    params = get_params(best)
+    print(f'Best PR-AUC {best["pr_auc"]:.4f} with {best["best_rounds"]} rounds: {params}')
+
+    model = train_final_model(cache_dir, params, n_estimators=int(best['best_rounds']), external_memory_dir=options.get('external-memory'))
+    joblib.dump(model, model_path)
+    vocabulary.save_vocabularies(backtesting.load_feature_cache(cache_dir)['vocabularies'], vocabulary.get_vocabularies_path(model_path))
+    print(f'Model saved to {model_path} in {time.perf_counter() - start:.0f}s')
@@ -3,7 +3,12 @@ import numpy as np
 import joblib
 import pyodbc
 import time
+import hashlib
+import cProfile
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime as dt
+import os
 import sys
 import schedule
 import warnings
@@ -11,9 +16,20 @@ import yaml
 
 sys.path.insert(0, '/app/preprocessing')
 from preprocessing import *
+import checkpoints
+import registry
 
 warnings.filterwarnings("ignore")
 
+MODEL_PATH = '/app/py/no_show_model_v2.joblib'
+PILOT_AGENDAS = ['CSA006', 'CSA009']   # agenda GYN, KIN
+# days from a run to the workday it predicts (3 workdays ahead) per weekday of the run, there is no run in the weekend
+WORKING_DAYS = [3, 3, 5, 5, 5, None, None]
+# AB-test: the number of highest predictions per specialism which get an arm, and the arms
+AB_TOP_N = {'GYN': 20, 'KIN': 20}
+AB_ARMS = ['Intervention', 'Control']
+PREDICTION_COLUMNS = ['PATIENTNR', 'NAAM', 'GEBDAT', 'GESLACHT', 'STARTDATEPLAN', 'STARTTIMEPLAN', 'SPECIALISM', 'PREDICTIE', 'LOCATIE']
+
 def get_db_connection(driver, server, db, uid, password, port):
     conn = pyodbc.connect(f'Driver={driver};'
                           f'Server={server};'
@@ -29,38 +45,53 @@ def days_from_today():
     Example: So 3 workdays from wednesday is monday, this is 5 days.
     It will return None when it is weekend.
     '''
-    working_days = [3, 3, 5, 5, 5, None, None]
     day_index = time.localtime().tm_wday
 
-    return(working_days[day_index])
+    return(WORKING_DAYS[day_index])
 
-def get_appointments_from_db(conn, n_years):
-    n_days =  days_from_today()
+def get_run_date(date):
+    '''
+    Returns the date of the nightly run which predicts date, the inverse of days_from_today
+    Example: monday is predicted on the wednesday before it
+    '''
+    for n_days in range(1, 8):
+        run_date = date - pd.Timedelta(days=n_days)
+        if WORKING_DAYS[run_date.weekday()] == n_days:
+            return run_date
 
-    # if it is weekend
-    if n_days is None:
-        return None
+    return None
 
-    query = '''    
-    -- get patients who have an appointment over 3 days
-    WITH CTE_patient_numbers AS(
-        SELECT DISTINCT 
-        AFS.PATIENTNR
-        
-        FROM  [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_AFSPRAAK] AS AFS
-        LEFT JOIN  [sql2019hix-h02].[HiX_OVZ].[dbo].CSZISLIB_LOCATION as loc on loc.LOCATIONID = AFS.LOCATIONID
-        LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[RP_PLANOBJECT] AS RPP ON afs.AFSPRAAKNR = RPP.LINKEDOBJECTID   AND RPP.LINKEDOBJECTCLASSID = 'AGENDA_AFSPRAAK'     
-        LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_SUBAGEND] AS SA  ON AFS.[AGENDA] = SA.[AGENDA]   AND AFS.[SUBAGENDA] = SA.[SUBAGENDA]      
-        LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_SUBAGENPROD] SAP ON SAP.SUBAGENDA = SA.SUBAGENDA
-        LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_AFSPCODE] AC ON AC.[CODE] = AFS.[CODE] AND AC.AGENDA = AFS.AGENDA
-        LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[PATIENT_PATIENT] PP ON PP.PATIENTNR = AFS.PATIENTNR
-                    
-        WHERE 1 = 1   
-        AND CAST(RPP.STARTDATEPLAN AS DATE) = CAST(DATEADD(DAY,''' + str(n_days) + ''', GETDATE())  AS DATE)
-        AND AFS.PATIENTNR NOT LIKE '' 
-        AND AC.CONSTYPE IN ('E','H','V','*')
-    )
+def get_as_of_dates(start, end, today):
+    '''
+    Returns the as-of date of every workday from start to end (indexed by the workday): the date of its nightly run,
+    or today for the workdays whose nightly run is still to come. The features of a workday only use the history up to its as-of date
+    '''
+    dates = pd.bdate_range(start, end)
+
+    return pd.Series([min(get_run_date(date), today) for date in dates], index=dates, dtype='datetime64[ns]')
+
+# patients who have an appointment between two numbers of days from now, the parameters are the numbers of days
+TARGET_PATIENTS_QUERY = '''
+    SELECT DISTINCT 
+    AFS.PATIENTNR
+    
+    FROM  [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_AFSPRAAK] AS AFS
+    LEFT JOIN  [sql2019hix-h02].[HiX_OVZ].[dbo].CSZISLIB_LOCATION as loc on loc.LOCATIONID = AFS.LOCATIONID
+    LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[RP_PLANOBJECT] AS RPP ON afs.AFSPRAAKNR = RPP.LINKEDOBJECTID   AND RPP.LINKEDOBJECTCLASSID = 'AGENDA_AFSPRAAK'     
+    LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_SUBAGEND] AS SA  ON AFS.[AGENDA] = SA.[AGENDA]   AND AFS.[SUBAGENDA] = SA.[SUBAGENDA]      
+    LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_SUBAGENPROD] SAP ON SAP.SUBAGENDA = SA.SUBAGENDA
+    LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_AFSPCODE] AC ON AC.[CODE] = AFS.[CODE] AND AC.AGENDA = AFS.AGENDA
+    LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[PATIENT_PATIENT] PP ON PP.PATIENTNR = AFS.PATIENTNR
+                
+    WHERE 1 = 1   
+    AND CAST(RPP.STARTDATEPLAN AS DATE) BETWEEN CAST(DATEADD(DAY, ?, GETDATE())  AS DATE) AND CAST(DATEADD(DAY, ?, GETDATE())  AS DATE)
+    AND AFS.PATIENTNR NOT LIKE '' 
+    AND AC.CONSTYPE IN ('E','H','V','*')
+'''
 
+# appointments up to n days from now, the first parameter is the number of days
+# the filters on the history (period and patients) are appended to this query
+APPOINTMENTS_QUERY = '''
     SELECT DISTINCT 
     AFS.PATIENTNR
     ,PP.GESLACHT
@@ -107,40 +138,138 @@ def get_appointments_from_db(conn, n_years):
     LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[AGENDA_MUTATIEREDEN] MR ON AFS.VERPLREDEN = MR.Code
     LEFT JOIN [sql2019hix-h02].[HiX_OVZ].[dbo].[RP_PROGRAM] RPPR ON RPP.PROGRAM = RPPR.ID   -- voor verloskunde uitsluiting
 
-    RIGHT JOIN CTE_patient_numbers PATS ON PATS.PATIENTNR = AFS.PATIENTNR  -- Right join op CTE, we willen alleen de historie van de patienten die een afspraak hebben gepland komende drie dagen
-
     WHERE 1 = 1  
     AND SA.SUBAGENDA NOT IN ('002306', 'ZH0338', 'ZH1709')   -- geboorte agenda's
-    AND CAST(RPP.STARTDATEPLAN AS DATE) <= CAST(DATEADD(DAY,''' + str(n_days) + ''', GETDATE())  AS DATE)  
-    AND RPP.STARTDATEPLAN >= DATEADD(YEAR, -'''+ str(n_years) +''', GETDATE())
+    AND CAST(RPP.STARTDATEPLAN AS DATE) <= CAST(DATEADD(DAY, ?, GETDATE())  AS DATE)  
     AND AFS.PATIENTNR NOT LIKE '' 
     AND AC.CONSTYPE IN ('E','H','V','*')
+'''
+
+def get_appointments_from_db(conn, n_years, since=None):
+    '''
+    Gets the appointments of the patients who have an appointment over 3 workdays, including n_years of their history
+    If since is given (the first date missing in the history store), only the appointments from that date onwards are
+    fetched, for all patients, since the older history is already in the store
     '''
+    n_days =  days_from_today()
 
-    results = pd.read_sql_query(query, conn)
-    return results
+    # if it is weekend
+    if n_days is None:
+        return None
 
-def convert_features_to_category(df):
-    '''Converts categorical feature to pandas category type'''
-    
-    for col in ['GESLACHT', 'POSTCODE', 'WOONPLAATS', 'AGENDA', 'DESCRIPTION', 'CONSTYPE', 'CODE', 'SPECIALISME', 'LOCATIE', 'DagAfspraak', 'AfspraakZelfdeDag']:
-        df[col] = df[col].astype('category')
-    
-    return df
+    if since is None:
+        # we only want the history of the patients who have an appointment over 3 days
+        query = APPOINTMENTS_QUERY + f'''
+    AND RPP.STARTDATEPLAN >= DATEADD(YEAR, -?, GETDATE())
+    AND AFS.PATIENTNR IN ({TARGET_PATIENTS_QUERY})
+'''
+        params = [n_days, n_years, n_days, n_days]
+    else:
+        # the closed appointments of all patients are needed to keep the history store up to date
+        query = APPOINTMENTS_QUERY + '''
+    AND CAST(RPP.STARTDATEPLAN AS DATE) >= ?
+'''
+        params = [n_days, pd.Timestamp(since).strftime('%Y-%m-%d')]
+
+    results = pd.read_sql_query(query, conn, params=params)
+    return schema.apply_schema(results)
+
+def get_closed_appointments_from_db(conn, start, end):
+    '''
+    Gets the appointments of all patients with start <= STARTDATEPLAN < end, used to build the history store in batches of dates
+    '''
+    query = APPOINTMENTS_QUERY + '''
+    AND CAST(RPP.STARTDATEPLAN AS DATE) >= ?
+    AND CAST(RPP.STARTDATEPLAN AS DATE) < ?
+'''
+    results = pd.read_sql_query(query, conn, params=[0, pd.Timestamp(start).strftime('%Y-%m-%d'), pd.Timestamp(end).strftime('%Y-%m-%d')])
+    return schema.apply_schema(results)
+
+def get_target_patients_from_db(conn, n_days, agendas=None, until_n_days=None):
+    '''
+    Gets the patient numbers of the patients who have an appointment over n_days (first phase of the extraction)
+    If until_n_days is given, the patients who have an appointment from n_days up to and including until_n_days days from now
+    If agendas is given, only the patients with an appointment in one of these agendas
+    '''
+    query, params = TARGET_PATIENTS_QUERY, [n_days, n_days if until_n_days is None else until_n_days]
+    if agendas is not None:
+        query += f'''    AND AFS.AGENDA IN ({','.join(['?' for _ in agendas])})
+'''
+        params += list(agendas)
+    patients = pd.read_sql_query(query, conn, params=params)
+
+    return patients['PATIENTNR'].tolist()
+
+def get_appointment_batch_from_db(conn, patients, n_days, n_years, history_n_days=0):
+    '''
+    Gets the appointments of n_years of history of a batch of patients, up to n_days from now
+    The history starts n_years before history_n_days days from now (before today by default)
+    '''
+    query = APPOINTMENTS_QUERY + f'''
+    AND RPP.STARTDATEPLAN >= DATEADD(YEAR, -?, DATEADD(DAY, ?, GETDATE()))
+    AND AFS.PATIENTNR IN ({','.join(['?' for _ in patients])})
+'''
+    results = pd.read_sql_query(query, conn, params=[n_days, n_years, history_n_days] + list(patients))
+    return schema.apply_schema(results)
+
+def iter_appointment_batches(connect, patients, n_days, n_years, batch_size=500, n_connections=4, history_n_days=0):
+    '''
+    Gets the history of the patients in batches of batch_size patients (second phase of the extraction)
+    The batches are fetched in parallel over a pool of n_connections connections, created with connect().
+    Every batch is yielded as soon as it arrives, so it can be preprocessed while the others are still being fetched
+    '''
+    batches = [patients[i:i + batch_size] for i in range(0, len(patients), batch_size)]
+    if len(batches) == 0:
+        return
+
+    connections = queue.Queue()
+    for _ in range(min(n_connections, len(batches))):
+        connections.put(connect())
+
+    def fetch(batch):
+        conn = connections.get()
+        try:
+            return get_appointment_batch_from_db(conn, batch, n_days, n_years, history_n_days=history_n_days)
+        finally:
+            connections.put(conn)
+
+    try:
+        with ThreadPoolExecutor(max_workers=connections.qsize()) as pool:
+            futures = [pool.submit(fetch, batch) for batch in batches]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        while not connections.empty():
+            connections.get().close()
 
 def attach_predictions(df_original, df_preds):
     df_display = df_original.merge(df_preds, on=['PATIENTNR', 'SPECIALISME'], how='right')  # right join, we only want to display patients with predictions
 
     return df_display
 
-def preprocess(df):
+def preprocess(df, store=None, extended_features=False, memory_report=None, metrics=None, exclude_days_per_date=None):
 
-    df['SPECIALISME'] = df['SPECCODE'].combine_first(df['TARAFD'])
-    df['STARTDATEPLAN'] = pd.to_datetime(df['STARTDATEPLAN'])
-    df = preprocess_noshow_data(df, hist_years=10, n_appointments=0, training=False)
+    df = schema.apply_schema(df)
+    df['SPECIALISME'] = misc.get_specialism(df)
+    df = preprocess_noshow_data(df, hist_years=10, n_appointments=0, training=False, store=store, extended_features=extended_features,
+                                memory_report=memory_report, metrics=metrics, exclude_days_per_date=exclude_days_per_date)
 
     return df
 
+def preprocess_batches(batches, store=None, extended_features=False, memory_report=None, metrics=None, exclude_days_per_date=None):
+    '''
+    Preprocesses every batch of appointments as it arrives and combines the results
+    This is possible because the features of a patient only depend on the appointments of that patient
+    Returns None if there are no appointments at all
+    '''
+    df_batches = [preprocess(df, store, extended_features=extended_features, memory_report=memory_report, metrics=metrics,
+                             exclude_days_per_date=exclude_days_per_date)
+                  for df in instrumentation.timed_iter(metrics, 'extract appointments', batches) if df is not None and len(df) > 0]
+    if len(df_batches) == 0:
+        return None
+
+    return schema.concat(df_batches)
+
 def apply_model(data_entry):
     pred = model.predict_proba(misc.get_feature_df(data_entry, training=False))[:,1]
     return pred
@@ -154,52 +283,300 @@ def process_gyn(df):
     return df
 
 
-def predict(df):
+def select_appointments(df, vocabularies=None, agendas=PILOT_AGENDAS, pred_date=None):
+    '''
+    Selects the appointments of pred_date (default the last date in df) of the given agendas, all agendas if agendas is None
+    pred_date can also be a list of dates, then the appointments of all these dates are selected
+    Returns these appointments and the vocabularies to encode them with
+    '''
 
     # get only appointments of the prediction date
-    pred_date = df['STARTDATEPLAN'].max()  # get the date of which we want the predictions
-    df_predict = df[df['STARTDATEPLAN'] == pred_date]
+    if pred_date is None:
+        pred_date = df['STARTDATEPLAN'].max()  # get the date of which we want the predictions
+    df_predict = df[df['STARTDATEPLAN'].isin(pred_date if isinstance(pred_date, list) else [pred_date])]
 
-    # predict
     df_predict = process_gyn(df_predict)
-    df_predict = convert_features_to_category(df_predict)
-    df_predict = df_predict[df_predict['AGENDA'].isin(['CSA006', 'CSA009'])]   # agenda GYN, KIN (only for pilot, delete after)
+    # a model saved without vocabularies was fitted on astype('category'), the values of the day itself reproduce that encoding
+    if vocabularies is None:
+        vocabularies = vocabulary.build_vocabularies(df_predict)
+    if agendas is not None:
+        df_predict = df_predict[df_predict['AGENDA'].isin(agendas)]   # only the pilot agendas, unless scoring hospital wide
     df_predict.loc[df_predict['num_no_shows'].isna(), 'num_no_shows'] = 0
     df_predict.loc[df_predict['perc_no_shows'].isna(), 'perc_no_shows'] = 0
     df_predict.loc[df_predict['last_noshow'].isna(), 'last_noshow'] = 0
     df_predict.loc[df_predict['num_appointments'].isna(), 'num_appointments'] = 0
 
-    df_predict['PREDICTIE'] =  model.predict_proba(misc.get_feature_df(df_predict, training=False))[:,1]
+    return df_predict, vocabularies
+
+def get_model_input(df, vocabularies=None, extended_features=False, agendas=PILOT_AGENDAS, pred_date=None):
+    '''
+    Selects the appointments to predict (see select_appointments)
+    Returns these appointments and the model input of these appointments, encoded with the vocabularies
+    '''
+    df_predict, vocabularies = select_appointments(df, vocabularies, agendas=agendas, pred_date=pred_date)
+
+    # only the model input is encoded, the values themselves are kept for the dashboard
+    features = vocabulary.encode(misc.get_feature_df(df_predict, training=False, extended_features=extended_features).copy(), vocabularies)
+
+    return df_predict, features
+
+def predict(df, vocabularies=None, extended_features=False, agendas=PILOT_AGENDAS, pred_date=None):
+    '''
+    Predicts the appointments of pred_date (default the last date in df) of the given agendas, all agendas if agendas is None
+    '''
+    df_predict, features = get_model_input(df, vocabularies, extended_features=extended_features, agendas=agendas, pred_date=pred_date)
+
+    # predict
+    df_predict['PREDICTIE'] =  model.predict_proba(features)[:,1]
     df_predict = df_predict.sort_values(by='PREDICTIE', ascending=False)
     
-    return   df_predict[['PATIENTNR', 'NAAM', 'GEBDAT', 'GESLACHT', 'STARTDATEPLAN', 'STARTTIMEPLAN', 'SPECIALISM', 'PREDICTIE', 'LOCATIE']]
+    return   df_predict[PREDICTION_COLUMNS]
 
-def add_phone_numbers(df, phone_numbers):
+def init_scoring_worker(worker_model, worker_vocabularies):
     '''
-    Adds phone numbers to the dataframe. 
-    One person can have multiple phone numbers.
-    It will add all the phone numbers seperated by a semicollumn in one column.
-    The front-end can extract the phone numbers by splitting on the semicollumn. 
+    Sets up a process of the hospital wide scoring pool, the history store is sent with every shard (only the rows of its patients)
     '''
-    # doing this is a bit tedeous, so the approach might be a bit messy :)
-    # it creates a list of all of the phone numbers and then joins them seperated by a semicollumn
-    phone_numbers = phone_numbers.groupby('PATIENTNR')['TELEFOON'].apply(list).reset_index()  
-    phone_numbers['TELEFOON'] = phone_numbers['TELEFOON'].apply(lambda x: '; '.join(x))
+    global model, vocabularies
+    model, vocabularies = worker_model, worker_vocabularies
 
-    # add to df
-    df = pd.merge(df, phone_numbers[['PATIENTNR', 'TELEFOON']], on='PATIENTNR')
+def read_memory_mb(field):
+    '''
+    Returns a memory field of /proc/self/status (VmRSS, VmHWM) in MB
+    '''
+    with open('/proc/self/status') as f:
+        return int(f.read().split(f'{field}:')[1].split()[0]) / 1024
 
-    return df
+def reset_peak_rss():
+    '''
+    Resets the peak resident memory (VmHWM) of the process and returns it as the baseline of a shard.
+    A forked worker already counts the pages it shares with the parent (model, store, extract) and a reused worker the memory
+    its earlier shards left behind, the baseline takes these out of the check of the shard.
+    If the peak can not be reset the baseline is the peak so far, so the check never counts an earlier shard
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
-def get_phone_numbers(conn, df):
+    return read_memory_mb('VmHWM')
+
+def check_worker_memory(memory_limit_mb, baseline_mb):
     '''
-    Gets the phone numbers of each patient.
-    It deletes the patients where no phone number is registered.
+    Raises a MemoryError if the peak resident memory of the process grew more than memory_limit_mb since the baseline (0 for no limit)
+    The resident memory is checked instead of limiting the address space, the threads and allocators of xgboost and numpy
+    reserve much more address space than they use
+    '''
+    if not memory_limit_mb:
+        return
+
+    used_mb = read_memory_mb('VmHWM') - baseline_mb
+    if used_mb > memory_limit_mb:
+        raise MemoryError(f'The shard used {used_mb:.0f} MB, more than worker_memory_mb ({memory_limit_mb})')
+
+def get_shard_key(patients):
+    '''
+    Returns a key of a shard which only depends on its patients, a retry gets the same shards and finds their snapshots with this key
+    '''
+    return hashlib.sha1('\n'.join(map(str, patients)).encode()).hexdigest()[:16]
+
+def score_shard(config, patients, df, shard_store, n_days, pred_date, extended_features, shard_dir=None):
+    '''
+    Preprocesses and predicts the appointments of a shard of patients in a worker process
+    Without a history store df is None and the history of the patients is extracted here, over a connection of the worker itself.
+    The extracted batches are saved in shard_dir (if given), so a retry of the run loads them instead of extracting them again.
+    With a store df holds the appointments of the patients since the store was last updated and shard_store their stored history.
+    The memory the shard adds to the worker is checked after every batch, after the preprocessing and after the prediction,
+    a shard which added more than worker_memory_mb raises a MemoryError. The check runs between these steps, it is not a hard ceiling
+    Returns the predictions (None if the shard has no appointments to predict) and, with a history store, the preprocessed appointments
+    '''
+    memory_limit_mb = config.get('worker_memory_mb', 0)
+    baseline_mb = reset_peak_rss()
+
+    if df is None:
+        batch_size = config.get('batch_size', 500)
+        connections = []
+        dates = []
+
+        # the workers already run in parallel, so every worker fetches its batches one after the other
+        def fetch_batches():
+            connections.append(get_db_connection(config['driver'], config['server'], config['database'], config['user'],
+                                                 config['password'], config['port']))
+            for i in range(0, len(patients), batch_size):
+                yield get_appointment_batch_from_db(connections[0], patients[i:i + batch_size], n_days, 10)
+
+        def check_batches(batches):
+            for batch in batches:
+                check_worker_memory(memory_limit_mb, baseline_mb)
+                if len(batch) > 0:
+                    dates.append(batch['STARTDATEPLAN'].max())
+                yield batch
+
+        stage = f'extract-{get_shard_key(patients)}'
+        if shard_dir is not None and checkpoints.has_checkpoint(shard_dir, stage):
+            batches = checkpoints.load_batches(shard_dir, stage)
+        elif shard_dir is not None:
+            batches = checkpoints.save_batches(shard_dir, stage, fetch_batches())
+        else:
+            batches = fetch_batches()
+
+        try:
+            df_preprocessed = preprocess_batches(check_batches(batches), extended_features=extended_features)
+        finally:
+            for conn in connections:
+                conn.close()
+        if len(dates) == 0:
+            return None, None
+        # every patient of the shard has an appointment on the prediction date, the cleaning can remove them all
+        # so the date is taken before the preprocessing, which makes it the same in every shard
+        pred_date = max(dates)
+    else:
+        df_preprocessed = preprocess_batches([df], shard_store, extended_features=extended_features)
+
+    if df_preprocessed is None:
+        return None, None
+    check_worker_memory(memory_limit_mb, baseline_mb)
+
+    # the preprocessed appointments are only sent back when they are needed to update the history store
+    df_preprocessed_out = df_preprocessed if shard_store is not None else None
+    if not (df_preprocessed['STARTDATEPLAN'] == pred_date).any():
+        return None, df_preprocessed_out
+
+    df_predicted = predict(df_preprocessed, vocabularies, extended_features=extended_features, agendas=None, pred_date=pred_date)
+    check_worker_memory(memory_limit_mb, baseline_mb)
+    return df_predicted, df_preprocessed_out
+
+def split_shard(patients, df):
+    '''
+    Splits a shard in two halves of patients, used when a shard does not fit in the memory of a worker
+    '''
+    halves = [patients[:len(patients) // 2], patients[len(patients) // 2:]]
+    if df is None:
+        return [(half, None) for half in halves]
+
+    return [(half, df[df['PATIENTNR'].isin(half)]) for half in halves]
+
+def score_hospital_wide(con, config, store, n_days, extended_features, run_dir=None):
+    '''
+    Scores the appointments of all agendas instead of only the pilot agendas
+    The patients are split in shards by a hash of their patient number (the features of a patient only depend on their own history),
+    the shards are processed by a pool of processes with a memory limit per shard and the results are merged at the end.
+    A shard which hits the memory limit is split in two and processed again, a single patient which still hits it is skipped.
+    With a run_dir the extraction is saved in it (the patients or the appointments since the store was last updated in the process itself,
+    the history of every shard in its worker), so a retry of the run does not extract anything again
+    Returns the predictions sorted on prediction and, with a history store, the preprocessed appointments
+    (None, None) if there is nothing to score
+    '''
+    n_shards = config.get('n_shards', 16)
+    shard_dir = os.path.join(run_dir, 'shards') if run_dir is not None else None
+    if shard_dir is not None:
+        os.makedirs(shard_dir, exist_ok=True)
+
+    if store is None:
+        if run_dir is not None and checkpoints.has_checkpoint(run_dir, 'extract_patients'):
+            patients = checkpoints.load_checkpoint(run_dir, 'extract_patients')['PATIENTNR']
+        else:
+            patients = pd.Series(get_target_patients_from_db(con, n_days), dtype=object, name='PATIENTNR')
+            if run_dir is not None:
+                checkpoints.save_checkpoint(run_dir, 'extract_patients', patients.to_frame())
+        partitions = hash_partitions(patients, n_shards)
+        shards = [(patients[partitions == i].tolist(), None) for i in range(n_shards)]
+        pred_date = None   # taken from the extracted appointments in every shard (see score_shard)
+    else:
+        if run_dir is not None and checkpoints.has_checkpoint(run_dir, 'extract'):
+            batches = list(checkpoints.load_batches(run_dir, 'extract'))
+        else:
+            batches = [get_appointments_from_db(con, 10, since=history_store.get_closed_until(store))]
+            if run_dir is not None:
+                batches = list(checkpoints.save_batches(run_dir, 'extract', batches))
+        batches = [batch for batch in batches if len(batch) > 0]
+        if len(batches) == 0:
+            return None, None
+        df = schema.concat(batches)
+        partitions = hash_partitions(df['PATIENTNR'], n_shards)
+        shards = [(df['PATIENTNR'][partitions == i].unique().tolist(), df[partitions == i]) for i in range(n_shards)]
+        pred_date = df['STARTDATEPLAN'].max()
+    shards = [shard for shard in shards if len(shard[0]) > 0]
+
+    predicted, preprocessed, skipped = [], [], []
+    with ProcessPoolExecutor(max_workers=config.get('n_workers', 4), initializer=init_scoring_worker,
+                             initargs=(model, vocabularies)) as pool:
+        # every worker only gets the stored history of the patients of its shard, not the whole store
+        submit = lambda shard: pool.submit(score_shard, config, shard[0], shard[1],
+                                           history_store.select_patients(store, shard[0]) if store is not None else None,
+                                           n_days, pred_date, extended_features, shard_dir=shard_dir)
+        pending = {submit(shard): shard for shard in shards}
+        while pending:
+            for future in as_completed(list(pending)):
+                shard = pending.pop(future)
+                try:
+                    df_predicted, df_preprocessed = future.result()
+                except MemoryError:
+                    if len(shard[0]) < 2:
+                        # the appointments of this patient are left out of the predictions (and of the history store)
+                        print(f'The appointments of patient {shard[0][0]} do not fit in the memory of a worker, skipping them')
+                        skipped.extend(shard[0])
+                        continue
+                    print(f'Shard of {len(shard[0])} patients did not fit in the memory of a worker, splitting it')
+                    for half in split_shard(*shard):
+                        pending[submit(half)] = half
+                    continue
+
+                if df_predicted is not None:
+                    predicted.append(df_predicted)
+                if df_preprocessed is not None:
+                    preprocessed.append(df_preprocessed)
+
+    if len(skipped) > 0:
+        print(f'Skipped {len(skipped)} patients which did not fit in the memory of a worker: {", ".join(map(str, skipped))}')
+    if len(predicted) == 0:
+        return None, None
+
+    df_predicted = schema.concat(predicted).sort_values(by='PREDICTIE', ascending=False)
+    df_preprocessed = schema.concat(preprocessed) if len(preprocessed) > 0 else None
+    return df_predicted, df_preprocessed
+
+def score_date_range(config, start, end, agendas=PILOT_AGENDAS):
     '''
-    patnumbers = ','.join([f"'{str(num)}'" for num in df['PATIENTNR'].tolist()])  # format so that it can be inserted into the query
+    Predicts all workdays from start to end in one run, for backfills (dates in the past) and for planning several workdays ahead
+    The history of the patients is extracted once and every workday gets the features as of its as-of date (see get_as_of_dates):
+    the appointments after the as-of date are left out of the history and the appointments scheduled after it are not predicted.
+    Cancellations and other changes after the as-of date are not known, the extract only has the current state of the appointments
+    Returns the predictions sorted on date and prediction with the as-of date of every prediction, None if there is nothing to predict
+    '''
+    if vocabularies is None:
+        raise ValueError('Predicting a date range needs the vocabularies of the model, the dates would get different encodings otherwise')
 
-    # query for patients
-    query = f"""SELECT DISTINCT
+    today = pd.Timestamp.today().normalize()
+    as_of = get_as_of_dates(start, end, today)
+    if len(as_of) == 0:
+        return None
+    exclude_days_per_date = pd.Series((as_of.index - pd.DatetimeIndex(as_of)).days, index=as_of.index)
+    first_n_days, last_n_days = (as_of.index[0] - today).days, (as_of.index[-1] - today).days
+
+    connect = lambda: get_db_connection(config['driver'], config['server'], config['database'], config['user'], config['password'], config['port'])
+    con = connect()
+    try:
+        patients = get_target_patients_from_db(con, first_n_days, agendas=agendas, until_n_days=last_n_days)
+        batches = iter_appointment_batches(connect, patients, last_n_days, 10, batch_size=config.get('batch_size', 500),
+                                           n_connections=config.get('n_connections', 4), history_n_days=min(first_n_days, 0))
+        df_preprocessed = preprocess_batches(batches, extended_features=config.get('extended_features', False),
+                                             exclude_days_per_date=exclude_days_per_date)
+    finally:
+        con.close()
+    if df_preprocessed is None:
+        return None
+
+    # appointments which were scheduled after the as-of date did not exist yet when the date would have been predicted
+    scheduled = df_preprocessed['INVOERDAT'].dt.normalize() <= df_preprocessed['STARTDATEPLAN'].map(as_of)
+    df_predicted = predict(df_preprocessed[scheduled], vocabularies, extended_features=config.get('extended_features', False), agendas=agendas,
+                           pred_date=as_of.index.tolist())
+    df_predicted['AS_OF'] = df_predicted['STARTDATEPLAN'].map(as_of)
+
+    return df_predicted.sort_values(by=['STARTDATEPLAN', 'PREDICTIE'], ascending=[True, False])
+
+# phone numbers of the patients, the patient numbers are appended to this query in batches of parameters
+PHONE_NUMBERS_QUERY = """SELECT DISTINCT
     RC.ADRSID AS PATIENTNR
   
     ,CASE
@@ -213,134 +590,386 @@ def get_phone_numbers(conn, df):
     WHERE
     ADRTYPE IN ('0000000002','CS00000004')
     AND (UITVOERDL NOT LIKE '')
-    AND RC.ADRSID IN ({patnumbers})"""
+"""
 
-    phone_numbers = pd.read_sql_query(query, conn)
-    phone_numbers['TELEFOON'] = phone_numbers.apply(lambda row: f"{row['TELEFOON']} ({row['OPMERKING']})".replace('()', '').replace('((', '(').replace('))', ')'), axis=1) 
-    # select only patients from who a phone number is known
-    df = df[df['PATIENTNR'].isin(phone_numbers['PATIENTNR'].tolist())]
+# phone numbers per patient (None if no number is registered) with the time they were fetched, shared by the runs of this process
+# expired entries are removed and the size is bounded in get_phone_numbers
+PHONE_CACHE = {}
 
-    # attach phone numbers to df
-    df = add_phone_numbers(df, phone_numbers)
-    
-    return df
+def fetch_phone_numbers(conn, patients, batch_size=1000):
+    '''
+    Gets the phone numbers of the patients from the database, in batches of batch_size patients sent as parameters
+    Returns the phone numbers of every patient separated by a semicolon, patients without a phone number are left out
+    '''
+    batches = [patients[i:i + batch_size] for i in range(0, len(patients), batch_size)]
+    phone_numbers = pd.concat([pd.read_sql_query(PHONE_NUMBERS_QUERY + f"    AND RC.ADRSID IN ({','.join(['?' for _ in batch])})", conn,
+                                                 params=list(batch)) for batch in batches], ignore_index=True)
+
+    # number (remark), without the parentheses when there is no remark
+    phone_numbers['TELEFOON'] = (phone_numbers['TELEFOON'].astype(str) + ' (' + phone_numbers['OPMERKING'].astype(str) + ')') \
+        .str.replace('()', '', regex=False).str.replace('((', '(', regex=False).str.replace('))', ')', regex=False)
+
+    # one person can have multiple phone numbers, the front-end can extract them by splitting on the semicolon
+    return phone_numbers.groupby('PATIENTNR', sort=False)['TELEFOON'].agg('; '.join)
 
-def assign_groups(df, spec):
+def add_phone_numbers(df, phone_numbers):
     '''
-    Assigns group for AB-testing
-    One group gets 'Intervention' the other 'Control'.
-    This is done by alternating the top 20 from 'Intervention' to 'Control'
+    Adds the phone numbers (a series of the phone numbers per patient) to the dataframe
+    Patients without a phone number are left out
     '''
+    phone_numbers = phone_numbers.rename('TELEFOON').rename_axis('PATIENTNR').reset_index()
 
-    # okay so we do not want the number 1 prediction to always be in a certain group
-    # that is why I am alternating the number 1 each day by using the weekday number
-    groups = ['Intervention', 'Control']
-    if dt.now().weekday() % 2==0:
-        groups = groups[::-1]  # reverses the list
-    
-    # if we have 20 or more we can add the group alternatively to the dataframe
-    if len(df[df['SPECIALISM'] == spec]) >= 20:
-        df_top = df[df['SPECIALISM'] == spec].iloc[0:20]
-        df.loc[df_top.index, 'GROUP_AB'] = groups * 10
-        df.loc[df['GROUP_AB'].isna(), 'GROUP_AB'] = None
-    
-    # else just assign all the rows we do have 
+    return pd.merge(df, phone_numbers, on='PATIENTNR')
+
+def get_phone_numbers(conn, df, ttl_hours=12, batch_size=1000, max_cached=100000):
+    '''
+    Gets the phone numbers of each patient.
+    It deletes the patients where no phone number is registered.
+    Only the patients who are not in PHONE_CACHE, or were fetched more than ttl_hours ago, are looked up in the database.
+    Entries older than ttl_hours are removed from the cache and it keeps at most max_cached patients, the oldest are removed first
+    '''
+    patients = pd.unique(df['PATIENTNR']).tolist()
+    now = time.time()
+    for patient in [patient for patient, (fetched_at, _) in PHONE_CACHE.items() if now - fetched_at > ttl_hours * 3600]:
+        del PHONE_CACHE[patient]
+
+    missing = [patient for patient in patients if patient not in PHONE_CACHE]
+    if len(missing) > 0:
+        fetched = fetch_phone_numbers(conn, missing, batch_size=batch_size)
+        PHONE_CACHE.update({patient: (now, fetched.get(patient)) for patient in missing})
+
+    phone_numbers = pd.Series([PHONE_CACHE[patient][1] for patient in patients], index=patients, dtype=object).dropna()
+
+    # the patients are added in the order they are fetched, so the first entries are the oldest
+    for patient in list(PHONE_CACHE)[:max(len(PHONE_CACHE) - max_cached, 0)]:
+        del PHONE_CACHE[patient]
+
+    return add_phone_numbers(df, phone_numbers)
+
+def assign_groups(df, top_n=AB_TOP_N, arms=AB_ARMS, date=None, seed=None):
+    '''
+    Assigns the groups for AB-testing of all specialisms in one pass
+    Within every specialism in top_n the appointments are ranked on prediction, the top_n[specialism] highest get an arm
+    by alternating through arms ('Intervention' and 'Control'), all other appointments get None.
+    We do not want the number 1 prediction to always be in a certain arm, so the arm of the number 1 rotates with the weekday of date
+    (default today). With a seed the rotation is drawn from the seed and the date instead, the same seed and date give the same groups
+    '''
+    date = pd.Timestamp.today() if date is None else pd.Timestamp(date)
+    if seed is None:
+        shift = (date.weekday() + 1) % len(arms)   # with two arms the number 1 is 'Control' on even weekdays
     else:
-        for i in range(len(df[df['SPECIALISM'] == spec])):
-            group = groups[0] if i%2==0 else groups[1]
-            index =  df.loc[df['SPECIALISM'] == spec].index[i]
-            df.loc[index, 'GROUP_AB'] = group
-    
-    return df
+        shift = np.random.default_rng([seed, date.toordinal()]).integers(len(arms))
 
+    # rank within the specialism, ties keep the order of df
+    codes, specialisms = pd.factorize(df['SPECIALISM'].astype(object))
+    order = np.argsort(-df['PREDICTIE'].to_numpy(dtype=np.float64), kind='stable')
+    rank = np.empty(len(df), dtype=np.int64)
+    rank[order] = pd.Series(codes[order]).groupby(codes[order]).cumcount().to_numpy()
 
-def write_results_to_db(conn, data):
+    limits = np.array([top_n.get(spec, 0) for spec in specialisms] + [0])[codes]   # code -1 (no specialism) gets the last limit
+    groups = np.array(arms, dtype=object)[(rank + shift) % len(arms)]
+    df['GROUP_AB'] = np.where(rank < limits, groups, None)
 
-    cursor = conn.cursor()
+    return df
 
-    # write data of previous day (together with action/status of calls) into the _all table
-    cols = ",".join([str(i) for i in data.columns.tolist() + ['GEBELD', 'STATUS']])
-    sql = f"INSERT INTO NoShowPreds_all ({cols}) SELECT {cols} FROM NoShowPreds_curr"
-    cursor.execute(sql)
-    conn.commit()
-    cursor.execute("DELETE FROM NoShowPreds_curr")
 
-    # early exit if there is no data, nothing to write
-    if data is None:
-        return
+# columns written by the back-end, GEBELD and STATUS are filled in by the dashboard
+RESULT_COLUMNS = ['PATIENTNR', 'NAAM', 'TELEFOON', 'STARTDATEPLAN', 'STARTTIMEPLAN', 'SPECIALISM', 'PREDICTIE', 'GEBDAT', 'GESLACHT', 'GROUP_AB', 'LOCATIE']
 
-    # insert df records one by one. 
-    cols = ",".join([str(i) for i in data.columns.tolist()])
-    for i, row in data.iterrows():
-        sql = f"INSERT INTO NoShowPreds_curr ({cols}) VALUES ({','.join(['?' for _ in range(len(row))])})"
-        cursor.execute(sql, tuple(row))
-    
-    # commit and close cursor
-    conn.commit()
-    cursor.close()
+def archive_current_predictions(cursor):
+    '''
+    Moves the predictions of the previous day (together with action/status of calls) into the _all table
+    This does not commit, so it can be part of the same transaction as writing the new predictions
+    '''
+    cols = ",".join(RESULT_COLUMNS + ['GEBELD', 'STATUS'])
+    cursor.execute(f"INSERT INTO NoShowPreds_all ({cols}) SELECT {cols} FROM NoShowPreds_curr")
+    cursor.execute("DELETE FROM NoShowPreds_curr")
 
-def empty_db_table(conn):
+def write_results_to_db(conn, data, batch_size=1000):
+    '''
+    Archives the predictions of the previous day and writes the new predictions in one transaction
+    If anything fails the transaction is rolled back, so the dashboard keeps showing the previous predictions
+    The rows are sent in batches of parameter arrays (fast_executemany) instead of one insert per row
+    '''
     cursor = conn.cursor()
+    cursor.fast_executemany = True
 
-    # write data of previous day (together with action/status of calls) into the _all table
-    # this only needs to be done on Friday, Try/except for Saturday if it maybe fails due to an empty database
     try:
-        cols = ",".join([str(i) for i in data.columns.tolist() + ['GEBELD', 'STATUS']])
-        sql = f"INSERT INTO NoShowPreds_all ({cols}) SELECT {cols} FROM NoShowPreds_curr"
-        cursor.execute(sql)
+        archive_current_predictions(cursor)
+
+        n_rows = 0
+        start = time.time()
+        # nothing to write if there is no data
+        if data is not None and len(data) > 0:
+            cols = data.columns.tolist()
+            sql = f"INSERT INTO NoShowPreds_curr ({','.join(cols)}) VALUES ({','.join(['?' for _ in cols])})"
+
+            # missing values have to be None for the odbc driver
+            rows = list(data.astype(object).where(data.notna(), None).itertuples(index=False, name=None))
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany(sql, rows[i:i + batch_size])
+            n_rows = len(rows)
+
         conn.commit()
+        duration = time.time() - start
+        print(f'Wrote {n_rows} rows in {duration:.2f}s ({n_rows / max(duration, 1e-6):.0f} rows/s)')
     except Exception:
-        pass
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
 
-    cursor.execute("DELETE FROM NoShowPreds_curr")
-    conn.commit()
+def empty_db_table(conn):
+    '''
+    Archives the predictions of the previous day and empties the _curr table (weekend or no appointments)
+    '''
+    write_results_to_db(conn, None)
 
-    cursor.close()
 
 
+def write_metrics(config, record):
+    '''
+    Prints the stages of a run and appends the record of the run to the json lines file metrics_path of the config (if set)
+    '''
+    instrumentation.print_metrics(record['stages'])
+    print(f'Run {record.get("status")} in {record["wall_s"]:.2f}s ({record["cpu_s"]:.2f}s cpu, {record["peak_rss_mb"]:.1f} MB peak rss)')
+    if config.get('metrics_path'):
+        instrumentation.write_run_record(config['metrics_path'], record)
+
+def run_stage(run_dir, metrics, stage, func, *args, **kwargs):
+    '''
+    Runs a stage of the nightly run and saves its output in run_dir (see checkpoints.py)
+    If the stage finished in an earlier try of the run its output is loaded instead
+    '''
+    if checkpoints.has_checkpoint(run_dir, stage):
+        print(f'{stage} finished in an earlier try, resuming from its snapshot')
+        return checkpoints.load_checkpoint(run_dir, stage)
+
+    output = instrumentation.timed(metrics, stage, func, *args, **kwargs)
+    checkpoints.save_checkpoint(run_dir, stage, output)
+
+    return output
+
+def run_stages(config, run_dir, metrics):
+    '''
+    Runs the stages of the nightly run: extract, preprocess, predict, phone numbers, groups, write and (with a history store) store
+    Every stage saves its output in run_dir and a stage which finished in an earlier try is not run again,
+    so a retry resumes after the last finished stage and never extracts the history from the database twice
+    Returns the number of predictions written
+    '''
+    timed = lambda stage, func, *args, **kwargs: instrumentation.timed(metrics, stage, func, *args, **kwargs)
+    stage = lambda name, func, *args, **kwargs: run_stage(run_dir, metrics, name, func, *args, **kwargs)
+    connect = lambda: get_db_connection(config['driver'], config['server'], config['database'], config['user'], config['password'], config['port'])
+    con = timed('connect', connect)
+
+    # with a history store only the appointments since the last run have to be extracted
+    store_path = config.get('history_store')
+    store = timed('open_history_store', open_history_store, store_path, config.get('history_refresh_days', 5)) if store_path else None
+    extended_features = config.get('extended_features', False)
+    memory_report = [] if config.get('memory_report', False) else None
+
+    def extract_and_preprocess():
+        # the extracted batches are saved as they arrive, so a failure in the preprocessing does not extract them again
+        if checkpoints.has_checkpoint(run_dir, 'extract'):
+            batches = checkpoints.load_batches(run_dir, 'extract')
+        elif store is None:
+            # first get the patients who have an appointment over n days, then get their history in batches
+            patients = timed('extract patients', get_target_patients_from_db, con, n_days)
+            batches = checkpoints.save_batches(run_dir, 'extract', iter_appointment_batches(connect, patients, n_days, 10,
+                                               batch_size=config.get('batch_size', 500), n_connections=config.get('n_connections', 4)))
+        else:
+            batches = checkpoints.save_batches(run_dir, 'extract', [get_appointments_from_db(con, 10, since=history_store.get_closed_until(store))])
+
+        return preprocess_batches(batches, store, extended_features=extended_features, memory_report=memory_report, metrics=metrics)
+
+    def score_all_agendas():
+        # the stages within the shards run in the worker processes and are not recorded separately
+        df_predicted, df_preprocessed = score_hospital_wide(con, config, store, n_days, extended_features, run_dir=run_dir)
+        checkpoints.save_checkpoint(run_dir, 'preprocess', df_preprocessed)
+        return df_predicted
 
-def main(config, tries=0):
     try:
-        print(f'Start prediction at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}')
-        con = get_db_connection(config['driver'], config['server'], config['database'], config['user'], config['password'], config['port'])
-        
-        df_appointments = get_appointments_from_db(con, 10)
-        # if it is weekend or there are no appointments that are scheduled
-        if df_appointments is None:
-            empty_db_table(con)
+        n_days = days_from_today()
+        # if it is weekend there is nothing to predict
+        if n_days is None:
+            df_predicted, df_preprocessed = None, None
+        elif config.get('hospital_wide', False):
+            df_predicted = stage('predict', score_all_agendas)
+            df_preprocessed = checkpoints.load_checkpoint(run_dir, 'preprocess')
         else:
-            df_preprocessed = preprocess(df_appointments)
-            df_predicted = predict(df_preprocessed)
-            df_tel = get_phone_numbers(con, df_predicted)
-            
-            df_final = assign_groups(df_tel, spec='GYN')
-            df_final = assign_groups(df_final, spec='KIN')
-            write_results_to_db(con, df_final)
-        
+            df_preprocessed = stage('preprocess', extract_and_preprocess)
+            df_predicted = stage('predict', predict, df_preprocessed, vocabularies, extended_features=extended_features) if df_preprocessed is not None else None
+
+        if memory_report:
+            schema.print_memory_report(memory_report)
 
+        # if it is weekend or there are no appointments that are scheduled
+        if df_predicted is None:
+            df_final = None
+            stage('write', empty_db_table, con)
+        else:
+            # the phone numbers are left out of the snapshots, they only keep the patients with a phone number.
+            # the numbers are joined in again (from PHONE_CACHE) just before the write
+            phone_options = {'ttl_hours': config.get('phone_cache_hours', 12), 'batch_size': config.get('phone_batch_size', 1000),
+                             'max_cached': config.get('phone_cache_size', 100000)}
+            df_tel = stage('phone_numbers', lambda: get_phone_numbers(con, df_predicted, **phone_options).drop(columns='TELEFOON'))
+            df_final = stage('groups', assign_groups, df_tel, top_n=config.get('ab_top_n', AB_TOP_N), arms=config.get('ab_arms', AB_ARMS),
+                             seed=config.get('ab_seed'))
+            stage('write', lambda: write_results_to_db(con, get_phone_numbers(con, df_final, **phone_options)))
+
+        # add the appointments up to today to the store, these have a definitive outcome now
+        if store is not None and df_preprocessed is not None:
+            stage('store', update_history_store, store, df_preprocessed, store_path)
+    finally:
         con.close()
-        print(f'Finished prediction at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}')
-    
-    # if it somehow fails try again (maybe due to inability to connect to db)
-    # tries for a maximum of 10 times
-    except Exception as e:
-        print("Failed to predict, trying again...")
-        print(f"Error: {e}")
-        if tries < 10:
-            main(tries+1)
 
+    return len(df_final) if df_final is not None else 0
+
+def open_history_store(store_path, refresh_days=5):
+    '''
+    Loads the history store for a nightly run. The appointments of the last refresh_days workdays are removed from it,
+    so they are extracted again and appended with their current outcome (see history_store.reopen_history_store)
+    The nightly run never builds a store itself, a missing store is built once with history_store.py
+    '''
+    store = history_store.load_history_store(store_path)
+    if store is None:
+        raise FileNotFoundError(f'No history store at {store_path}, build it with history_store.py or leave history_store empty in the config')
+
+    return history_store.reopen_history_store(store, history_store.get_closed_until(store) - pd.offsets.BDay(refresh_days))
+
+def update_history_store(store, df_preprocessed, store_path):
+    '''
+    Adds the appointments up to today to the history store, prunes it to ten years and saves it
+    '''
+    store = history_store.append_to_history_store(store, df_preprocessed, closed_until=pd.Timestamp.today())
+    store = history_store.prune_history_store(store, history_years=10)
+    history_store.save_history_store(store, store_path)
+
+def load_model(config):
+    '''
+    Loads the active version of the model registry (model_registry in config), or the model at MODEL_PATH without a registry
+    Returns the version, the model and its vocabularies (None if no vocabularies were saved with the model)
+    '''
+    if config.get('model_registry'):
+        return registry.load_version(config['model_registry'])
+
+    return MODEL_PATH, joblib.load(MODEL_PATH), vocabulary.load_vocabularies(vocabulary.get_vocabularies_path(MODEL_PATH))
+
+def load_new_version(config, current_version):
+    '''
+    Loads the active version of the model registry if it is not current_version
+    Returns the version, the model and its vocabularies, or None if the version did not change, there is no registry,
+    or the new version can not be loaded (a missing file, a wrong checksum)
+    '''
+    if not config.get('model_registry'):
+        return None
+
+    active = None
+    try:
+        active = registry.get_active_version(config['model_registry'])
+        if active == current_version:
+            return None
+        return registry.load_version(config['model_registry'], active)
+    except (OSError, ValueError) as e:
+        print(f'Keeping model version {current_version}, version {active} could not be loaded: {e}')
+        return None
+
+def swap_model(config):
+    '''
+    Swaps in the active version of the model registry if it changed since the last run, called before every run
+    The new version is loaded completely before the model and its vocabularies are swapped together, see load_new_version
+    '''
+    global model, vocabularies, model_version
+    loaded = load_new_version(config, model_version)
+    if loaded is None:
+        return
+
+    model_version, model, vocabularies = loaded
+    print(f'Switched to model version {model_version}')
+
+def main(config):
+    '''
+    Runs the nightly prediction, if a try fails (maybe due to inability to connect to db) it is retried up to max_tries tries
+    The waiting time before a retry starts at retry_delay_s seconds and doubles every try, up to max_retry_delay_s seconds.
+    A retry, or a manual rerun on the same day, resumes after the last stage which finished (see run_stages)
+    All tries of a run predict with the same model, a new active version in the model registry is picked up before the run starts
+    '''
+    swap_model(config)
+    today = pd.Timestamp.today().normalize()
+    snapshot_dir = config.get('snapshot_dir', '/app/py/snapshots')
+    checkpoints.remove_old_runs(snapshot_dir, config.get('snapshot_days', 3), today)
+    run_dir = checkpoints.get_run_dir(snapshot_dir, today)
+
+    max_tries = config.get('max_tries', 10)
+    for tries in range(max_tries):
+        # time, rows and peak memory of every stage of the try, see features/instrumentation.py
+        metrics = []
+        record = {'started': pd.Timestamp.now().isoformat(), 'run_date': today.strftime('%Y-%m-%d'), 'tries': tries, 'model_version': model_version,
+                  'hospital_wide': config.get('hospital_wide', False), 'stages': metrics}
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            print(f'Start prediction at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}')
+            record['predictions'] = run_stages(config, run_dir, metrics)
+            record['status'] = 'finished'
+            print(f'Finished prediction at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}')
+        except Exception as e:
+            record.update(status='failed', error=f'{type(e).__name__}: {e}')
+            print(f"Failed to predict (try {tries + 1} of {max_tries})")
+            print(f"Error: {e}")
+        finally:
+            record.update(wall_s=time.perf_counter() - wall_start, cpu_s=time.process_time() - cpu_start, peak_rss_mb=schema.peak_rss_mb())
+            write_metrics(config, record)
+
+        if record['status'] == 'finished':
+            return
+        if tries + 1 < max_tries:
+            delay = min(config.get('retry_delay_s', 60) * 2 ** tries, config.get('max_retry_delay_s', 1800))
+            print(f'Trying again in {delay}s')
+            time.sleep(delay)
 
 if __name__ == '__main__':
     # load config 
     config_path = './config.yaml' 
     with open(config_path) as stream:
         config = yaml.safe_load(stream)
-    # load models in memory
-    model = joblib.load('/app/py/no_show_model_v2.joblib')  
+    # the nightly run does not build a missing history store, it would extract ten years of all patients in one query
+    if config.get('history_store') and not os.path.exists(config['history_store']):
+        raise FileNotFoundError(f'No history store at {config["history_store"]}, build it with history_store.py or leave history_store empty in the config')
+    # load models in memory, from the model registry if there is one (see registry.py)
+    model_version, model, vocabularies = load_model(config)
+    if vocabularies is None:
+        if config.get('hospital_wide', False):
+            raise ValueError('Hospital wide scoring needs the vocabularies of the model, every shard would get its own encoding otherwise')
+        print('No vocabularies saved with the model, the categories are derived from the appointments of each day')
+
+    options = dict(arg[2:].split('=', 1) if '=' in arg else (arg[2:], True) for arg in sys.argv[1:] if arg.startswith('--'))
+
+    # python3 back_end.py --dates=<yyyy-mm-dd>,<yyyy-mm-dd> --output=<predictions.csv> [--all-agendas] predicts all workdays between the dates
+    # in one run (see score_date_range) and saves the predictions to a csv instead of the database
+    if 'dates' in options:
+        start, end = options['dates'].split(',')
+        df_predicted = score_date_range(config, pd.Timestamp(start), pd.Timestamp(end), agendas=None if 'all-agendas' in options else PILOT_AGENDAS)
+        if df_predicted is None:
+            print('No appointments to predict between these dates')
+        else:
+            df_predicted.to_csv(options['output'], index=False)
+            print(f'Saved {len(df_predicted)} predictions of {df_predicted["STARTDATEPLAN"].nunique()} dates to {options["output"]}')
+        sys.exit(0)
+
+    # python3 back_end.py --once [--profile=<path.prof>] runs a single prediction now instead of every night,
+    # with --profile the run is profiled with cProfile and the stats are dumped to the path (view with pstats or snakeviz)
+    if 'once' in options:
+        if 'profile' in options:
+            profiler = cProfile.Profile()
+            profiler.runcall(main, config)
+            profiler.dump_stats(options['profile'])
+            print(f'Profile saved to {options["profile"]}')
+        else:
+            main(config)
+        sys.exit(0)
 
     # summer time: 02:00 is 00:00 on machine.
     # to prevent update issues, set schedule time to 04:00, so 02:00 machine time
-    # main(config)
     schedule.every().day.at("02:00").do(main, config)
 
     print("Script started")
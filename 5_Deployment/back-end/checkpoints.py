@@ -0,0 +1,87 @@
+'''Snapshots of the output of every stage of the nightly run, so a retry or a rerun on the same day resumes after the last finished stage'''
+
+import os
+import shutil
+import pandas as pd
+
+
+def get_run_dir(snapshot_dir: str, run_date: pd.Timestamp) -> str:
+    '''
+    Returns the directory with the snapshots of the run of run_date, creates it if it does not exist yet
+    '''
+    run_dir = os.path.join(snapshot_dir, run_date.strftime('%Y-%m-%d'))
+    os.makedirs(run_dir, exist_ok=True)
+
+    return run_dir
+
+
+def write_frame(df: pd.DataFrame, path: str):
+    '''
+    Writes df to a parquet file next to path first and then swaps it, so a failed write never leaves a broken snapshot behind
+    '''
+    tmp_path = f'{path}.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def has_checkpoint(run_dir: str, stage: str) -> bool:
+    '''
+    Returns True if the stage finished in an earlier try of the run
+    '''
+    return os.path.exists(os.path.join(run_dir, f'{stage}.done'))
+
+
+def save_checkpoint(run_dir: str, stage: str, df: pd.DataFrame = None):
+    '''
+    Saves the output of a stage and marks it as finished, a stage without output (or with None) only gets the mark
+    '''
+    if df is not None:
+        write_frame(df, os.path.join(run_dir, f'{stage}.parquet'))
+    open(os.path.join(run_dir, f'{stage}.done'), 'w').close()
+
+
+def load_checkpoint(run_dir: str, stage: str) -> pd.DataFrame:
+    '''
+    Returns the output of a finished stage, None if the stage had no output
+    '''
+    path = os.path.join(run_dir, f'{stage}.parquet')
+
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+
+def save_batches(run_dir: str, stage: str, batches):
+    '''
+    Yields the batches and saves every batch as it passes, the stage is marked as finished once all batches are saved
+    The batches of an unfinished earlier try are removed first
+    '''
+    batch_dir = os.path.join(run_dir, stage)
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    os.makedirs(batch_dir)
+
+    for i, df in enumerate(batches):
+        if df is not None and len(df) > 0:
+            write_frame(df, os.path.join(batch_dir, f'part-{i:05d}.parquet'))
+        yield df
+    save_checkpoint(run_dir, stage)
+
+
+def load_batches(run_dir: str, stage: str):
+    '''
+    Yields the batches saved by save_batches in the order they were saved
+    '''
+    batch_dir = os.path.join(run_dir, stage)
+    for file in sorted(os.listdir(batch_dir)):
+        yield pd.read_parquet(os.path.join(batch_dir, file))
+
+
+def remove_old_runs(snapshot_dir: str, keep_days: int, today: pd.Timestamp):
+    '''
+    Removes the snapshots of runs before today - keep_days, these contain patient data and are only needed to resume a run
+    '''
+    if not os.path.isdir(snapshot_dir):
+        return
+
+    oldest = (today - pd.Timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    for run in os.listdir(snapshot_dir):
+        if run < oldest:
+            shutil.rmtree(os.path.join(snapshot_dir, run), ignore_errors=True)
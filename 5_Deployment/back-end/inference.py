@@ -0,0 +1,130 @@
+'''Low latency inference with the booster of the model: in place prediction on a float32 matrix in the fixed feature order of the booster'''
+
+import sys
+import time
+import joblib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, '/app/preprocessing')
+from features import vocabulary
+
+
+def get_predictor(model, vocabularies: dict, n_threads: int = 1) -> dict:
+    '''
+    Prepares the booster of a fitted XGBClassifier for in place prediction on the cpu with n_threads threads
+    The feature order, the vocabularies of the categorical features and the iterations to use are fixed once,
+    so a prediction only fills a float32 matrix and calls the booster. The booster is a copy, the model itself is not changed
+    '''
+    booster = model.get_booster().copy()
+    booster.set_param({'nthread': n_threads, 'device': 'cpu'})
+
+    try:
+        iteration_range = (0, model.best_iteration + 1)   # the sklearn interface predicts with the best iteration after early stopping
+    except AttributeError:
+        iteration_range = (0, 0)
+
+    features = booster.feature_names
+    categorical = {col: pd.Index(vocabularies[col]) for col, feature_type in zip(features, booster.feature_types) if feature_type == 'c'}
+
+    return {'booster': booster, 'features': features, 'categorical': categorical, 'iteration_range': iteration_range,
+            'buffer': np.empty((0, len(features)), dtype=np.float32)}
+
+
+def get_buffer(predictor: dict, n_rows: int) -> np.ndarray:
+    '''
+    Returns the first n_rows rows of the matrix which is reused between predictions, it only grows when a batch is larger than before
+    The matrix is shared, so this must only be used from one thread
+    '''
+    if len(predictor['buffer']) < n_rows:
+        predictor['buffer'] = np.empty((max(n_rows, 2 * len(predictor['buffer'])), len(predictor['features'])), dtype=np.float32)
+
+    return predictor['buffer'][:n_rows]
+
+
+def to_matrix(predictor: dict, df: pd.DataFrame, out: np.ndarray = None) -> np.ndarray:
+    '''
+    Writes the features of df to out (a new matrix if None) in the feature order of the booster
+    df only has to contain the feature columns, in any order. The categorical features are written as their position
+    in the vocabulary, which are the codes vocabulary.encode gives, and missing values as NaN
+    '''
+    if out is None:
+        out = np.empty((len(df), len(predictor['features'])), dtype=np.float32)
+
+    for i, col in enumerate(predictor['features']):
+        if col in predictor['categorical']:
+            codes = vocabulary.get_codes(df[col], predictor['categorical'][col])
+            out[:, i] = np.where(codes >= 0, codes, np.nan)
+        else:
+            out[:, i] = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    return out
+
+
+def predict_matrix(predictor: dict, matrix: np.ndarray) -> np.ndarray:
+    '''
+    Returns the probability of a no show for every row of a matrix made by to_matrix
+    '''
+    return predictor['booster'].inplace_predict(matrix, iteration_range=predictor['iteration_range'], missing=np.nan)
+
+
+def predict_proba(predictor: dict, df: pd.DataFrame) -> np.ndarray:
+    '''
+    Returns the probability of a no show for every row of df, the same as model.predict_proba(encoded features)[:,1]
+    '''
+    return predict_matrix(predictor, to_matrix(predictor, df, out=get_buffer(predictor, len(df))))
+
+
+def make_benchmark_features(predictor: dict, n_rows: int, seed: int = 0) -> pd.DataFrame:
+    '''
+    Makes random feature rows: the categorical features are drawn from their vocabulary (one in ten missing), the others from [0, 100)
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(index=range(n_rows))
+    for col in predictor['features']:
+        if col in predictor['categorical']:
+            values = np.array(predictor['categorical'][col].tolist() + [None], dtype=object)
+            df[col] = values[rng.choice(len(values), n_rows, p=[0.9 / (len(values) - 1)] * (len(values) - 1) + [0.1])]
+        else:
+            df[col] = rng.uniform(0, 100, n_rows).astype(np.float32)
+
+    return df
+
+
+def benchmark(model, vocabularies: dict, batch_sizes: list = [1, 10, 100, 1000, 10000], n_threads: list = [1, 4], repeats: int = 50) -> pd.DataFrame:
+    '''
+    Measures the latency of model.predict_proba on the encoded features against predict_proba of a predictor,
+    both starting from the same feature rows. Returns the median and 95th percentile per batch and the median per row
+    '''
+    results = []
+    for threads in n_threads:
+        predictor = get_predictor(model, vocabularies, n_threads=threads)
+        model.set_params(n_jobs=threads)
+        for batch_size in batch_sizes:
+            df = make_benchmark_features(predictor, batch_size)
+            paths = {'predict_proba': lambda: model.predict_proba(vocabulary.encode(df[predictor['features']].copy(), vocabularies))[:,1],
+                     'in place': lambda: predict_proba(predictor, df)}
+            if not np.allclose(paths['predict_proba'](), paths['in place'](), atol=1e-6):
+                raise ValueError('The in place predictions differ from predict_proba')
+
+            for path, run in paths.items():
+                durations = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    run()
+                    durations.append((time.perf_counter() - start) * 1000)
+                results.append({'threads': threads, 'batch_size': batch_size, 'path': path, 'batch_ms': np.median(durations),
+                                'batch_p95_ms': np.percentile(durations, 95), 'row_us': np.median(durations) / batch_size * 1000})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    # micro benchmark of the inference path: python inference.py [model path]
+    model_path = sys.argv[1] if len(sys.argv) > 1 else '/app/py/no_show_model_v2.joblib'
+    model = joblib.load(model_path)
+    vocabularies = vocabulary.load_vocabularies(vocabulary.get_vocabularies_path(model_path))
+    if vocabularies is None:
+        raise ValueError('The inference path needs the vocabularies of the model')
+
+    print(benchmark(model, vocabularies).to_string(index=False, float_format='%.3f'))
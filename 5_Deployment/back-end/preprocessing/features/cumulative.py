@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 
 # old function, this was very slow since an apply needed to be utilized
+# the features it calculated are available as calculate_cum_features(..., extended=True)
 def calculate_cum_features_old(row: pd.Series, data: pd.DataFrame, n_years: int) -> pd.Series:
     '''
     Calculates the cumalutive features for each appointment
@@ -54,69 +55,214 @@ def calculate_cum_features_old(row: pd.Series, data: pd.DataFrame, n_years: int)
 
     return pd.Series({f'num_no_shows': num_no_shows, f'perc_no_shows': perc_no_shows, f'num_appointments_spec': num_appointments_spec, f'num_no_shows_spec': num_no_shows_spec, f'perc_no_shows_spec': perc_no_shows_spec, f'num_appointments': num_appointments, f'stiptheid': stiptheid,  f'days_since_last_appointment': days_since_last_appointment, f'no_show_last_appointment': no_show_last_appointment, f'appointment_last_week': appointment_last_week, f'perc_scaled': perc_scaled, f'weighted_no_show_percentage': weighted_no_show_percentage})
 
-def calculate_cum_features(df: pd.DataFrame, history_years : int=5, exclude_days=3):
+# composite (patient, date) keys are patient_code * 2**32 + date, dates are shifted so they are never negative
+KEY_SHIFT = 32
+DATE_OFFSET = 2**31
 
-    # Rolling features can't be calculated on non-unique index
-    df = df.set_index(["PATIENTNR", "STARTDATEPLAN"])
-    df = df[~df.index.duplicated(keep="last")].reset_index()
-    df = df.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'])
 
+def dates_to_days(series: pd.Series) -> np.ndarray:
+    '''
+    Converts a datetime series to the number of days since 1970-01-01
+    '''
+    return series.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
 
 
-    # create rolling windows, df_exclude will be used to remove the data about appointments of the previous n days. This is done because in deployment we will be predicting no shows over n days
-    window_days = 365 * history_years
-    df_period = df.reset_index().set_index('STARTDATEPLAN').groupby('PATIENTNR', sort=False)[['no_show', 'VerschilAankomstEnStart']].rolling(f'{window_days}D')
-    df_exclude = df.reset_index().set_index('STARTDATEPLAN').groupby('PATIENTNR', sort=False)[['no_show', 'VerschilAankomstEnStart']].rolling(f'{exclude_days}D')
+def patient_date_keys(codes: np.ndarray, days: np.ndarray) -> np.ndarray:
+    '''
+    Combines patient codes and dates into one sortable int64 key
+    '''
+    return (codes.astype(np.int64) << KEY_SHIFT) + (days.astype(np.int64) + DATE_OFFSET)
 
-    # calculate previous no show features
-    ## calculate the previous number of no shows per appointment in the last n years
-    df_num_no_shows = (df_period['no_show'].sum() - df_exclude['no_show'].sum()).reset_index().rename(columns={'no_show': 'num_no_shows'})
-    df = df.merge(df_num_no_shows, on=['STARTDATEPLAN', 'PATIENTNR'])
 
-    ## calculate the previous number of appointments per appointment in the last n years
-    df_num_appointments = (df_period['no_show'].count() - df_exclude['no_show'].count()).reset_index().rename(columns={'no_show': 'num_appointments'})
-    df = df.merge(df_num_appointments, on=['STARTDATEPLAN', 'PATIENTNR'])
+def decayed_running_sum(codes: np.ndarray, days: np.ndarray, values: np.ndarray, decay_rate: float) -> np.ndarray:
+    '''
+    Calculates per patient the exponentially decayed sum of all values up to and including each appointment
+    s[i] = s[i-1] * exp(-decay_rate * (days[i] - days[i-1])) + values[i], restarting at every patient
+    The arrays must be sorted by (patient code, date)
 
-    ## calculate percentage of previous no shows
-    df['perc_no_shows'] = df['num_no_shows'] / df['num_appointments']
+    The recurrence is evaluated for all patients at once, one step per position within the history of a patient.
+    So the number of python iterations is the length of the longest history, not the number of appointments
+    '''
+    sums = values.astype(np.float64)
+    if len(sums) == 0:
+        return sums
 
+    # position of each appointment within the history of its patient
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    position = np.arange(len(codes)) - np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+    decay = np.exp(-decay_rate * np.diff(days, prepend=days[0]).astype(np.float64))
 
+    order = np.argsort(position, kind='stable')
+    bounds = np.searchsorted(position[order], np.arange(position.max() + 2))
+    for step in range(1, len(bounds) - 1):
+        index = order[bounds[step]:bounds[step + 1]]
+        sums[index] += sums[index - 1] * decay[index]
 
-    # calcualte mean time of arrival 
-    df_stipteid = (df_period['VerschilAankomstEnStart'].sum() - df_exclude['VerschilAankomstEnStart'].sum().fillna(0)).reset_index().rename(columns={'VerschilAankomstEnStart': 'stiptheid'})
-    df = df.merge(df_stipteid, on=['STARTDATEPLAN', 'PATIENTNR'])
-    df['stiptheid'] = df['stiptheid'] / df['num_appointments']
+    return sums
 
 
+def calculate_window_features(codes: np.ndarray, days: np.ndarray, no_show: np.ndarray, arrival: np.ndarray,
+                              q_codes: np.ndarray, q_days: np.ndarray, window_days: int, exclude_days: int,
+                              decay_rate: float = None) -> dict:
+    '''
+    Calculates the cumulative features for the appointments (q_codes, q_days) based on a history
+    The history arrays must be sorted by (patient code, date) and contain one appointment per patient per day
 
-    # calculate status of the last appointment, excluding the appointments from the last 3 days
-    df = df.sort_values(by=['PATIENTNR', 'STARTDATEPLAN'])
+    The history of an appointment on day t are the appointments in (t - window_days, t - exclude_days].
+    All window boundaries are found with a binary search and all sums are differences of prefix sums.
+    If decay_rate is given, the no show percentage weighted by exp(-decay_rate * days ago) is calculated as well
+    '''
+    keys = patient_date_keys(codes, days)
+    q_codes = q_codes.astype(np.int64)
+    q_days = q_days.astype(np.int64)
+
+    # positions of the window boundaries within the history of each patient
+    lo = np.searchsorted(keys, patient_date_keys(q_codes, q_days - window_days), side='right')
+    hi = np.searchsorted(keys, patient_date_keys(q_codes, q_days - exclude_days), side='right')
+    top = np.searchsorted(keys, patient_date_keys(q_codes, q_days), side='right')
+    first = np.searchsorted(keys, q_codes << KEY_SHIFT, side='left')
+
+    # prefix sums, so every window aggregate is a difference of two lookups
+    cum_no_show = np.concatenate([[0], np.cumsum(no_show, dtype=np.int64)])
+    cum_arrival = np.concatenate([[0.], np.cumsum(np.nan_to_num(arrival.astype(np.float64)))])
+    cum_arrival_count = np.concatenate([[0], np.cumsum(~np.isnan(arrival), dtype=np.int64)])
+
+    num_appointments = (hi - lo).astype(np.float64)
+    num_no_shows = (cum_no_show[hi] - cum_no_show[lo]).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perc_no_shows = num_no_shows / num_appointments
+
+    # the summed arrival time is missing when no arrival time is known in the whole window (including the excluded days)
+    has_arrival = (cum_arrival_count[top] - cum_arrival_count[lo]) > 0
+    arrival_sum = np.where(has_arrival, cum_arrival[hi] - cum_arrival[lo], np.nan)
+
+    # the last appointment on or before t - exclude_days, this one is not limited by the history window
+    has_previous = hi > first
+    previous = np.where(has_previous, hi - 1, 0)
+    last_noshow = np.where(has_previous, no_show[previous] if len(no_show) else 0, np.nan)
+    previous_days = np.where(has_previous, days[previous] if len(days) else 0, 0)
+    days_since_last_appointment = np.where(has_previous, previous_days - q_days, np.nan)
+    appointment_last_week = (has_previous & (q_days - previous_days <= 7)).astype(int)
+
+    features = {'num_no_shows': num_no_shows, 'num_appointments': num_appointments, 'perc_no_shows': perc_no_shows,
+                'arrival_sum': arrival_sum, 'last_noshow': last_noshow, 'has_previous': has_previous,
+                'previous_days': previous_days, 'days_since_last_appointment': days_since_last_appointment,
+                'appointment_last_week': appointment_last_week}
+
+    if decay_rate is not None:
+        features['weighted_no_show_percentage'] = np.full(len(q_days), np.nan)
+        if len(days):
+            weighted_no_shows = decayed_running_sum(codes, days, no_show, decay_rate)
+            weights = decayed_running_sum(codes, days, np.ones(len(days)), decay_rate)
+
+            # the window is the decayed sum up to its last appointment minus the (further decayed) sum before the window
+            # both are relative to the last appointment in the window, the scale cancels out in the percentage
+            end = np.maximum(hi - 1, 0)
+            before = np.maximum(lo - 1, 0)
+            decay_before = np.where(lo > first, np.exp(-decay_rate * (days[end] - days[before]).astype(np.float64)), 0.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weighted = (weighted_no_shows[end] - decay_before * weighted_no_shows[before]) / (weights[end] - decay_before * weights[before])
+            features['weighted_no_show_percentage'] = np.where(hi > lo, weighted, np.nan)
+
+    return features
+
+
+def calculate_spec_features(codes: np.ndarray, spec_codes: np.ndarray, days: np.ndarray, no_show: np.ndarray,
+                            q_codes: np.ndarray, q_spec_codes: np.ndarray, q_days: np.ndarray, window_days: int, exclude_days: int) -> dict:
+    '''
+    Calculates the number and percentage of no shows of the patient within the specialism of the appointment
+    This uses the same windows as calculate_window_features, grouped by (patient, specialism) instead of patient
+    The history arrays do not have to be sorted
+    '''
+    # combine patient and specialism into one code, missing specialisms (-1) get their own code
+    n_specs = max(spec_codes.max(initial=-1), q_spec_codes.max(initial=-1)) + 2
+    pairs = codes.astype(np.int64) * n_specs + spec_codes + 1
+    q_pairs = q_codes.astype(np.int64) * n_specs + q_spec_codes + 1
 
-    ## create a shifted df to use for merging
-    df_shifted = df.copy()
-    df_shifted['STARTDATEPLAN'] = df_shifted['STARTDATEPLAN'] + pd.Timedelta(days=exclude_days)
-    df_shifted = df_shifted.rename(columns={'no_show': 'last_noshow'})
+    order = np.lexsort((days, pairs))
+    features = calculate_window_features(pairs[order], days[order], no_show[order], np.zeros(len(order)), q_pairs, q_days,
+                                         window_days=window_days, exclude_days=exclude_days)
 
-    ## perform an asof merge, this is a merge where it tries to find an match to join on and otherwise finds the closes possible value to merge on
-    ## we use direction='backwards' to find the appointment most close to the date of appointment date minus 3 days (offset)
-    df = pd.merge_asof(df.sort_values(by=['STARTDATEPLAN']), df_shifted[['PATIENTNR', 'STARTDATEPLAN', 'last_noshow']].sort_values(by=['STARTDATEPLAN']),
-                        on='STARTDATEPLAN', by='PATIENTNR', direction='backward')
+    return {'num_no_shows_spec': features['num_no_shows'], 'num_appointments_spec': features['num_appointments'],
+            'perc_no_shows_spec': features['perc_no_shows']}
 
-    
 
-    # calculate time difference in days between this and previous appointemtn, excluding the appointments from the last 3 days
-    df = df.sort_values(by=['PATIENTNR', 'STARTDATEPLAN'])
+def attach_window_features(df: pd.DataFrame, features: dict, spec_features: dict = None) -> pd.DataFrame:
+    '''
+    Attaches the output of calculate_window_features to the dataframe, in the same format as the old rolling windows
+    If spec_features is given, the extended features (specialism and decay weighted history) are attached as well
+    '''
+    df['num_no_shows'] = features['num_no_shows']
+    df['num_appointments'] = features['num_appointments']
+    df['perc_no_shows'] = features['perc_no_shows']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['stiptheid'] = features['arrival_sum'] / features['num_appointments']
+    df['last_noshow'] = features['last_noshow']
+    df['DATE_PREV_APP'] = pd.to_datetime(np.where(features['has_previous'], features['previous_days'], np.nan), unit='D')
+    df['days_since_last_appointment'] = features['days_since_last_appointment']
 
-    ## create a shifted df to use for merging
-    df_shifted = df.copy()
-    df_shifted['DATE_PREV_APP'] = df_shifted['STARTDATEPLAN']
-    df_shifted['STARTDATEPLAN'] = df_shifted['STARTDATEPLAN'] + pd.Timedelta(days=exclude_days)
+    if spec_features is not None:
+        for col in ['num_no_shows_spec', 'num_appointments_spec', 'perc_no_shows_spec']:
+            df[col] = spec_features[col]
+        df['appointment_last_week'] = features['appointment_last_week']
+        df['weighted_no_show_percentage'] = features['weighted_no_show_percentage']
 
-    ## perform an asof merge, this is a merge where it tries to find an match to join on and otherwise finds the closes possible value to merge on
-    ## we use direction='backwards' to find the appointment most close to the date of appointment date minus 3 days (offset)
-    df = pd.merge_asof(df.sort_values(by=['STARTDATEPLAN']), df_shifted[['PATIENTNR', 'STARTDATEPLAN', 'DATE_PREV_APP']].sort_values(by=['STARTDATEPLAN']),
-                        on='STARTDATEPLAN', by='PATIENTNR', direction='backward')
-    df['days_since_last_appointment'] = (df['DATE_PREV_APP'] - df['STARTDATEPLAN']).dt.days
+    return df
 
-    return(df)
 
+def get_exclude_days(dates: pd.Series, exclude_days: int, exclude_days_per_date: pd.Series = None):
+    '''
+    Returns the number of days left out of the history of every appointment
+    This is exclude_days, or the value of the date of the appointment in exclude_days_per_date (indexed by date) if it is given there
+    '''
+    if exclude_days_per_date is None:
+        return exclude_days
+
+    return dates.map(exclude_days_per_date).fillna(exclude_days).to_numpy(dtype=np.int64)
+
+
+def calculate_cum_features(df: pd.DataFrame, history_years : int=5, exclude_days=3, extended: bool = False, decay_rate: float = 0.01,
+                           exclude_days_per_date: pd.Series = None):
+    '''
+    Calculates the cumalutive features for each appointment
+    This is based on a history of the patient of n years ago
+
+    The features consists out of:
+    (1) number of no shows (2) number of appointments (3) percentage of no shows 
+    (4) mean difference between arrival and appointment time (5) days since last appointment
+    (6) status of the last appointment
+
+    If extended=True the features of calculate_cum_features_old that were dropped are added as well:
+    (7) number and percentage of no shows and number of appointments within the same specialism
+    (8) appointment in the week before the excluded days y/n (9) no show percentage weighted by exp(-decay_rate * days ago)
+
+    The data is sorted once, all windows are calculated with calculate_window_features.
+    The rows are returned sorted by (STARTDATEPLAN, PATIENTNR)
+
+    exclude_days_per_date gives other excluded days for some dates (see get_exclude_days), when the dates are predicted over different horizons
+    '''
+    # only one appointment per patient per day is used
+    df = df.set_index(["PATIENTNR", "STARTDATEPLAN"])
+    df = df[~df.index.duplicated(keep="last")].reset_index()
+    df = df.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'], kind='mergesort').reset_index(drop=True)
+
+    # the history is the same data ordered by (patient, date), the frame is already sorted on date so a stable sort on patient is enough
+    codes = pd.factorize(df['PATIENTNR'])[0]
+    days = dates_to_days(df['STARTDATEPLAN'])
+    order = np.argsort(codes, kind='stable')
+
+    # the appointments of the last exclude_days are left out of the history, because in deployment we will be predicting no shows over n days
+    no_show = df['no_show'].to_numpy(dtype=np.int64)
+    arrival = df['VerschilAankomstEnStart'].to_numpy(dtype=np.float64)
+    exclude_days = get_exclude_days(df['STARTDATEPLAN'], exclude_days, exclude_days_per_date)
+    features = calculate_window_features(codes[order], days[order], no_show[order], arrival[order], codes, days,
+                                         window_days=365 * history_years, exclude_days=exclude_days,
+                                         decay_rate=decay_rate if extended else None)
+
+    spec_features = None
+    if extended:
+        spec_codes = pd.factorize(df['SPECIALISME'])[0]
+        spec_features = calculate_spec_features(codes, spec_codes, days, no_show, codes, spec_codes, days,
+                                                window_days=365 * history_years, exclude_days=exclude_days)
+
+    return attach_window_features(df, features, spec_features)
@@ -1,12 +1,20 @@
+import os
+import sys
+import functools
 import pandas as pd
 import numpy as np
 from numpy import radians, sin, cos, sqrt, arctan2
 
+from features import parsing
+
+# hospital locations, the zip code index holds the distance to each of them
+LOCATIONS = ['Hengelo', 'Almelo']
+
 def extract_zipcode(series: pd.Series) -> pd.Series:
     '''
     Extracts the 4 digits from a zipcode field
     '''
-    return series.astype('str').str.extract(r'^(\d{4})').astype('float').astype('Int64', errors='ignore')
+    return parsing.map_unique(series, lambda zipcodes: zipcodes.astype('str').str.extract(r'^(\d{4})', expand=False).astype('float').astype('Int64', errors='ignore'))
 
 
 def get_location(description: str) -> float:
@@ -28,6 +36,13 @@ def get_location(description: str) -> float:
         return np.nan
 
 
+def get_locations(descriptions: pd.Series) -> pd.Series:
+    '''
+    Gets the location of every appointment, get_location is only called once per distinct description
+    '''
+    return parsing.map_unique(descriptions, lambda uniques: uniques.apply(get_location))
+
+
 def get_all_nl_zip_codes(postalcodes_path: str) -> pd.DataFrame:
     ''' 
     Gets the longitudes and langitudes for all the postal codes from a text file
@@ -67,4 +82,67 @@ def haversine_distance(location: pd.Series, lats: pd.Series, lons: pd.Series) ->
     c = 2 * np.arcsin(np.sqrt(a))
     distance = 6378.137 * c
 
-    return distance
\ No newline at end of file
+    return distance
+
+
+def build_zip_code_index(postalcodes_path: str) -> np.ndarray:
+    '''
+    Builds an array indexed by the 4 digit postal code, with columns: latitude, longitude and the distance to each location
+    Postal codes which are not in the text file are missing (nan)
+    The distances are calculated with haversine_distance, so a lookup gives the same value as calculating it per appointment
+    '''
+    zip_codes = get_all_nl_zip_codes(postalcodes_path)
+    zip_codes['POSTCODE'] = extract_zipcode(pd.Series(zip_codes.index)).to_numpy(dtype='float64', na_value=np.nan)
+    zip_codes = zip_codes[zip_codes['POSTCODE'].notna() & ~zip_codes['POSTCODE'].duplicated()]
+
+    rows = zip_codes['POSTCODE'].to_numpy(dtype=np.int64)
+    lats = zip_codes['latitude'].to_numpy(dtype=np.float64)
+    lons = zip_codes['longitude'].to_numpy(dtype=np.float64)
+
+    index = np.full((10000, 2 + len(LOCATIONS)), np.nan)
+    index[rows, 0] = lats
+    index[rows, 1] = lons
+    for i, location in enumerate(LOCATIONS):
+        index[rows, 2 + i] = haversine_distance(pd.Series([location] * len(rows), name='LOCATIE'), lats, lons)
+
+    return index
+
+
+@functools.lru_cache()
+def load_zip_code_index(postalcodes_path: str) -> np.ndarray:
+    '''
+    Loads the zip code index belonging to the postal codes text file (memory mapped, read only)
+    The index is built and saved next to the text file when it does not exist yet or when the text file is newer
+    The index is cached, so the text file is read at most once per process.
+    Every process writes to its own temporary file which is then swapped in, so processes which build it at the same time
+    never read a half written index
+    '''
+    index_path = f'{os.path.splitext(postalcodes_path)[0]}_index.npy'
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(postalcodes_path):
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, build_zip_code_index(postalcodes_path))
+        os.replace(tmp_path, index_path)
+
+    return np.load(index_path, mmap_mode='r')
+
+
+def lookup_zip_codes(index: np.ndarray, postcodes: pd.Series, locations: pd.Series) -> pd.DataFrame:
+    '''
+    Gets the latitude, longitude and distance to the appointment location (AFSTAND) of every appointment from the zip code index
+    '''
+    postcodes = postcodes.to_numpy(dtype='float64', na_value=np.nan)
+    known = ~np.isnan(postcodes) & (postcodes >= 0) & (postcodes < len(index))
+    rows = np.where(known, postcodes, 0).astype(np.int64)
+    cols = 2 + locations.map({location: i for i, location in enumerate(LOCATIONS)}).to_numpy(dtype='float64', na_value=np.nan)
+
+    features = pd.DataFrame({'latitude': np.where(known, index[rows, 0], np.nan),
+                             'longitude': np.where(known, index[rows, 1], np.nan)}, index=locations.index)
+    features['AFSTAND'] = np.where(known & ~np.isnan(cols), index[rows, np.nan_to_num(cols).astype(np.int64)], np.nan)
+
+    return features
+
+
+if __name__ == '__main__':
+    # builds the zip code index from a geonames postal code file
+    load_zip_code_index(sys.argv[1])
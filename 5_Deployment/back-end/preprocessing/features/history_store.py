@@ -0,0 +1,259 @@
+'''Persistent per-patient appointment history used to calculate the cumulative features'''
+
+import os
+import sys
+import pandas as pd
+import numpy as np
+
+from features import cumulative
+
+
+def _deduplicate(patients: np.ndarray, days: np.ndarray, priority: np.ndarray) -> np.ndarray:
+    '''
+    Returns the indices that sort the records by (patient, date) with only the last record per patient per day
+    The record with the highest priority wins, ties are decided by the original order
+    '''
+    order = np.lexsort((np.arange(len(days)), priority, days, patients))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (patients[order][1:] != patients[order][:-1]) | (days[order][1:] != days[order][:-1])
+
+    return order[last]
+
+
+def _from_arrays(patients: np.ndarray, days: np.ndarray, no_show: np.ndarray, arrival: np.ndarray, specialism: np.ndarray,
+                 closed_until: int) -> dict:
+    '''
+    Builds a store from arrays that are already sorted by (patient, date)
+    '''
+    unique_patients, starts = np.unique(patients, return_index=True)
+    offsets = np.append(starts, len(patients)).astype(np.int64)
+
+    return {'patients': unique_patients.astype(str), 'offsets': offsets, 'dates': days.astype(np.int32),
+            'no_show': no_show.astype(np.int8), 'arrival': arrival.astype(np.float32), 'specialism': specialism.astype(str),
+            'closed_until': np.array(closed_until, dtype=np.int32)}
+
+
+def _frame_arrays(df: pd.DataFrame):
+    '''
+    Gets the arrays stored per appointment from a preprocessed dataframe
+    '''
+    patients = df['PATIENTNR'].astype(str).to_numpy()
+    days = cumulative.dates_to_days(df['STARTDATEPLAN'])
+    no_show = df['no_show'].to_numpy(dtype=np.int8)
+    arrival = df['VerschilAankomstEnStart'].to_numpy(dtype=np.float32)
+    specialism = df['SPECIALISME'].astype(str).to_numpy()
+
+    return patients, days, no_show, arrival, specialism
+
+
+def _patient_rows(store: dict, patients: np.ndarray) -> tuple:
+    '''
+    Returns the indices of the patients which are in the store, their number of stored appointments and the rows of these appointments
+    '''
+    index = np.unique(np.searchsorted(store['patients'], patients))
+    index = index[index < len(store['patients'])]
+    index = index[np.isin(store['patients'][index], patients)]
+    starts, ends = store['offsets'][index], store['offsets'][index + 1]
+    lengths = ends - starts
+    rows = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+
+    return index, lengths, rows
+
+
+def build_history_store(df: pd.DataFrame, closed_until) -> dict:
+    '''
+    Builds the history store from preprocessed appointments (output of preprocess_noshow_data)
+    Only appointments before closed_until are stored, later appointments have no definitive outcome yet
+
+    The store contains per patient an array of appointment dates, no show outcomes, arrival time differences and specialisms.
+    The patients are sorted and the appointments of patient i are stored at offsets[i]:offsets[i+1]
+    '''
+    return build_history_store_from_batches([df], closed_until)
+
+
+def build_history_store_from_batches(batches, closed_until) -> dict:
+    '''
+    Builds the history store from batches of preprocessed appointments (see build_history_store), only the arrays of the store
+    are kept of every batch. A patient may have appointments in several batches, so the batches can be periods of time
+    '''
+    closed_until = pd.Timestamp(closed_until).normalize()
+    arrays = [_frame_arrays(df[df['STARTDATEPLAN'] < closed_until]) for df in batches if df is not None]
+    if len(arrays) == 0:
+        raise ValueError('No appointments to build the history store from')
+    patients, days, no_show, arrival, specialism = [np.concatenate(column) for column in zip(*arrays)]
+    keep = _deduplicate(patients, days, np.zeros(len(days), dtype=np.int8))
+
+    return _from_arrays(patients[keep], days[keep], no_show[keep], arrival[keep], specialism[keep], (closed_until - pd.Timestamp(0)).days)
+
+
+def append_to_history_store(store: dict, df: pd.DataFrame, closed_until) -> dict:
+    '''
+    Appends the closed appointments of a preprocessed dataframe to the store
+    Appointments which are already in the store are overwritten by the new ones
+    '''
+    new = build_history_store(df, closed_until)
+    old_patients = np.repeat(store['patients'], np.diff(store['offsets']))
+    new_patients = np.repeat(new['patients'], np.diff(new['offsets']))
+
+    patients = np.concatenate([old_patients, new_patients])
+    days = np.concatenate([store['dates'], new['dates']])
+    no_show = np.concatenate([store['no_show'], new['no_show']])
+    arrival = np.concatenate([store['arrival'], new['arrival']])
+    specialism = np.concatenate([store['specialism'], new['specialism']])
+    priority = np.concatenate([np.zeros(len(old_patients), dtype=np.int8), np.ones(len(new_patients), dtype=np.int8)])
+
+    keep = _deduplicate(patients, days, priority)
+    closed_until = max(int(store['closed_until']), int(new['closed_until']))
+
+    return _from_arrays(patients[keep], days[keep], no_show[keep], arrival[keep], specialism[keep], closed_until)
+
+
+def reopen_history_store(store: dict, since) -> dict:
+    '''
+    Removes the appointments from since onwards and moves closed_until back to since, so they are extracted and appended again.
+    The outcome of an appointment can still change after it was appended (a no show registered late, a cancellation), the appointments
+    of the last days are replaced by their current state this way
+    '''
+    since = min((pd.Timestamp(since).normalize() - pd.Timestamp(0)).days, int(store['closed_until']))
+    keep = store['dates'] < since
+    patients = np.repeat(store['patients'], np.diff(store['offsets']))
+
+    return _from_arrays(patients[keep], store['dates'][keep], store['no_show'][keep], store['arrival'][keep], store['specialism'][keep], since)
+
+
+def prune_history_store(store: dict, history_years: int) -> dict:
+    '''
+    Removes the appointments older than history_years, these are never used for the cumulative features
+    '''
+    start = int(store['closed_until']) - 365 * history_years
+    keep = store['dates'] >= start
+    patients = np.repeat(store['patients'], np.diff(store['offsets']))
+
+    return _from_arrays(patients[keep], store['dates'][keep], store['no_show'][keep], store['arrival'][keep], store['specialism'][keep],
+                        int(store['closed_until']))
+
+
+def select_patients(store: dict, patients) -> dict:
+    '''
+    Returns a store with only the appointments of the given patients, e.g. for a worker which only scores these patients
+    '''
+    index, lengths, rows = _patient_rows(store, np.asarray(patients, dtype=str))
+
+    return _from_arrays(np.repeat(store['patients'][index], lengths), store['dates'][rows], store['no_show'][rows], store['arrival'][rows],
+                        store['specialism'][rows], int(store['closed_until']))
+
+
+def get_closed_until(store: dict) -> pd.Timestamp:
+    '''
+    Returns the first date of which the appointments are not yet in the store
+    '''
+    return pd.Timestamp(int(store['closed_until']), unit='D')
+
+
+def save_history_store(store: dict, path: str):
+    '''
+    Saves the store to an uncompressed npz file
+    The file is written next to the old one first and then swapped, so a failed run never leaves a broken store behind
+    '''
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **store)
+    os.replace(tmp_path, path)
+
+
+def load_history_store(path: str) -> dict:
+    '''
+    Loads the store from a npz file, returns None if there is no store yet
+    '''
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+def calculate_cum_features_from_store(store: dict, df: pd.DataFrame, history_years: int = 5, exclude_days: int = 3,
+                                      extended: bool = False, decay_rate: float = 0.01, exclude_days_per_date: pd.Series = None) -> pd.DataFrame:
+    '''
+    Calculates the cumulative features of the appointments in df from the history in the store
+    The appointments in df are used as history as well (they overwrite the store on the same patient and day),
+    so df only has to contain the appointments since the store was last updated
+
+    Returns the same columns as cumulative.calculate_cum_features (including the extended features if extended=True)
+    '''
+    # one appointment per patient per day, just like calculate_cum_features
+    df = df.set_index(['PATIENTNR', 'STARTDATEPLAN'])
+    df = df[~df.index.duplicated(keep='last')].reset_index()
+    df = df.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'], kind='mergesort').reset_index(drop=True)
+
+    q_patients, q_days, q_no_show, q_arrival, q_specialism = _frame_arrays(df)
+    exclude_days = cumulative.get_exclude_days(df['STARTDATEPLAN'], exclude_days, exclude_days_per_date)
+
+    # gather the stored history of only the patients in df
+    index, lengths, rows = _patient_rows(store, q_patients)
+
+    patients = np.concatenate([np.repeat(store['patients'][index], lengths), q_patients])
+    days = np.concatenate([store['dates'][rows], q_days])
+    no_show = np.concatenate([store['no_show'][rows], q_no_show])
+    arrival = np.concatenate([store['arrival'][rows], q_arrival])
+    specialism = np.concatenate([store['specialism'][rows], q_specialism])
+    priority = np.concatenate([np.zeros(len(rows), dtype=np.int8), np.ones(len(q_patients), dtype=np.int8)])
+
+    # combine history and df, with df winning on the same patient and day
+    keep = _deduplicate(patients, days, priority)
+    vocabulary, codes = np.unique(patients[keep], return_inverse=True)
+    q_codes = np.searchsorted(vocabulary, q_patients)
+
+    features = cumulative.calculate_window_features(codes, days[keep], no_show[keep], arrival[keep], q_codes, q_days,
+                                                    window_days=365 * history_years, exclude_days=exclude_days,
+                                                    decay_rate=decay_rate if extended else None)
+
+    spec_features = None
+    if extended:
+        specialisms, spec_codes = np.unique(np.concatenate([specialism[keep], q_specialism]), return_inverse=True)
+        spec_features = cumulative.calculate_spec_features(codes, spec_codes[:len(codes)], days[keep], no_show[keep],
+                                                           q_codes, spec_codes[len(codes):], q_days,
+                                                           window_days=365 * history_years, exclude_days=exclude_days)
+
+    return cumulative.attach_window_features(df, features, spec_features)
+
+
+if __name__ == '__main__':
+    # python -m features.history_store <preprocessed.csv> <store.npz> <closed_until>
+    #   builds the initial store from a preprocessed csv (output of preprocess_noshow_data)
+    #   the PATIENTNR format has to be the same as the format of the nightly extract
+    # python -m features.history_store --config=<config.yaml> <store.npz> [--years=10]
+    #   builds the initial store from the database of the back-end, closed until today. The appointments of all patients are
+    #   extracted and preprocessed one month at a time, only the arrays of the store are kept of every month
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--'))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if 'config' in options:
+        import yaml
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        import back_end
+
+        with open(options['config']) as stream:
+            config = yaml.safe_load(stream)
+        outfile = args[0]
+        closed_until = pd.Timestamp.today().normalize()
+        months = pd.date_range(end=closed_until, periods=12 * int(options.get('years', 10)) + 1, freq='MS')
+
+        def extract_months():
+            conn = back_end.get_db_connection(config['driver'], config['server'], config['database'], config['user'], config['password'], config['port'])
+            try:
+                for start, end in zip(months, list(months[1:]) + [closed_until]):
+                    df = back_end.get_closed_appointments_from_db(conn, start, end)
+                    print(f'{start.strftime("%Y-%m")}: {len(df)} appointments')
+                    yield back_end.preprocess(df) if len(df) > 0 else None
+            finally:
+                conn.close()
+
+        store = build_history_store_from_batches(extract_months(), closed_until)
+    else:
+        file, outfile, closed_until = args
+        df = pd.read_csv(file, parse_dates=['STARTDATEPLAN'], dtype={'PATIENTNR': str})
+        store = build_history_store(df, closed_until)
+
+    save_history_store(store, outfile)
+    print(f'Saved the history of {len(store["patients"])} patients ({len(store["dates"])} appointments) to {outfile}')
@@ -0,0 +1,75 @@
+'''Wall time, cpu time, peak memory and row counts per stage of a run, recorded in a list of stage records like the memory report'''
+
+import json
+import time
+import pandas as pd
+
+from features import schema
+
+
+def record_stage(metrics: list, stage: str, rows: int, wall_start: float, cpu_start: float):
+    '''
+    Appends the time since wall_start (time.perf_counter) and cpu_start (time.process_time) of a stage to metrics
+    '''
+    metrics.append({'stage': stage, 'rows': rows, 'wall_s': time.perf_counter() - wall_start, 'cpu_s': time.process_time() - cpu_start,
+                    'peak_rss_mb': schema.peak_rss_mb()})
+
+
+def timed(metrics: list, stage: str, func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs) and records it as a stage in metrics, returns the output of func
+    The rows are the length of the first dataframe or series func gets (or of its output if it gets none), just calls func if metrics is None
+    '''
+    if metrics is None:
+        return func(*args, **kwargs)
+
+    rows = next((len(arg) for arg in list(args) + list(kwargs.values()) if isinstance(arg, (pd.DataFrame, pd.Series))), None)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    output = func(*args, **kwargs)
+    if rows is None and isinstance(output, (pd.DataFrame, pd.Series, list)):
+        rows = len(output)
+    record_stage(metrics, stage, rows, wall_start, cpu_start)
+
+    return output
+
+
+def timed_iter(metrics: list, stage: str, iterable):
+    '''
+    Yields the items of iterable and records the time spent waiting for every item as a stage in metrics
+    Used for the batches of the extraction, so the time waiting for the database is separated from the preprocessing of the batches
+    '''
+    iterator = iter(iterable)
+    while True:
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if metrics is not None:
+            record_stage(metrics, stage, len(item) if item is not None else 0, wall_start, cpu_start)
+        yield item
+
+
+def summarize(metrics: list) -> pd.DataFrame:
+    '''
+    Combines the stages which ran multiple times (once per batch), in the order they first ran
+    '''
+    return pd.DataFrame(metrics, columns=['stage', 'rows', 'wall_s', 'cpu_s', 'peak_rss_mb']).groupby('stage', sort=False).agg(
+        {'rows': 'sum', 'wall_s': 'sum', 'cpu_s': 'sum', 'peak_rss_mb': 'max'})
+
+
+def print_metrics(metrics: list):
+    '''
+    Prints the time, rows and peak memory per stage
+    '''
+    for stage, row in summarize(metrics).iterrows():
+        print(f'{stage:<50} {row["rows"]:>10.0f} rows {row["wall_s"]:>10.2f} s {row["cpu_s"]:>10.2f} s cpu {row["peak_rss_mb"]:>10.1f} MB peak rss')
+
+
+def write_run_record(path: str, record: dict):
+    '''
+    Appends the record of a run as one line of json to path, the stages are combined with summarize
+    '''
+    record = dict(record, stages=json.loads(summarize(record['stages']).reset_index().to_json(orient='records')))
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
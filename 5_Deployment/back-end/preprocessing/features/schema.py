@@ -0,0 +1,118 @@
+'''Declared dtypes of the columns in the preprocessing, applied at ingest and kept by every stage'''
+
+import resource
+import pandas as pd
+
+
+# text columns with few distinct values are categories, numbers get the smallest type which holds them
+# float32 is used for the numeric features since the model converts its input to float32 anyway
+SCHEMA = {
+    # extracted columns
+    'GESLACHT': 'category', 'POSTCODE': 'category', 'WOONPLAATS': 'category', 'TIMEDIFF': 'category', 'STARTTIMEPLAN': 'category',
+    'AANKOMST': 'category', 'AGENDA': 'category', 'SUBAGENDA': 'category', 'SPECCODE': 'category', 'TARAFD': 'category',
+    'SPECIALISM': 'category', 'LOCATIONID': 'category', 'DESCRIPTION': 'category', 'IsVoldaan': 'category', 'REDEN': 'category',
+    'CONSTYPE': 'category', 'CODE': 'category', 'LEEFTIJD': 'float32', 'DUUR': 'float32', 'AfspraakstatusKey': 'Int8',
+    'VERLOSKUNDE': 'int8', 'PA': 'int8', 'INVOERDAT': 'datetime64[ns]', 'STARTDATEPLAN': 'datetime64[ns]',
+    # target and date features
+    'no_show': 'int8', 'AfspraakZelfdeDag': 'bool', 'VerschilInplannenEnAfspraak': 'int16', 'MaandAfspraak': 'int8',
+    'DagAfspraak': 'category', 'TijdAfspraak': 'float32', 'SPECIALISME': 'category', 'VerschilAankomstEnStart': 'float32',
+    # geo features
+    'LOCATIE': 'category', 'latitude': 'float32', 'longitude': 'float32', 'AFSTAND': 'float32',
+    # cumulative features
+    'num_no_shows': 'float32', 'num_appointments': 'float32', 'perc_no_shows': 'float32', 'stiptheid': 'float32',
+    'last_noshow': 'float32', 'DATE_PREV_APP': 'datetime64[ns]', 'days_since_last_appointment': 'float32',
+    'num_no_shows_spec': 'float32', 'num_appointments_spec': 'float32', 'perc_no_shows_spec': 'float32',
+    'appointment_last_week': 'int8', 'weighted_no_show_percentage': 'float32',
+}
+
+
+def is_category(series: pd.Series) -> bool:
+    '''
+    Returns True if the series is categorical
+    '''
+    return isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def to_category(series: pd.Series) -> pd.Series:
+    '''
+    Converts a series to a category with sorted categories, the same categories astype('category') gives on the raw values
+    '''
+    if not is_category(series):
+        return series.astype('category')
+    if not series.cat.categories.is_monotonic_increasing:
+        return series.cat.reorder_categories(series.cat.categories.sort_values())
+
+    return series
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Converts the columns of df which are in the schema to their declared dtype
+    Columns which already have the right dtype are left alone, so applying the schema after every stage is cheap
+    '''
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'category':
+            df[col] = to_category(df[col])
+        elif dtype.startswith('datetime64'):
+            if df[col].dtype != dtype:
+                df[col] = pd.to_datetime(df[col])
+        elif df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+
+    return df
+
+
+def union_categories(*series: pd.Series) -> list:
+    '''
+    Gives categorical series the same (sorted) categories, so they can be combined without falling back to strings
+    Series which are not categorical are returned as they are
+    '''
+    if not all(is_category(s) for s in series):
+        return list(series)
+
+    categories = series[0].cat.categories
+    for s in series[1:]:
+        categories = categories.union(s.cat.categories)
+
+    return [s.cat.set_categories(categories) for s in series]
+
+
+def concat(frames: list) -> pd.DataFrame:
+    '''
+    Concatenates frames with the schema applied, pd.concat would turn categories which differ per frame into strings
+    '''
+    frames = [df.copy(deep=False) for df in frames]   # the columns are replaced, not changed, so the data is not copied
+    for col in frames[0].columns:
+        if all(col in df.columns and is_category(df[col]) for df in frames):
+            for df, s in zip(frames, union_categories(*[df[col] for df in frames])):
+                df[col] = s
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def peak_rss_mb() -> float:
+    '''
+    Returns the peak resident memory of the process in MB
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report_memory(report: list, stage: str, df: pd.DataFrame):
+    '''
+    Appends the size of df and the peak memory of the process after a stage to report, does nothing if report is None
+    '''
+    if report is None:
+        return
+
+    report.append({'stage': stage, 'rows': len(df), 'frame_mb': df.memory_usage(deep=True).sum() / 2**20, 'peak_rss_mb': peak_rss_mb()})
+
+
+def print_memory_report(report: list):
+    '''
+    Prints the memory report per stage, stages which ran multiple times (once per batch) are combined
+    '''
+    stages = pd.DataFrame(report).groupby('stage', sort=False).agg({'rows': 'sum', 'frame_mb': 'max', 'peak_rss_mb': 'max'})
+    for stage, row in stages.iterrows():
+        print(f'{stage:<20} {row["rows"]:>10.0f} rows {row["frame_mb"]:>10.1f} MB frame {row["peak_rss_mb"]:>10.1f} MB peak rss')
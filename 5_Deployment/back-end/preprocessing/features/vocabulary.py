@@ -0,0 +1,96 @@
+'''Frozen vocabularies of the categorical features, shared by training and inference'''
+
+import os
+import json
+import pandas as pd
+import numpy as np
+
+from features import schema
+
+
+# categorical features of the model
+CATEGORICAL_FEATURES = ['GESLACHT', 'POSTCODE', 'WOONPLAATS', 'AGENDA', 'DESCRIPTION', 'CONSTYPE', 'CODE', 'SPECIALISME', 'LOCATIE',
+                        'DagAfspraak', 'AfspraakZelfdeDag']
+
+# values which were not seen during training get the code after the last known value
+UNKNOWN = '<unknown>'
+
+
+def build_vocabularies(df: pd.DataFrame, columns: list = CATEGORICAL_FEATURES) -> dict:
+    '''
+    Returns per column the sorted values present in df
+    These are the categories astype('category') gives, so the codes are the same as those of a model trained on astype('category')
+    '''
+    vocabularies = {}
+    for col in columns:
+        series = df[col]
+        if schema.is_category(series):
+            values = series.cat.remove_unused_categories().cat.categories
+        else:
+            values = pd.Index(series.dropna().unique()).sort_values()
+        vocabularies[col] = values.tolist()
+
+    return vocabularies
+
+
+def get_codes(series: pd.Series, known: pd.Index) -> np.ndarray:
+    '''
+    Returns the position of every value of series in the vocabulary known, unseen values get len(known) and missing values -1
+    Categorical series are looked up through their categories, so the values themselves are never compared
+    '''
+    if schema.is_category(series):
+        lookup = known.get_indexer(series.cat.categories)
+        lookup[lookup == -1] = len(known)
+        # the code -1 of missing values picks the -1 appended at the end
+        return np.append(lookup, -1)[series.cat.codes.to_numpy()]
+
+    codes = known.get_indexer(series)
+    codes[(codes == -1) & series.notna().to_numpy()] = len(known)
+    return codes
+
+
+def get_categories(values: list) -> pd.Index:
+    '''
+    Returns the categories of an encoded column: the values of the vocabulary as strings, followed by the unknown bucket
+    xgboost (>= 3) only accepts categories of a single type, the codes are looked up on the values themselves so they do not change
+    '''
+    return pd.Index([str(value) for value in values] + [UNKNOWN], dtype=object)
+
+
+def encode(df: pd.DataFrame, vocabularies: dict) -> pd.DataFrame:
+    '''
+    Encodes the columns in vocabularies to categories with the frozen vocabulary followed by the unknown bucket (see get_categories)
+    The code of a value is its position in the vocabulary, unseen values get code len(vocabulary) and missing values stay missing
+    '''
+    for col, values in vocabularies.items():
+        codes = get_codes(df[col], pd.Index(values))
+        df[col] = pd.Categorical.from_codes(codes, categories=get_categories(values))
+
+    return df
+
+
+def get_vocabularies_path(model_path: str) -> str:
+    '''
+    Returns the path of the vocabularies which belong to a model, these are saved next to the model
+    '''
+    return f'{os.path.splitext(model_path)[0]}_vocabularies.json'
+
+
+def save_vocabularies(vocabularies: dict, path: str):
+    '''
+    Saves the vocabularies as json, next to the model they belong to (see get_vocabularies_path)
+    '''
+    with open(path, 'w') as f:
+        json.dump(vocabularies, f, indent=1)
+
+
+def load_vocabularies(path: str) -> dict:
+    '''
+    Loads the vocabularies, returns None if the model has no vocabularies saved
+    '''
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
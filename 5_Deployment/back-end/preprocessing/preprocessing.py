@@ -1,13 +1,19 @@
 import pandas as pd
+import numpy as np
 import sys
 import time
 
-from features import datetime, geographic, cumulative, misc
+from features import datetime, geographic, cumulative, misc, history_store, schema, vocabulary, instrumentation
 from cleaning import cleaning
 
 
+# postal codes of the Netherlands (geonames), the coordinates and distances are looked up in an index built from this file
+ZIP_CODES_PATH = '/app/py/NL.txt'
 
-def preprocess_noshow_data(df_data: pd.DataFrame, hist_years: int, n_appointments: int, training: bool = False) -> pd.DataFrame:
+
+def preprocess_noshow_data(df_data: pd.DataFrame, hist_years: int, n_appointments: int, training: bool = False, store: dict = None,
+                           extended_features: bool = False, memory_report: list = None, metrics: list = None,
+                           exclude_days_per_date: pd.Series = None) -> pd.DataFrame:
     '''
     Preprocesses all of the data so that it can be used for training or inference
 
@@ -27,6 +33,19 @@ def preprocess_noshow_data(df_data: pd.DataFrame, hist_years: int, n_appointment
         Boolean to indicate if the preprocessing is for training
         If training=True the target variable is attached to the dataframe
         If training=False the target variable is not attached to the dataframe
+    store : dict
+        History store (see features/history_store.py) holding the appointments before df_data
+        If given, the cumulative features are calculated from the store combined with df_data,
+        so df_data only has to contain the appointments since the store was last updated
+    extended_features : bool
+        Boolean to indicate if the extended history features are added (see cumulative.calculate_cum_features)
+        These are the specialism level and decay weighted no show features
+    memory_report : list
+        If given, the size of the dataframe and the peak memory after every stage are appended (see features/schema.py)
+    metrics : list
+        If given, the time, rows and peak memory of every function are appended (see features/instrumentation.py)
+    exclude_days_per_date : pd.Series
+        Number of days left out of the history per date (indexed by date) instead of 3, for dates predicted further ahead
     
     Returns
     -------
@@ -34,36 +53,67 @@ def preprocess_noshow_data(df_data: pd.DataFrame, hist_years: int, n_appointment
         Dataframe containing the preprocessed data
         Only the features for modelling are returned
     '''
+    # the declared dtypes are applied at the start and after every stage
+    timed = lambda stage, func, *args, **kwargs: instrumentation.timed(metrics, stage, func, *args, **kwargs)
+    df_data = timed('schema.apply_schema', schema.apply_schema, df_data)
+    schema.report_memory(memory_report, 'ingest', df_data)
+
     # removing data not suitable for prediction
-    df_data = cleaning.clean_data(df_data)
+    df_data = timed('cleaning.clean_data', cleaning.clean_data, df_data)
     df_data = df_data[df_data['CONSTYPE'].isin(['H', 'E', 'V', '*'])]
 
     # get target variable
-    df_data = misc.process_target_variable(df_data)  
+    df_data = timed('misc.process_target_variable', misc.process_target_variable, df_data)
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'cleaning', df_data)
 
     # get date features
-    df_data['AfspraakZelfdeDag'] = datetime.has_appointment_same_day(df_data)
-    df_data['VerschilInplannenEnAfspraak'] = datetime.difference_scheduling_and_appointment(df_data)
+    df_data['AfspraakZelfdeDag'] = timed('datetime.has_appointment_same_day', datetime.has_appointment_same_day, df_data)
+    df_data['VerschilInplannenEnAfspraak'] = timed('datetime.difference_scheduling_and_appointment', datetime.difference_scheduling_and_appointment,
+                                                   df_data)
     df_data = df_data[df_data['VerschilInplannenEnAfspraak']  >= 3]   # at inference we are predicting appointments over 3 days
-    df_data['MaandAfspraak'] = datetime.fetch_month(df_data['STARTDATEPLAN'])
-    df_data['DagAfspraak'] = datetime.fetch_weekday(df_data['STARTDATEPLAN'])
-    df_data['TijdAfspraak'] = datetime.fetch_appointment_hour(df_data['STARTTIMEPLAN'])
-    df_data['SPECIALISME'] = misc.get_specialism(df_data)
-    df_data['VerschilAankomstEnStart'] = datetime.difference_scheduling_and_arrival(df_data, treshold=60)
+    df_data['MaandAfspraak'] = timed('datetime.fetch_month', datetime.fetch_month, df_data['STARTDATEPLAN'])
+    df_data['DagAfspraak'] = timed('datetime.fetch_weekday', datetime.fetch_weekday, df_data['STARTDATEPLAN'])
+    df_data['TijdAfspraak'] = timed('datetime.fetch_appointment_hour', datetime.fetch_appointment_hour, df_data['STARTTIMEPLAN'])
+    df_data['SPECIALISME'] = timed('misc.get_specialism', misc.get_specialism, df_data)
+    df_data['VerschilAankomstEnStart'] = timed('datetime.difference_scheduling_and_arrival', datetime.difference_scheduling_and_arrival, df_data,
+                                               treshold=60)
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'date features', df_data)
 
     # get geo features
-    df_data['POSTCODE'] = geographic.extract_zipcode(df_data['POSTCODE'])
-    df_data['LOCATIE'] = df_data['DESCRIPTION'].apply(geographic.get_location)
-    zip_codes = geographic.get_all_nl_zip_codes('/app/py/NL.txt')
-    df_data = df_data.merge(zip_codes, how='left', left_on='POSTCODE', right_index=True)
-    df_data['AFSTAND'] = geographic.haversine_distance(df_data['LOCATIE'], df_data['latitude'], df_data['longitude'])
+    df_data['POSTCODE'] = timed('geographic.extract_zipcode', geographic.extract_zipcode, df_data['POSTCODE'])
+    df_data['LOCATIE'] = timed('geographic.get_locations', geographic.get_locations, df_data['DESCRIPTION'])
+    zip_code_index = geographic.load_zip_code_index(ZIP_CODES_PATH)   # precomputed coordinates and distances per postal code
+    zip_code_features = timed('geographic.lookup_zip_codes', geographic.lookup_zip_codes, zip_code_index, df_data['POSTCODE'], df_data['LOCATIE'])
+    for col in ['latitude', 'longitude', 'AFSTAND']:
+        df_data[col] = zip_code_features[col]
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'geo features', df_data)
 
     # get cumulative features
-    df_data = cumulative.calculate_cum_features(df_data, history_years=hist_years, exclude_days=3)
+    if store is None:
+        df_data = timed('cumulative.calculate_cum_features', cumulative.calculate_cum_features, df_data, history_years=hist_years, exclude_days=3,
+                        extended=extended_features, exclude_days_per_date=exclude_days_per_date)
+    else:
+        df_data = timed('history_store.calculate_cum_features_from_store', history_store.calculate_cum_features_from_store, store, df_data,
+                        history_years=hist_years, exclude_days=3, extended=extended_features, exclude_days_per_date=exclude_days_per_date)
     df_data = df_data[df_data['num_appointments'] >= n_appointments]   # remove appointments having a history less than n_appointments
+    df_data = schema.apply_schema(df_data)
+    schema.report_memory(memory_report, 'cumulative features', df_data)
 
     return df_data
     # return misc.get_feature_df(df_data, training=training)
+
+
+def hash_partitions(patients: pd.Series, n_partitions: int) -> np.ndarray:
+    '''
+    Returns the partition of every row based on a hash of the patient number
+    All appointments of a patient end up in the same partition, and a patient is in the same partition in every run
+    '''
+    hashes = pd.util.hash_pandas_object(patients.astype(str), index=False).to_numpy()
+
+    return (hashes % n_partitions).astype(np.int64)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+'''Local registry of model versions: the boosters in their native format and a manifest with the versions, their checksums and the active version'''
+
+import os
+import sys
+import json
+import hashlib
+import joblib
+import numpy as np
+import pandas as pd
+import xgboost
+
+sys.path.insert(0, '/app/preprocessing')
+from features import vocabulary
+
+
+MANIFEST = 'manifest.json'
+
+
+def load_manifest(registry_dir: str) -> dict:
+    '''
+    Returns the manifest of the registry, an empty manifest if nothing is registered yet
+    '''
+    path = os.path.join(registry_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'active': None, 'versions': {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(registry_dir: str, manifest: dict):
+    '''
+    Writes the manifest next to the old one first and then swaps it, so a running back end never reads a half written manifest
+    '''
+    path = os.path.join(registry_dir, MANIFEST)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f'{path}.tmp', path)
+
+
+def get_checksum(path: str) -> str:
+    '''
+    Returns the sha256 of a file, read in blocks of 1 MB
+    '''
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def get_params(model) -> dict:
+    '''
+    Returns the parameters of the XGBClassifier which can be saved as json, the others are left to their defaults when it is loaded
+    '''
+    return {key: value for key, value in model.get_params().items()
+            if isinstance(value, (bool, int, str)) or (isinstance(value, float) and not np.isnan(value))}
+
+
+def register_model(registry_dir: str, model, vocabularies: dict, version: str, activate: bool = False, source: str = None) -> dict:
+    '''
+    Saves the booster of a fitted XGBClassifier as a version in the registry, in the native (ubjson) format of xgboost
+    The manifest gets the features, the vocabularies and the checksum of the version. The version only becomes active with activate
+    Returns the manifest entry of the version
+    '''
+    manifest = load_manifest(registry_dir)
+    if version in manifest['versions']:
+        raise ValueError(f'Version {version} is already registered')
+
+    os.makedirs(registry_dir, exist_ok=True)
+    file = f'{version}.ubj'
+    booster = model.get_booster()
+    booster.save_model(os.path.join(registry_dir, file))
+
+    entry = {'file': file, 'sha256': get_checksum(os.path.join(registry_dir, file)), 'registered': pd.Timestamp.now().isoformat(),
+             'source': source, 'features': booster.feature_names, 'feature_types': booster.feature_types, 'params': get_params(model),
+             'vocabularies': vocabularies}
+    manifest['versions'][version] = entry
+    if activate:
+        manifest['active'] = version
+    save_manifest(registry_dir, manifest)
+
+    return entry
+
+
+def activate_version(registry_dir: str, version: str):
+    '''
+    Points the registry to version, a running back end picks it up before its next run
+    '''
+    manifest = load_manifest(registry_dir)
+    if version not in manifest['versions']:
+        raise ValueError(f'Version {version} is not registered in {registry_dir}')
+    manifest['active'] = version
+    save_manifest(registry_dir, manifest)
+
+
+def get_active_version(registry_dir: str) -> str:
+    '''
+    Returns the active version of the registry, None if no version is active
+    '''
+    return load_manifest(registry_dir)['active']
+
+
+def load_version(registry_dir: str, version: str = None) -> tuple:
+    '''
+    Loads a version (the active version if None) as an XGBClassifier which predicts on the cpu, after checking its checksum
+    Returns the version, the model and its vocabularies
+    '''
+    manifest = load_manifest(registry_dir)
+    version = manifest['active'] if version is None else version
+    if version not in manifest['versions']:
+        raise ValueError(f'No version {version} in {registry_dir}')
+
+    entry = manifest['versions'][version]
+    path = os.path.join(registry_dir, entry['file'])
+    if get_checksum(path) != entry['sha256']:
+        raise ValueError(f'The checksum of {path} does not match the manifest')
+
+    model = xgboost.XGBClassifier(**dict(entry['params'], device='cpu'))
+    model.load_model(path)
+    if model.get_booster().feature_names != entry['features']:
+        raise ValueError(f'The features of {path} do not match the manifest')
+
+    return version, model, entry['vocabularies']
+
+
+if __name__ == '__main__':
+    # python3 registry.py register <model.joblib> <registry_dir> [--version=<version>] [--activate]
+    #   registers a model saved by the training notebook, train.py or refresh.py with its vocabularies, the version defaults to the file name
+    # python3 registry.py activate <registry_dir> <version>
+    # python3 registry.py list <registry_dir>
+    command = sys.argv[1]
+    options = dict(arg[2:].split('=', 1) if '=' in arg else (arg[2:], True) for arg in sys.argv[2:] if arg.startswith('--'))
+
+    if command == 'register':
+        model_path, registry_dir = sys.argv[2:4]
+        vocabularies = vocabulary.load_vocabularies(vocabulary.get_vocabularies_path(model_path))
+        if vocabularies is None:
+            raise ValueError('The registry needs the vocabularies of the model')
+        version = options.get('version', os.path.splitext(os.path.basename(model_path))[0])
+        register_model(registry_dir, joblib.load(model_path), vocabularies, version, activate='activate' in options, source=model_path)
+        print(f'Registered {model_path} as version {version}{" (active)" if "activate" in options else ""}')
+    elif command == 'activate':
+        registry_dir, version = sys.argv[2:4]
+        activate_version(registry_dir, version)
+        print(f'Version {version} is active')
+    elif command == 'list':
+        manifest = load_manifest(sys.argv[2])
+        for version, entry in manifest['versions'].items():
+            print(f'{"*" if version == manifest["active"] else " "} {version:<40} {entry["registered"]:<30} {entry["source"]}')
+    else:
+        raise ValueError(f'Unknown command {command}, use register, activate or list')
@@ -0,0 +1,217 @@
+import hmac
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from back_end import *
+import inference
+
+# model input of the requests waiting to be predicted, as (matrix, future, time put in the queue, predictor), see inference.to_matrix
+PENDING = queue.Queue()
+STATS = {'requests': 0, 'predict_calls': 0, 'predicted_rows': 0}
+STATS_LOCK = threading.Lock()
+
+
+def get_serving(version, model, vocabularies, n_threads):
+    '''
+    The version, vocabularies and predictor a request is scored with, they are swapped together by replacing the whole dict
+    '''
+    return {'version': version, 'vocabularies': vocabularies, 'predictor': inference.get_predictor(model, vocabularies, n_threads=n_threads)}
+
+def predict_batch(predictor, batch):
+    '''
+    Predicts the stacked matrices of a batch of requests in one call of the booster and sets the futures of the requests
+    '''
+    n_rows = sum(len(matrix) for matrix, _, _, _ in batch)
+    start = time.perf_counter()
+    try:
+        matrix = batch[0][0] if len(batch) == 1 else np.concatenate([matrix for matrix, _, _, _ in batch], out=inference.get_buffer(predictor, n_rows))
+        pred = inference.predict_matrix(predictor, matrix)
+    except Exception as e:
+        for _, future, _, _ in batch:
+            future.set_exception(e)
+        return
+    end = time.perf_counter()
+
+    with STATS_LOCK:
+        STATS['predict_calls'] += 1
+        STATS['predicted_rows'] += n_rows
+    bounds = np.cumsum([0] + [len(matrix) for matrix, _, _, _ in batch])
+    for (_, future, queued, _), first, last in zip(batch, bounds[:-1], bounds[1:]):
+        future.set_result({'pred': pred[first:last], 'queue_ms': (start - queued) * 1000, 'predict_ms': (end - start) * 1000,
+                           'batch_requests': len(batch), 'batch_rows': n_rows})
+
+def batch_predictions(config, max_batch_rows, max_wait_ms):
+    '''
+    Combines the model input of concurrent requests into one call of the booster, runs in its own thread
+    After the first request arrives it waits at most max_wait_ms for other requests, or until max_batch_rows rows are collected.
+    Between batches, at most every model_check_s seconds, a newly activated version of the model registry is swapped in (see load_new_version).
+    Requests which were encoded before the swap are still predicted by the predictor of their own vocabularies, never stacked with newer requests
+    '''
+    global serving
+    check_s = config.get('model_check_s', 60)
+    last_check = time.perf_counter()
+    while True:
+        if time.perf_counter() - last_check >= check_s:
+            last_check = time.perf_counter()
+            loaded = load_new_version(config, serving['version'])
+            if loaded is not None:
+                serving = get_serving(*loaded, n_threads=config.get('inference_threads', 1))
+                print(f'Switched to model version {serving["version"]}')
+
+        # wakes up without requests as well, so an idle service swaps before its next request
+        try:
+            batch = [PENDING.get(timeout=check_s)]
+        except queue.Empty:
+            continue
+        n_rows = len(batch[0][0])
+        deadline = time.perf_counter() + max_wait_ms / 1000
+        while n_rows < max_batch_rows:
+            try:
+                batch.append(PENDING.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+            n_rows += len(batch[-1][0])
+
+        for predictor in {id(request[3]): request[3] for request in batch}.values():
+            predict_batch(predictor, [request for request in batch if request[3] is predictor])
+
+def get_request_appointments(config, request):
+    '''
+    Gets the appointments of a request, as a list of batches, and the date to predict
+    The request contains either the appointment rows themselves (columns of APPOINTMENTS_QUERY, including the history of the patients),
+    or patients and/or agendas whose appointments over n_days (or on date) are extracted from the database in batches of batch_size patients
+    '''
+    if 'appointments' in request:
+        df = pd.DataFrame(request['appointments'])
+        pred_date = pd.Timestamp(request['date']) if 'date' in request else None   # default the last date in the rows
+        return [df], pred_date
+
+    today = pd.Timestamp.today().normalize()
+    if 'date' in request:
+        n_days = (pd.Timestamp(request['date']) - today).days
+    else:
+        n_days = request.get('n_days', days_from_today())
+    if n_days is None:
+        raise ValueError('No prediction date in the weekend, give date or n_days')
+
+    connect = lambda: get_db_connection(config['driver'], config['server'], config['database'], config['user'], config['password'], config['port'])
+    patients = request.get('patients')
+    if not patients:
+        conn = connect()
+        try:
+            patients = get_target_patients_from_db(conn, n_days, agendas=request.get('agendas'))
+        finally:
+            conn.close()
+    # the database accepts at most 2100 parameters per query, so the patients are always extracted in batches
+    batches = list(iter_appointment_batches(connect, patients, n_days, 10, batch_size=config.get('batch_size', 500),
+                                            n_connections=config.get('n_connections', 4)))
+
+    return batches, today + pd.Timedelta(days=n_days)
+
+def score_request(config, request):
+    '''
+    Preprocesses and predicts the appointments of a request, the predictions themselves are made in batch_predictions
+    Returns the model version, the predictions sorted on prediction and the time spent in every step
+    '''
+    start = time.perf_counter()
+    batches, pred_date = get_request_appointments(config, request)
+    extracted = time.perf_counter()
+
+    df_predict = pd.DataFrame(columns=PREDICTION_COLUMNS)
+    result = {}
+    prepared = extracted
+    current = serving   # the version of the whole request, even if a new version is swapped in meanwhile
+    df_preprocessed = preprocess_batches(batches, extended_features=config.get('extended_features', False))
+    if df_preprocessed is not None:
+        df_predict, _ = select_appointments(df_preprocessed, current['vocabularies'], agendas=request.get('agendas'), pred_date=pred_date)
+        matrix = inference.to_matrix(current['predictor'], df_predict)
+        prepared = time.perf_counter()
+        if len(matrix) > 0:
+            future = Future()
+            PENDING.put((matrix, future, time.perf_counter(), current['predictor']))
+            result = future.result()
+            df_predict['PREDICTIE'] = result.pop('pred')
+            df_predict = df_predict.sort_values(by='PREDICTIE', ascending=False)[PREDICTION_COLUMNS]
+    end = time.perf_counter()
+
+    with STATS_LOCK:
+        STATS['requests'] += 1
+    # queue_ms and predict_ms are the waiting time for and the duration of the combined predict_proba call
+    latency = {'extract_ms': (extracted - start) * 1000, 'preprocess_ms': (prepared - extracted) * 1000, **result,
+               'total_ms': (end - start) * 1000}
+
+    return {'model': current['version'], 'predictions': json.loads(df_predict.to_json(orient='records', date_format='iso')), 'latency': latency}
+
+
+LOCAL_HOSTS = ['127.0.0.1', 'localhost', '::1']
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''
+    POST /predict scores the appointments of the request (see get_request_appointments), GET /health returns the counters of the service
+    The predictions contain patient data, so /predict needs the header "Authorization: Bearer <service_token>" if a token is set
+    '''
+    def is_authorized(self):
+        token = self.server.config.get('service_token')
+        if not token:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': f'Unknown path {self.path}'})
+        self.send_json(200, {'model': serving['version'], **STATS})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.send_json(404, {'error': f'Unknown path {self.path}'})
+        if not self.is_authorized():
+            return self.send_json(401, {'error': 'Missing or wrong bearer token'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            response = score_request(self.server.config, request)
+        except (ValueError, KeyError) as e:
+            return self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+        except Exception as e:
+            return self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+        self.send_json(200, response)
+
+
+if __name__ == '__main__':
+    # load config
+    config_path = './config.yaml'
+    with open(config_path) as stream:
+        config = yaml.safe_load(stream)
+
+    # the model, the vocabularies and the zip code index stay in memory, a new active version of the registry is swapped in by batch_predictions
+    model_version, model, vocabularies = load_model(config)
+    if vocabularies is None:
+        raise ValueError('The scoring service needs the vocabularies of the model, requests which are predicted together have to share the encoding')
+    geographic.load_zip_code_index(ZIP_CODES_PATH)
+    serving = get_serving(model_version, model, vocabularies, n_threads=config.get('inference_threads', 1))
+
+    threading.Thread(target=batch_predictions, args=(config, config.get('max_batch_rows', 10000), config.get('max_wait_ms', 10)), daemon=True).start()
+
+    host = config.get('service_host', '127.0.0.1')
+    if host not in LOCAL_HOSTS and not config.get('service_token'):
+        raise ValueError(f'The scoring service returns patient data, it only listens on {host} with a service_token')
+    server = ThreadingHTTPServer((host, config.get('service_port', 5555)), ScoringHandler)
+    server.config = config
+    print(f'Scoring service started on {server.server_address[0]}:{server.server_address[1]}')
+    server.serve_forever()
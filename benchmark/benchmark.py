@@ -0,0 +1,191 @@
+'''Benchmarks every stage of the pipeline on synthetic appointments and saves the results, so they can be compared between commits'''
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, '5_Deployment', 'back-end', 'preprocessing'))
+sys.path.insert(0, os.path.join(ROOT, '5_Deployment', 'back-end'))
+
+import joblib
+import xgboost
+import back_end
+import inference
+import preprocessing
+from features import datetime, geographic, cumulative, misc, schema, vocabulary
+from cleaning import cleaning
+
+import synthetic
+
+
+def time_stage(results: list, stage: str, size: int, func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs) and appends its duration to results, returns the output of func
+    size is the number of generated appointments, rows the length of the first dataframe or series the stage got (after the filters of the earlier stages)
+    '''
+    rows = next((len(arg) for arg in args if isinstance(arg, (pd.DataFrame, pd.Series))), size)
+    start = time.perf_counter()
+    output = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    results.append({'stage': stage, 'size': size, 'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds > 0 else None,
+                    'peak_rss_mb': schema.peak_rss_mb()})
+    print(f'{stage:<50} {size:>10} {rows:>10} rows {seconds:>10.3f} s')
+
+    return output
+
+
+def benchmark_preprocessing(results: list, df: pd.DataFrame, size: int) -> pd.DataFrame:
+    '''
+    Times every function of the preprocessing (see preprocessing.preprocess_noshow_data) in the order of the pipeline
+    Returns the preprocessed appointments
+    '''
+    df = time_stage(results, 'schema.apply_schema', size, schema.apply_schema, df)
+    df['SPECIALISME'] = time_stage(results, 'misc.get_specialism', size, misc.get_specialism, df)
+
+    df = time_stage(results, 'cleaning.clean_data', size, cleaning.clean_data, df)
+    df = df[df['CONSTYPE'].isin(['H', 'E', 'V', '*'])]
+    df = time_stage(results, 'misc.process_target_variable', size, misc.process_target_variable, df)
+    df = schema.apply_schema(df)
+
+    df['AfspraakZelfdeDag'] = time_stage(results, 'datetime.has_appointment_same_day', size, datetime.has_appointment_same_day, df)
+    df['VerschilInplannenEnAfspraak'] = time_stage(results, 'datetime.difference_scheduling_and_appointment', size,
+                                                   datetime.difference_scheduling_and_appointment, df)
+    df = df[df['VerschilInplannenEnAfspraak'] >= 3]
+    df['MaandAfspraak'] = time_stage(results, 'datetime.fetch_month', size, datetime.fetch_month, df['STARTDATEPLAN'])
+    df['DagAfspraak'] = time_stage(results, 'datetime.fetch_weekday', size, datetime.fetch_weekday, df['STARTDATEPLAN'])
+    df['TijdAfspraak'] = time_stage(results, 'datetime.fetch_appointment_hour', size, datetime.fetch_appointment_hour, df['STARTTIMEPLAN'])
+    df['SPECIALISME'] = misc.get_specialism(df)
+    df['VerschilAankomstEnStart'] = time_stage(results, 'datetime.difference_scheduling_and_arrival', size,
+                                               datetime.difference_scheduling_and_arrival, df, treshold=60)
+    df = schema.apply_schema(df)
+
+    df['POSTCODE'] = time_stage(results, 'geographic.extract_zipcode', size, geographic.extract_zipcode, df['POSTCODE'])
+    df['LOCATIE'] = time_stage(results, 'geographic.get_locations', size, geographic.get_locations, df['DESCRIPTION'])
+    geographic.load_zip_code_index.cache_clear()
+    zip_code_index = time_stage(results, 'geographic.load_zip_code_index', size, geographic.load_zip_code_index, preprocessing.ZIP_CODES_PATH)
+    zip_code_features = time_stage(results, 'geographic.lookup_zip_codes', size, geographic.lookup_zip_codes, zip_code_index,
+                                   df['POSTCODE'], df['LOCATIE'])
+    for col in ['latitude', 'longitude', 'AFSTAND']:
+        df[col] = zip_code_features[col]
+    df = schema.apply_schema(df)
+
+    time_stage(results, 'cumulative.calculate_cum_features (extended)', size, cumulative.calculate_cum_features, df, history_years=10,
+               exclude_days=3, extended=True)
+    df = time_stage(results, 'cumulative.calculate_cum_features', size, cumulative.calculate_cum_features, df, history_years=10, exclude_days=3)
+
+    return schema.apply_schema(df)
+
+
+def fit_stand_in_model(df: pd.DataFrame, vocabularies: dict):
+    '''
+    Fits a model with the parameters of the training notebook on preprocessed synthetic appointments
+    Used when no model is given, the time a prediction takes depends on the size of the model and not on its quality
+    '''
+    features = vocabulary.encode(misc.get_feature_df(df, training=False).copy(), vocabularies)
+    model = xgboost.XGBClassifier(enable_categorical=True, tree_method='hist', learning_rate=0.15, max_cat_to_onehot=25, max_cat_threshold=5,
+                                  reg_alpha=10, scale_pos_weight=0.5, n_estimators=350)
+
+    return model.fit(features, df['no_show'])
+
+
+def benchmark_prediction(results: list, df: pd.DataFrame, size: int, model, vocabularies: dict):
+    '''
+    Times the prediction of the last day (back_end.predict) and of all appointments, and the A/B groups of all appointments
+    '''
+    back_end.model = model
+    time_stage(results, 'back_end.predict', size, back_end.predict, df, vocabularies, agendas=None)
+
+    features = time_stage(results, 'vocabulary.encode', size, vocabulary.encode, misc.get_feature_df(df, training=False).copy(), vocabularies)
+    pred = time_stage(results, 'model.predict_proba', size, model.predict_proba, features)[:,1]
+    predictor = inference.get_predictor(model, vocabularies, n_threads=os.cpu_count())
+    time_stage(results, 'inference.predict_proba', size, inference.predict_proba, predictor, df)
+
+    df_predicted = df[[col for col in back_end.PREDICTION_COLUMNS if col != 'PREDICTIE']].copy()
+    df_predicted['PREDICTIE'] = pred
+    df_predicted = df_predicted.sort_values(by='PREDICTIE', ascending=False).reset_index(drop=True)
+    time_stage(results, 'back_end.assign_groups', size, back_end.assign_groups, df_predicted)
+    top_n = {spec: 20 for spec in df_predicted['SPECIALISM'].dropna().unique()}
+    time_stage(results, 'back_end.assign_groups (all specialisms)', size, back_end.assign_groups, df_predicted, top_n=top_n)
+
+
+def get_commit() -> str:
+    '''
+    Returns the commit of the repository, with -dirty if there are uncommitted changes
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return f'{commit}-dirty' if dirty else commit
+
+
+def run_benchmarks(sizes: list, model=None, vocabularies: dict = None, seed: int = 0) -> dict:
+    '''
+    Benchmarks the pipeline on synthetic appointments of every size, returns the results with the commit and the environment
+    Without a model a stand-in model is fitted on the first size
+    '''
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        preprocessing.ZIP_CODES_PATH = os.path.join(tmp, 'NL.txt')
+        synthetic.write_zip_codes(preprocessing.ZIP_CODES_PATH, seed=seed)
+
+        for size in sizes:
+            df = time_stage(results, 'synthetic.make_appointments', size, synthetic.make_appointments, size, seed=seed)
+            time_stage(results, 'back_end.preprocess', size, back_end.preprocess, df.copy())
+            df = benchmark_preprocessing(results, df, size)
+
+            if model is None:
+                vocabularies = vocabulary.build_vocabularies(df)
+                model = fit_stand_in_model(df, vocabularies)
+            benchmark_prediction(results, df, size, model, vocabularies)
+
+    return {'commit': get_commit(), 'date': pd.Timestamp.now().isoformat(), 'machine': platform.node(), 'cpu_count': os.cpu_count(),
+            'versions': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__, 'xgboost': xgboost.__version__},
+            'seed': seed, 'results': results}
+
+
+def compare_results(old: dict, new: dict, threshold: float = 1.1) -> pd.DataFrame:
+    '''
+    Compares the duration of every stage and size of two runs, stages which take more than threshold times as long are regressions
+    '''
+    keys = ['stage', 'size']
+    df = pd.DataFrame(old['results'])[keys + ['seconds']].merge(pd.DataFrame(new['results'])[keys + ['seconds']], on=keys,
+                                                                 suffixes=('_old', '_new'))
+    df['ratio'] = df['seconds_new'] / df['seconds_old']
+    df['regression'] = df['ratio'] > threshold
+
+    return df
+
+
+if __name__ == '__main__':
+    # python benchmark.py <results.json> [--sizes=100000,1000000,10000000] [--seed=0] [--model=<model.joblib>] [--compare=<old results.json>]
+    output_path = sys.argv[1]
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--') and '=' in arg)
+    sizes = [int(size) for size in options.get('sizes', '100000,1000000,10000000').split(',')]
+
+    model, vocabularies = None, None
+    if 'model' in options:
+        model = joblib.load(options['model'])
+        vocabularies = vocabulary.load_vocabularies(vocabulary.get_vocabularies_path(options['model']))
+        if vocabularies is None:
+            raise ValueError('The benchmark needs the vocabularies of the model')
+
+    run = run_benchmarks(sizes, model, vocabularies, seed=int(options.get('seed', 0)))
+    with open(output_path, 'w') as f:
+        json.dump(run, f, indent=1)
+    print(f'Results saved to {output_path}')
+
+    if 'compare' in options:
+        with open(options['compare']) as f:
+            comparison = compare_results(json.load(f), run)
+        print(comparison.to_string(index=False, float_format='%.3f'))
@@ -0,0 +1,226 @@
+'''Seeded generator of synthetic HiX like appointments, to measure the pipeline without the production data'''
+
+import numpy as np
+import pandas as pd
+
+
+# columns of the export of 1_DataExtraction/no_show_query.sql
+EXPORT_COLUMNS = ['PATIENTNR', 'MERGED', 'IsTestPatient', 'GESLACHT', 'POSTCODE', 'WOONPLAATS', 'LEEFTIJD', 'TIMEDIFF', 'INVOERDAT',
+                  'STARTDATEPLAN', 'STARTTIMEPLAN', 'AANKOMST', 'AGENDA', 'SUBAGENDA', 'SPECCODE', 'TARAFD', 'LOCATIONID', 'DESCRIPTION',
+                  'IsVoldaan', 'AfspraakstatusKey', 'REDEN', 'CONSTYPE', 'CODE', 'MEMO', 'OMSCHR', 'DUUR']
+
+# columns of APPOINTMENTS_QUERY in 5_Deployment/back-end/back_end.py (get_appointments_from_db)
+APPOINTMENTS_COLUMNS = ['PATIENTNR', 'GESLACHT', 'POSTCODE', 'WOONPLAATS', 'LEEFTIJD', 'INVOERDAT', 'STARTDATEPLAN', 'STARTTIMEPLAN',
+                        'AANKOMST', 'AGENDA', 'SPECCODE', 'TARAFD', 'SPECIALISM', 'LOCATIONID', 'DESCRIPTION', 'CONSTYPE', 'CODE', 'DUUR',
+                        'REDEN', 'GEBDAT', 'NAAM', 'IsVoldaan', 'AfspraakstatusKey', 'VERLOSKUNDE', 'PA']
+
+# agenda, specialism and share of the appointments, the emergency and radiology agendas are removed by the cleaning
+AGENDAS = [('CSA001', 'INT', 0.10), ('CSA002', 'CAR', 0.08), ('CSA003', 'CHI', 0.10), ('CSA004', 'NEU', 0.06), ('CSA005', 'LON', 0.06),
+           ('CSA006', 'GYN', 0.08), ('CSA007', 'URO', 0.06), ('CSA008', 'DER', 0.07), ('CSA009', 'KIN', 0.06), ('CSA010', 'OOG', 0.08),
+           ('CSA011', 'KNO', 0.06), ('CSA012', 'MDL', 0.05), ('CSA013', 'REU', 0.04), ('CSA014', 'ORT', 0.04), ('CSA015', 'PLA', 0.02),
+           ('CSA016', 'SEH', 0.02), ('CSA017', 'RAD', 0.02)]
+
+# location of the appointment and share of the appointments, the last ones are not at ZGT and are removed by the cleaning
+LOCATIONS = [('ZGT locatie Almelo', 'ZH0001', 0.44), ('ZGT locatie Hengelo', 'ZH0002', 0.40), ('Behandelcentrum Almelo', 'ZH0003', 0.03),
+             ('Behandelcentrum Hengelo', 'ZH0004', 0.03), ('Oncologisch centrum Hengelo', 'ZH0005', 0.02),
+             ('Slaapcentrum Hengelo', 'ZH0006', 0.01), ('Polikliniek Verloskunde Almelo', 'ZH0007', 0.01),
+             ('Obesitas centrum Hengelo ZGT', 'ZH0008', 0.01), ('Huisartsenpost Wierden', 'EX0001', 0.02), (None, None, 0.03)]
+
+# place of residence, its postal code range and share of the patients, the last one is for patients from outside the region
+TOWNS = [('Hengelo', 7550, 7559, 0.25), ('Almelo', 7600, 7609, 0.22), ('Enschede', 7511, 7548, 0.10), ('Borne', 7620, 7623, 0.06),
+         ('Wierden', 7640, 7642, 0.05), ('Vriezenveen', 7670, 7672, 0.05), ('Nijverdal', 7440, 7443, 0.05), ('Rijssen', 7460, 7463, 0.05),
+         ('Oldenzaal', 7570, 7577, 0.05), ('Delden', 7490, 7491, 0.03), ('Goor', 7470, 7472, 0.03), ('Tubbergen', 7650, 7651, 0.03),
+         ('Zwolle', 8000, 8049, 0.03)]
+
+# appointment code, its description and share, HB, TC and NB are call consultations which are removed by the cleaning
+CODES = [('NP', 'Nieuwe patient', 0.15), ('HP', 'Herhaalpolikliniek', 0.45), ('CO', 'Controle', 0.15), ('CV', 'Consult vervolg', 0.10),
+         ('ON', 'Onderzoek', 0.05), ('HB', 'Herhaal beeldbellen', 0.05), ('TC', 'Telefonisch consult', 0.04), ('NB', 'Nabellen', 0.01)]
+
+NO_SHOW_REASONS = [('Patient niet verschenen (of te laat gemeld)', 0.7), ('No show (geen factuur)', 0.2),
+                   ('Verzoek patient (<24 uur van tevoren afgemeld)', 0.1)]
+SURNAMES = ['de Vries', 'Jansen', 'Bakker', 'Visser', 'Smit', 'Meijer', 'de Boer', 'Mulder', 'Kuipers', 'Nijhuis', 'Oude Wesselink',
+            'Kamphuis', 'Leferink', 'Bosch', 'Wolters', 'Brinkman', 'Hofman', 'Dijkstra', 'Huisman', 'Wessels']
+
+# appointment slots between 08:00 and 16:55, the morning is busier than the afternoon
+SLOTS = np.arange(8 * 60, 17 * 60, 5)
+SLOT_WEIGHTS = np.where(SLOTS < 12 * 60, 1.5, 1.0)
+
+
+def minutes_to_times(minutes: np.ndarray) -> np.ndarray:
+    '''
+    Converts minutes since midnight to 'hh:mm' strings
+    '''
+    return np.char.add(np.char.add(np.char.zfill((minutes // 60).astype(str), 2), ':'), np.char.zfill((minutes % 60).astype(str), 2))
+
+
+def to_category(indices: np.ndarray, options) -> pd.Categorical:
+    '''
+    Returns the category of options[indices] with sorted categories, the way the extraction gives them after apply_schema
+    Options which are None and indices -1 are missing. The strings are only made once per option instead of once per row
+    '''
+    options = pd.Series(np.asarray(options, dtype=object))
+    categories = pd.Index(options.dropna().unique()).sort_values()
+    codes = np.append(categories.get_indexer(options), -1)
+
+    return pd.Categorical.from_codes(codes[indices], categories=categories).remove_unused_categories()
+
+
+def choose(rng: np.random.Generator, options: list, weights, size: int) -> np.ndarray:
+    '''
+    Draws size indices of options with the given (not necessarily normalized) weights
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    return rng.choice(len(options), size, p=weights / weights.sum())
+
+
+def make_patients(n_patients: int, rng: np.random.Generator, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    '''
+    Makes the patients with their personal data, how often they come and how likely they are not to show up
+    '''
+    towns = choose(rng, TOWNS, [t[3] for t in TOWNS], n_patients)
+    low, high = np.array([t[1] for t in TOWNS])[towns], np.array([t[2] for t in TOWNS])[towns]
+    digits = rng.integers(low, high + 1).astype(str)
+    letters = np.char.add(rng.choice(list('ABCDEGHJKLMNPRSTVWXZ'), n_patients), rng.choice(list('ABCDEGHJKLMNPRSTVWXZ'), n_patients))
+
+    # most postal codes are written as '7555 AB', but the field is free text
+    formats = choose(rng, range(5), [0.80, 0.15, 0.03, 0.015, 0.005], n_patients)
+    postcodes = np.char.add(np.char.add(digits, ' '), letters).astype(object)
+    postcodes[formats == 1] = np.char.add(digits, letters)[formats == 1]
+    postcodes[formats == 2] = np.char.lower(np.char.add(np.char.add(digits, ' '), letters))[formats == 2]
+    postcodes[formats == 3] = None
+    postcodes[formats == 4] = np.char.add('D-', rng.integers(10000, 99999, n_patients).astype(str))[formats == 4]   # german patients
+
+    birth = pd.Timestamp('1925-01-01') + pd.to_timedelta(rng.integers(0, (end - pd.Timestamp('1925-01-01')).days, n_patients), unit='D')
+    # the appointments of a patient are grouped around a period of treatment
+    center = rng.integers(0, (end - start).days, n_patients)
+    spread = rng.exponential(400, n_patients) + 7
+
+    return pd.DataFrame({'GESLACHT': np.where(rng.random(n_patients) < 0.55, 'V', 'M'), 'POSTCODE': postcodes,
+                         'WOONPLAATS': np.array([t[0] for t in TOWNS])[towns], 'GEBDAT': birth,
+                         'NAAM': rng.choice(SURNAMES, n_patients), 'activity': rng.lognormal(0, 1.2, n_patients),
+                         'no_show_rate': rng.beta(1.2, 18, n_patients), 'center': center, 'spread': spread})
+
+
+def make_appointments(n_rows: int, seed: int = 0, n_patients: int = None, start: str = '2014-01-01', end: str = '2024-05-01',
+                      columns: str = 'appointments') -> pd.DataFrame:
+    '''
+    Makes n_rows synthetic appointments between start and end, ordered on STARTDATEPLAN like the extraction
+    The same seed always gives the same appointments
+
+    Paramters
+    ---------
+    n_rows : int
+        Number of appointments
+    seed : int
+        Seed of the random generator
+    n_patients : int
+        Number of patients, default one patient per 8 appointments.
+        The number of appointments per patient is heavy tailed (lognormal), so a few patients have a very long history
+    start, end : str
+        Period of the appointments (format: yyyy-mm-dd), appointments from end onwards are in the future (AfspraakstatusKey 1)
+    columns : str
+        'appointments' for the columns of get_appointments_from_db (back-end) or 'export' for the columns of no_show_query.sql
+
+    Returns
+    -------
+    pd.DataFrame
+        Appointments with the text columns as categories
+    '''
+    rng = np.random.default_rng(seed)
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    patients = make_patients(n_patients or max(n_rows // 8, 1), rng, start, end)
+
+    patient = rng.choice(len(patients), n_rows, p=(patients['activity'] / patients['activity'].sum()).to_numpy())
+    offset = patients['center'].to_numpy()[patient] + rng.normal(0, 1, n_rows) * patients['spread'].to_numpy()[patient]
+    business_days = pd.bdate_range(start, end + pd.Timedelta(days=60))   # some appointments are planned after the end
+    day = np.round(offset * len(business_days) / ((end - start).days + 60)).astype(np.int64)
+    outside = (day < 0) | (day >= len(business_days))
+    day[outside] = rng.integers(0, len(business_days), outside.sum())
+    order = np.argsort(day, kind='stable')
+    patient, startdate = patient[order], business_days[day[order]]
+
+    # planning: most appointments are planned weeks ahead, some on the same or the next days
+    lead = np.where(rng.random(n_rows) < 0.1, rng.integers(0, 3, n_rows), np.round(rng.lognormal(3.2, 0.9, n_rows))).astype(np.int64)
+    invoerdat = startdate - pd.to_timedelta(lead, unit='D')
+    slot = SLOTS[choose(rng, SLOTS, SLOT_WEIGHTS, n_rows)]
+    durations = np.array([5, 10, 15, 20, 30, 45, 60])
+    duration = choose(rng, durations, [0.05, 0.2, 0.3, 0.15, 0.2, 0.05, 0.05], n_rows)
+
+    agenda = choose(rng, AGENDAS, [a[2] for a in AGENDAS], n_rows)
+    location = choose(rng, LOCATIONS, [l[2] for l in LOCATIONS], n_rows)
+    code = choose(rng, CODES, [c[2] for c in CODES], n_rows)
+    specialisms = [a[1] for a in AGENDAS]
+
+    # outcome: a no show with the probability of the patient, a few status 6 appointments have an other reason and are left out
+    future = (startdate >= end)
+    no_show = ~future & (rng.random(n_rows) < patients['no_show_rate'].to_numpy()[patient])
+    other_reason = ~future & ~no_show & (rng.random(n_rows) < 0.03)
+    status = np.where(rng.random(n_rows) < 0.8, 5, np.where(rng.random(n_rows) < 0.75, 3, 7))
+    status = np.where(no_show, np.where(rng.random(n_rows) < 0.9, 6, 8), status)
+    status = np.where(other_reason, 6, np.where(~future & (rng.random(n_rows) < 0.01), 2, status))
+    status = np.where(future, 1, status)
+    reasons = [r[0] for r in NO_SHOW_REASONS] + ['Ziekte patient']
+    reason = np.full(n_rows, -1)
+    reason[no_show] = choose(rng, NO_SHOW_REASONS, [r[1] for r in NO_SHOW_REASONS], no_show.sum())
+    reason[other_reason] = len(reasons) - 1
+
+    # arrival: patients come some minutes early, the arrival is not registered for all appointments
+    times = minutes_to_times(np.arange(24 * 60))
+    arrival = np.clip(slot - np.round(rng.normal(12, 10, n_rows)), 0, 24 * 60 - 1).astype(np.int64)
+    arrival[no_show | future | (rng.random(n_rows) < 0.15)] = -1
+
+    speccode = agenda.copy()
+    speccode[rng.random(n_rows) < 0.15] = -1   # TARAFD is used when SPECCODE is missing
+    subagenda = len(AGENDAS) * rng.integers(0, 3, n_rows) + agenda
+    patients['PATIENTNR'] = np.arange(len(patients)) + 1000000
+
+    df = pd.DataFrame({
+        'PATIENTNR': patients['PATIENTNR'].to_numpy()[patient],
+        'MERGED': np.zeros(n_rows, dtype=np.int64), 'IsTestPatient': np.zeros(n_rows, dtype=np.int64),
+        'GESLACHT': to_category(patient, patients['GESLACHT']),
+        'POSTCODE': to_category(patient, patients['POSTCODE']),
+        'WOONPLAATS': to_category(patient, patients['WOONPLAATS']),
+        'LEEFTIJD': (startdate.year - patients['GEBDAT'].dt.year.to_numpy()[patient]).astype(np.float64),
+        'TIMEDIFF': to_category(duration, np.char.add(minutes_to_times(durations), ':00.0000000')),
+        'INVOERDAT': invoerdat, 'STARTDATEPLAN': startdate,
+        'STARTTIMEPLAN': to_category(slot, times),
+        'AANKOMST': to_category(arrival, times),
+        'AGENDA': to_category(agenda, [a[0] for a in AGENDAS]),
+        'SUBAGENDA': to_category(subagenda, [f'{a[0]}{i + 1}' for i in range(3) for a in AGENDAS]),
+        'SPECCODE': to_category(speccode, specialisms), 'TARAFD': to_category(agenda, specialisms),
+        'SPECIALISM': to_category(agenda, specialisms),
+        'LOCATIONID': to_category(location, [l[1] for l in LOCATIONS]),
+        'DESCRIPTION': to_category(location, [l[0] for l in LOCATIONS]),
+        'IsVoldaan': to_category(np.isin(status, [3, 5, 7]).astype(np.int64), ['Nee', 'Ja']),
+        'AfspraakstatusKey': pd.array(status, dtype='Int64'), 'REDEN': to_category(reason, reasons),
+        'CONSTYPE': to_category(choose(rng, range(4), [0.6, 0.25, 0.1, 0.05], n_rows), ['H', 'E', 'V', '*']),
+        'CODE': to_category(code, [c[0] for c in CODES]),
+        'MEMO': to_category(np.where(rng.random(n_rows) < 0.2, 0, -1), ['Graag 10 minuten van tevoren melden']),
+        'OMSCHR': to_category(code, [c[1] for c in CODES]), 'DUUR': pd.array(durations[duration], dtype='Int64'),
+        'GEBDAT': patients['GEBDAT'].to_numpy()[patient], 'NAAM': to_category(patient, patients['NAAM']),
+        'VERLOSKUNDE': ((np.array(specialisms)[agenda] == 'GYN') & (rng.random(n_rows) < 0.15)).astype(np.int64),
+        'PA': (rng.random(n_rows) < 0.03).astype(np.int64),
+    })
+
+    if columns == 'export':
+        return df[EXPORT_COLUMNS]
+    if columns == 'appointments':
+        df['PATIENTNR'] = to_category(patient, patients['PATIENTNR'].astype(str))   # a varchar in HiX
+        return df[APPOINTMENTS_COLUMNS]
+
+    raise ValueError(f'Unknown columns {columns}, use appointments or export')
+
+
+def write_zip_codes(path: str, seed: int = 0):
+    '''
+    Writes a postal code file in the format of geonames (https://download.geonames.org/export/zip/) for the codes 1000 to 9999
+    The coordinates run roughly from the west (1000) to the east of the Netherlands, Twente (7400 to 7699) is around Hengelo
+    '''
+    rng = np.random.default_rng(seed)
+    codes = np.arange(1000, 10000)
+    lat = np.where((codes >= 7400) & (codes < 7700), rng.normal(52.3, 0.08, len(codes)), rng.uniform(50.8, 53.4, len(codes)))
+    lon = np.where((codes >= 7400) & (codes < 7700), rng.normal(6.7, 0.1, len(codes)), 4.2 + (codes - 1000) / 9000 * 2.8)
+
+    pd.DataFrame({'country': 'NL', 'code': codes, 'place': 'Plaats', 'admin1': 'Overijssel', 'admin1_code': 'OV', 'admin2': '',
+                  'admin2_code': '', 'admin3': '', 'admin3_code': '', 'latitude': lat.round(4), 'longitude': lon.round(4), 'accuracy': 6}
+                 ).to_csv(path, sep='\t', header=False, index=False)
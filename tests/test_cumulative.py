@@ -0,0 +1,98 @@
+'''The cumulative features of both copies of cumulative.py are the same as those of the rolling window implementation they replaced'''
+
+import os
+import sys
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+import synthetic
+
+
+def load_cumulative(copy: str):
+    # both copies are a module features.cumulative, so they are loaded from their files under their own names
+    path = os.path.join(ROOT, copy, 'preprocessing', 'features', 'cumulative.py')
+    spec = importlib.util.spec_from_file_location(f'cumulative_{copy.replace("/", "_").replace("-", "_")}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+COPIES = {'training': load_cumulative('3_PreProcessing'), 'back-end': load_cumulative('5_Deployment/back-end')}
+
+
+def calculate_cum_features_baseline(df: pd.DataFrame, history_years: int, exclude_days: int, training: bool) -> pd.DataFrame:
+    '''
+    The rolling window and merge_asof implementation of calculate_cum_features before it was rewritten
+    The training copy subtracts the number of appointments from the summed arrival times instead of dividing by it
+    '''
+    df = df.set_index(['PATIENTNR', 'STARTDATEPLAN'])
+    df = df[~df.index.duplicated(keep='last')].reset_index()
+    df = df.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'])
+
+    window_days = 365 * history_years
+    df_period = df.reset_index().set_index('STARTDATEPLAN').groupby('PATIENTNR', sort=False)[['no_show', 'VerschilAankomstEnStart']].rolling(f'{window_days}D')
+    df_exclude = df.reset_index().set_index('STARTDATEPLAN').groupby('PATIENTNR', sort=False)[['no_show', 'VerschilAankomstEnStart']].rolling(f'{exclude_days}D')
+
+    df_num_no_shows = (df_period['no_show'].sum() - df_exclude['no_show'].sum()).reset_index().rename(columns={'no_show': 'num_no_shows'})
+    df = df.merge(df_num_no_shows, on=['STARTDATEPLAN', 'PATIENTNR'])
+    df_num_appointments = (df_period['no_show'].count() - df_exclude['no_show'].count()).reset_index().rename(columns={'no_show': 'num_appointments'})
+    df = df.merge(df_num_appointments, on=['STARTDATEPLAN', 'PATIENTNR'])
+    df['perc_no_shows'] = df['num_no_shows'] / df['num_appointments']
+
+    df_stiptheid = (df_period['VerschilAankomstEnStart'].sum() - df_exclude['VerschilAankomstEnStart'].sum().fillna(0)).reset_index() \
+        .rename(columns={'VerschilAankomstEnStart': 'stiptheid'})
+    df = df.merge(df_stiptheid, on=['STARTDATEPLAN', 'PATIENTNR'])
+    df['stiptheid'] = df['stiptheid'] - df['num_appointments'] if training else df['stiptheid'] / df['num_appointments']
+
+    df = df.sort_values(by=['PATIENTNR', 'STARTDATEPLAN'])
+    df_shifted = df.copy()
+    df_shifted['STARTDATEPLAN'] = df_shifted['STARTDATEPLAN'] + pd.Timedelta(days=exclude_days)
+    df_shifted = df_shifted.rename(columns={'no_show': 'last_noshow'})
+    df = pd.merge_asof(df.sort_values(by=['STARTDATEPLAN']), df_shifted[['PATIENTNR', 'STARTDATEPLAN', 'last_noshow']].sort_values(by=['STARTDATEPLAN']),
+                       on='STARTDATEPLAN', by='PATIENTNR', direction='backward')
+
+    df = df.sort_values(by=['PATIENTNR', 'STARTDATEPLAN'])
+    df_shifted = df.copy()
+    df_shifted['DATE_PREV_APP'] = df_shifted['STARTDATEPLAN']
+    df_shifted['STARTDATEPLAN'] = df_shifted['STARTDATEPLAN'] + pd.Timedelta(days=exclude_days)
+    df = pd.merge_asof(df.sort_values(by=['STARTDATEPLAN']), df_shifted[['PATIENTNR', 'STARTDATEPLAN', 'DATE_PREV_APP']].sort_values(by=['STARTDATEPLAN']),
+                       on='STARTDATEPLAN', by='PATIENTNR', direction='backward')
+    df['days_since_last_appointment'] = (df['DATE_PREV_APP'] - df['STARTDATEPLAN']).dt.days
+
+    return df
+
+
+def make_history(n_rows: int, seed: int) -> pd.DataFrame:
+    '''
+    Synthetic appointments with the columns calculate_cum_features needs, the no shows and arrival times of benchmark/synthetic.py
+    '''
+    df = synthetic.make_appointments(n_rows, seed=seed, n_patients=n_rows // 20, start='2016-01-01', end='2024-05-01')
+    start_minutes = pd.to_timedelta(df['STARTTIMEPLAN'].astype(str) + ':00').dt.total_seconds() / 60
+    arrival_minutes = pd.to_timedelta(df['AANKOMST'].astype(object).where(df['AANKOMST'].notna(), None) + ':00').dt.total_seconds() / 60
+
+    return pd.DataFrame({'PATIENTNR': df['PATIENTNR'].astype(str), 'STARTDATEPLAN': df['STARTDATEPLAN'],
+                         'no_show': df['AfspraakstatusKey'].isin([6, 8]).astype(np.int64),
+                         'VerschilAankomstEnStart': (start_minutes - arrival_minutes).to_numpy(dtype=np.float64),
+                         'SPECIALISME': df['SPECIALISM'].astype(str)})
+
+
+def sort_rows(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(by=['STARTDATEPLAN', 'PATIENTNR'], kind='mergesort').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('copy', list(COPIES))
+@pytest.mark.parametrize('exclude_days', [3, 5])
+def test_same_features_as_the_baseline(copy, exclude_days):
+    df = make_history(20000, seed=exclude_days)
+    expected = sort_rows(calculate_cum_features_baseline(df.copy(), history_years=2, exclude_days=exclude_days, training=copy == 'training'))
+    result = COPIES[copy].calculate_cum_features(df.copy(), history_years=2, exclude_days=exclude_days)
+
+    # the rewrite returns the rows sorted by (STARTDATEPLAN, PATIENTNR), the baseline only by STARTDATEPLAN
+    assert result['STARTDATEPLAN'].is_monotonic_increasing
+    pd.testing.assert_frame_equal(sort_rows(result)[expected.columns], expected, check_exact=False, rtol=1e-9)
+    assert sorted(result.columns) == sorted(expected.columns)
@@ -0,0 +1,60 @@
+'''The history store plus the appointments of a nightly run give the same cumulative features as a recompute on the full history'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '5_Deployment', 'back-end', 'preprocessing'))
+from features import cumulative, history_store
+from test_cumulative import make_history
+
+
+def assert_same_store(a: dict, b: dict):
+    assert a.keys() == b.keys()
+    for key in a:
+        assert np.array_equal(a[key], b[key], equal_nan=a[key].dtype.kind == 'f'), key
+
+
+@pytest.mark.parametrize('extended', [False, True])
+def test_store_and_refreshed_days_give_the_full_features(extended):
+    df = make_history(20000, seed=11)
+    today = pd.Timestamp('2024-03-01')
+    last_run = today - pd.offsets.BDay(1)
+    refresh_start = last_run - pd.offsets.BDay(5)
+
+    # the store was appended the night before, when the outcomes of the last days were not final yet:
+    # some no shows were registered later and some appointments were cancelled afterwards
+    rng = np.random.default_rng(0)
+    recent = df.index[(df['STARTDATEPLAN'] >= refresh_start) & (df['STARTDATEPLAN'] < last_run)]
+    changed = rng.choice(recent, len(recent) // 4, replace=False)
+    df_then = df.copy()
+    df_then.loc[changed, 'no_show'] = 1 - df_then.loc[changed, 'no_show']
+    later = df.index[(df['STARTDATEPLAN'] > refresh_start) & (df['STARTDATEPLAN'] < last_run)]
+    cancelled = df_then.loc[rng.choice(later, 20, replace=False)].assign(STARTDATEPLAN=lambda d: d['STARTDATEPLAN'] - pd.Timedelta(days=1))
+    df_then = pd.concat([df_then, cancelled], ignore_index=True)
+    store = history_store.build_history_store(df_then, last_run)
+
+    # the nightly run reopens the last workdays and extracts everything from there on
+    store = history_store.reopen_history_store(store, history_store.get_closed_until(store) - pd.offsets.BDay(5))
+    assert history_store.get_closed_until(store) == refresh_start
+    delta = df[df['STARTDATEPLAN'] >= history_store.get_closed_until(store)]
+
+    result = history_store.calculate_cum_features_from_store(store, delta.copy(), history_years=2, exclude_days=3, extended=extended)
+    expected = cumulative.calculate_cum_features(df.copy(), history_years=2, exclude_days=3, extended=extended)
+    expected = expected[expected['STARTDATEPLAN'] >= refresh_start].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_exact=False, rtol=1e-9)
+
+    # after the run the store holds the current outcomes, the same as a store built from the full history
+    store = history_store.append_to_history_store(store, delta, closed_until=today)
+    assert_same_store(store, history_store.build_history_store(df, today))
+
+
+def test_build_from_batches_of_months():
+    df = make_history(5000, seed=12)
+    closed_until = pd.Timestamp('2024-03-01')
+    months = [month for _, month in df.groupby(df['STARTDATEPLAN'].dt.to_period('M'))]
+
+    assert_same_store(history_store.build_history_store_from_batches(months, closed_until), history_store.build_history_store(df, closed_until))
@@ -0,0 +1,45 @@
+'''The encoded features can be fitted and predicted by xgboost, also with integer and boolean values in the vocabularies'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import xgboost
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '5_Deployment', 'back-end', 'preprocessing'))
+from features import vocabulary
+
+
+def make_features(n_rows: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'POSTCODE': rng.choice([7607, 7511, 7551, np.nan], n_rows), 'AfspraakZelfdeDag': rng.choice([False, True], n_rows),
+                         'CONSTYPE': pd.Categorical(rng.choice(['H', 'E', 'V'], n_rows)), 'LEEFTIJD': rng.uniform(0, 90, n_rows)})
+
+
+def test_fit_and_predict_on_encoded_features():
+    train = make_features(500, seed=0)
+    columns = ['POSTCODE', 'AfspraakZelfdeDag', 'CONSTYPE']
+    vocabularies = vocabulary.build_vocabularies(train, columns=columns)
+    y = np.random.default_rng(1).integers(0, 2, len(train))
+
+    model = xgboost.XGBClassifier(enable_categorical=True, tree_method='hist', n_estimators=5)
+    model.fit(vocabulary.encode(train.copy(), vocabularies), y)
+
+    test = make_features(100, seed=2)
+    test.loc[:9, 'POSTCODE'] = 1234
+    encoded = vocabulary.encode(test.copy(), vocabularies)
+    assert (encoded['POSTCODE'].cat.codes[:10] == len(vocabularies['POSTCODE'])).all()
+    assert model.predict_proba(encoded).shape == (100, 2)
+
+
+def test_codes_are_positions_in_the_vocabulary():
+    df = make_features(200, seed=3)
+    vocabularies = vocabulary.build_vocabularies(df, columns=['POSTCODE', 'AfspraakZelfdeDag', 'CONSTYPE'])
+    encoded = vocabulary.encode(df.copy(), vocabularies)
+
+    for col, values in vocabularies.items():
+        codes = encoded[col].cat.codes.to_numpy()
+        expected = pd.Index(values).get_indexer(df[col])
+        assert np.array_equal(codes, expected)
+        assert encoded[col].cat.categories.tolist() == [str(value) for value in values] + [vocabulary.UNKNOWN]